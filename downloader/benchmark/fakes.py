@@ -0,0 +1,225 @@
+from typing import List, Dict, Tuple, Any, Optional, Union
+import os
+import time
+import zlib
+import base64
+import socket
+import struct
+
+from transmission_rpc import Torrent
+from deluge_client import rencode
+import deluge_client.client
+
+from downloader.state import config
+from downloader.state import state
+from downloader.model import metainfo
+from downloader.benchmark.library import SyntheticTorrent
+from downloader.torrent_clients import deluge
+from downloader.torrent_clients import transmission
+from downloader.pipeline import seedboxes
+
+
+def configure(workdir: str, **options: Any) -> None:
+    """Point the config (and state database) at a fresh work directory"""
+    state.close()
+    temp_dir = os.path.join(workdir, "temp")
+    final_dir = os.path.join(workdir, "final")
+    watch_dir = os.path.join(workdir, "watch")
+    for directory in (temp_dir, final_dir, watch_dir):
+        os.makedirs(directory, exist_ok=True)
+    config.config_cache = {
+        "state_json": os.path.join(workdir, "state.json"),
+        "sftp_host": "localhost",
+        "sftp_port": 22,
+        "sftp_user": "user",
+        "sftp_password": "",
+        "pget_conn": 4,
+        "mirror_parallel": 4,
+        "mirror_conn": 2,
+        "transfer_engine": "local",
+        "chmod_download": False,
+        "torrent_client_type": "deluge",
+        "torrent_client_options": {},
+        "torrent_watch_dirs": [{"directory": watch_dir, "temp_download_dir": temp_dir, "final_download_dir": final_dir}],
+        **options,
+    }
+
+
+class FakeDelugeClient(object):
+    """In-memory stand-in for deluge_client.DelugeRPCClient, answering the rpc calls the deluge module makes"""
+
+    def __init__(self, torrents: Dict[str, SyntheticTorrent], latency: float = 0):
+        self.torrents = torrents
+        self.latency = latency
+        self.connected = True
+        self.calls: List[str] = []
+
+    def _status(self, torrent: SyntheticTorrent, keys: List[str]) -> Dict[str, Any]:
+        status: Dict[str, Any] = {}
+        for key in keys:
+            if key == "completed_time":
+                status[key] = torrent.completed_time
+            elif key == "download_location":
+                status[key] = torrent.download_location
+            elif key == "name":
+                status[key] = torrent.name
+            elif key == "eta":
+                status[key] = 0 if torrent.completed_time else torrent.eta
+            elif key == "files":
+                status[key] = [{"index": i, "path": path, "size": size, "offset": 0} for i, (path, size) in enumerate(torrent.files)]
+            elif key == "file_progress":
+                status[key] = [1.0 if torrent.is_file_complete(path) else 0.0 for path, _ in torrent.files]
+        return status
+
+    def _add(self, infohash: str) -> str:
+        if infohash not in self.torrents:
+            self.torrents[infohash] = SyntheticTorrent(len(self.torrents) + 1, infohash, infohash, [], "/remote/downloads", 0)
+        return infohash
+
+    def call(self, method: str, *args: Any) -> Any:
+        self.calls.append(method)
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "core.get_torrents_status":
+            filter_dict, keys = args
+            ids = filter_dict.get("id", list(self.torrents))
+            return {infohash: self._status(self.torrents[infohash], keys) for infohash in ids if infohash in self.torrents}
+        if method == "core.add_torrent_file":
+            return self._add(metainfo.infohash_from_torrent(base64.b64decode(args[1])))
+        if method == "core.add_torrent_magnet":
+            infohash = metainfo.infohash_from_magnet(args[0])
+            if infohash is None:
+                raise ValueError(f"Invalid magnet {args[0]}")
+            return self._add(infohash)
+        raise NotImplementedError(f"Fake deluge client does not implement {method}")
+
+
+class FakeDelugeEventConnection(object):
+    """Stand-in for the deluge_client connection which the deluge module listens for events on, with the daemon's end of it a local socket"""
+
+    def __init__(self) -> None:
+        self._socket, self._daemon_socket = socket.socketpair()
+        self.host = "fake"
+        self.deluge_version = 2
+        self.deluge_protocol_version = 1
+        self.connected = True
+        self.calls: List[str] = []
+
+    def call(self, method: str, *args: Any) -> Any:
+        self.calls.append(method)
+        return None
+
+    def _send_call(self, deluge_version: int, protocol_version: int, method: str, *args: Any) -> None:
+        # Heartbeats go unanswered
+        self.calls.append(method)
+
+    def disconnect(self) -> None:
+        self._socket.close()
+
+    def send_event(self, name: str, *args: Any) -> None:
+        payload = zlib.compress(rencode.dumps((deluge_client.client.RPC_EVENT, name, args)))
+        self._daemon_socket.sendall(struct.pack("!BI", self.deluge_protocol_version, len(payload)) + payload)
+
+
+class _FakeEventsDelugeClient(deluge.DelugeClient):
+    def __init__(self, events: FakeDelugeEventConnection):
+        super().__init__({"host": "fake"})
+        self._events = events
+
+    def _new_client(self, automatic_reconnect: bool = True) -> Any:
+        return self._events
+
+
+class _AddedTorrent(object):
+    def __init__(self, hash_string: str):
+        self.hash_string = hash_string
+
+
+class FakeTransmissionClient(object):
+    """In-memory stand-in for transmission_rpc.Client, returning real transmission_rpc Torrent objects"""
+
+    def __init__(self, torrents: Dict[str, SyntheticTorrent], latency: float = 0, recently_active: Optional[List[str]] = None):
+        self.torrents = torrents
+        self.latency = latency
+        self._by_id = {torrent.torrent_id: torrent for torrent in torrents.values()}
+        # Infohashes reported by get_recently_active_torrents
+        self.recently_active = recently_active or []
+        self.calls: List[str] = []
+
+    def _torrent(self, torrent: SyntheticTorrent, arguments: List[str]) -> Torrent:
+        # Like the real client, id is always included
+        fields: Dict[str, Any] = {"id": torrent.torrent_id}
+        for argument in arguments:
+            if argument == "hashString":
+                fields[argument] = torrent.infohash
+            elif argument == "percentDone":
+                fields[argument] = 1.0 if torrent.completed_time else 0.5
+            elif argument == "eta":
+                fields[argument] = torrent.eta if torrent.eta > 0 and not torrent.completed_time else -1
+            elif argument == "doneDate":
+                fields[argument] = torrent.completed_time
+            elif argument == "downloadDir":
+                fields[argument] = torrent.download_location
+            elif argument == "name":
+                fields[argument] = torrent.name
+            elif argument == "files":
+                fields[argument] = [
+                    {"name": path, "length": size, "bytesCompleted": size if torrent.is_file_complete(path) else 0} for path, size in torrent.files
+                ]
+        return Torrent(fields=fields)
+
+    def _find(self, torrent_id: Union[int, str]) -> Optional[SyntheticTorrent]:
+        return self._by_id.get(torrent_id) if isinstance(torrent_id, int) else self.torrents.get(torrent_id)
+
+    def get_torrents(self, ids: Optional[List[Union[int, str]]] = None, arguments: Optional[List[str]] = None) -> List[Torrent]:
+        self.calls.append("torrent-get")
+        if self.latency:
+            time.sleep(self.latency)
+        found = [self._find(torrent_id) for torrent_id in ids] if ids is not None else list(self.torrents.values())
+        return [self._torrent(torrent, arguments or []) for torrent in found if torrent is not None]
+
+    def get_recently_active_torrents(self, arguments: Optional[List[str]] = None) -> Tuple[List[Torrent], List[int]]:
+        self.calls.append("torrent-get-recently-active")
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._torrent(self.torrents[infohash], arguments or []) for infohash in self.recently_active], []
+
+    def add_torrent(self, torrent: Union[bytes, str]) -> _AddedTorrent:
+        self.calls.append("torrent-add")
+        if self.latency:
+            time.sleep(self.latency)
+        infohash = metainfo.infohash_from_torrent(torrent) if isinstance(torrent, bytes) else metainfo.infohash_from_magnet(torrent)
+        if infohash is None:
+            raise ValueError("Invalid torrent")
+        if infohash not in self.torrents:
+            added = SyntheticTorrent(len(self.torrents) + 1, infohash, infohash, [], "/remote/downloads", 0)
+            self.torrents[infohash] = added
+            self._by_id[added.torrent_id] = added
+        return _AddedTorrent(infohash)
+
+
+def install_deluge(fake: FakeDelugeClient, pooled_connections: int = 8, events: Optional[FakeDelugeEventConnection] = None) -> deluge.DelugeClient:
+    """Create a deluge client which uses a fake connection (and fake pooled connections), as the only seedbox.
+    If events is given, it is the connection the client listens for events on once completion events are started
+    """
+    client = deluge.DelugeClient({"host": "fake"}) if events is None else _FakeEventsDelugeClient(events)
+    client.client = fake
+    for _ in range(pooled_connections):
+        client._add_clients.put(fake)
+    install_seedboxes({"default": client})
+    return client
+
+
+def install_transmission(fake: FakeTransmissionClient) -> transmission.TransmissionClient:
+    """Create a transmission client which uses a fake connection, as the only seedbox"""
+    client = transmission.TransmissionClient({"host": "fake"})
+    client.client = fake  # type: ignore
+    install_seedboxes({"default": client})
+    return client
+
+
+def install_seedboxes(clients: Dict[str, Any]) -> None:
+    """Replace the configured seedboxes with the given (fake) torrent clients, keyed by seedbox name"""
+    with seedboxes._seedboxes_lock:
+        seedboxes._seedboxes[:] = [seedboxes.Seedbox(name, client) for name, client in clients.items()]
+    seedboxes._pushing.clear()
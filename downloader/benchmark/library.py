@@ -0,0 +1,137 @@
+from typing import List, Dict, Set, Tuple, Any, Union
+import os
+import random
+import hashlib
+
+# (path relative to the torrent's download location, size)
+FileList = List[Tuple[str, int]]
+
+
+class SyntheticTorrent(object):
+    """A torrent as the fake torrent clients see it"""
+
+    def __init__(self, torrent_id: int, infohash: str, name: str, files: FileList, download_location: str, completed_time: int):
+        self.torrent_id = torrent_id
+        self.infohash = infohash
+        self.name = name
+        self.files = files
+        self.download_location = download_location
+        # 0 while incomplete
+        self.completed_time = completed_time
+        # Files which are complete while the torrent isn't
+        self.completed_files: Set[str] = set()
+        # Seconds until an incomplete torrent completes, 0 if the client can't estimate it
+        self.eta = 0
+
+    def is_file_complete(self, path: str) -> bool:
+        return bool(self.completed_time) or path in self.completed_files
+
+
+def bencode(value: Union[int, bytes, str, List[Any], Dict[Any, Any]]) -> bytes:
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    if isinstance(value, dict):
+        items = sorted((key.encode("utf-8") if isinstance(key, str) else key, item) for key, item in value.items())
+        return b"d" + b"".join(bencode(key) + bencode(item) for key, item in items) + b"e"
+    raise TypeError(f"Can't bencode {type(value)}")
+
+
+def make_metainfo(name: str, files: FileList, root: str = "") -> bytes:
+    """Build a .torrent file for the given files. Piece hashes are of the files under root if given, otherwise random since the data never exists"""
+    total = sum(size for _, size in files)
+    # Like common torrent creators, grow the piece size with the total size to keep the number of pieces reasonable
+    piece_length = 1 << 18
+    while total // piece_length > 2000 and piece_length < 1 << 24:
+        piece_length <<= 1
+    pieces = _hash_tree(root, files, piece_length) if root else os.urandom(20 * max(1, -(-total // piece_length)))
+    info: Dict[str, Any] = {"name": name, "piece length": piece_length, "pieces": pieces}
+    if len(files) == 1 and files[0][0] == name:
+        info["length"] = files[0][1]
+    else:
+        info["files"] = [{"length": size, "path": path.split("/")[1:]} for path, size in files]
+    return bencode({"announce": "http://tracker.invalid/announce", "info": info})
+
+
+def _hash_tree(root: str, files: FileList, piece_length: int) -> bytes:
+    hashes: List[bytes] = []
+    piece = b""
+    for path, _ in files:
+        with open(os.path.join(root, path), "rb") as f:
+            while True:
+                data = f.read(piece_length - len(piece))
+                if not data:
+                    break
+                piece += data
+                if len(piece) == piece_length:
+                    hashes.append(hashlib.sha1(piece).digest())
+                    piece = b""
+    if piece:
+        hashes.append(hashlib.sha1(piece).digest())
+    return b"".join(hashes)
+
+
+def make_files(name: str, count: int, rng: random.Random, max_depth: int = 3, files_per_dir: int = 200) -> FileList:
+    """Synthetic file list for a torrent called name, i.e. a season pack or a large collection nested a few directories deep"""
+    files: FileList = []
+    for i in range(count):
+        parts = [name]
+        remaining = i // files_per_dir
+        for depth in range(max_depth - 1):
+            if remaining == 0:
+                break
+            parts.append(f"dir{depth}_{remaining % 10}")
+            remaining //= 10
+        parts.append(f"file{i:06d}.{rng.choice(('mkv', 'nfo', 'srt', 'jpg', 'flac'))}")
+        files.append(("/".join(parts), rng.randint(1 << 10, 1 << 30)))
+    return files
+
+
+def make_rar_set(name: str, volumes: int, volume_size: int, scheme: str = "part") -> FileList:
+    """File list of a multipart rar set, named with the 'part', 'digit' (.001) or 'old' (.rar, .r00) scheme"""
+    files: FileList = []
+    for i in range(volumes):
+        if scheme == "part":
+            volume = f"{name}.part{i + 1:02d}.rar"
+        elif scheme == "digit":
+            volume = f"{name}.{i + 1:03d}.rar"
+        else:
+            volume = f"{name}.rar" if i == 0 else f"{name}.r{i - 1:02d}"
+        files.append((f"{name}/{volume}", volume_size))
+    files.append((f"{name}/{name}.nfo", 4096))
+    return files
+
+
+def make_library(count: int, completed_ratio: float, files_per_torrent: int, download_location: str, seed: int = 0) -> Dict[str, SyntheticTorrent]:
+    """Synthetic library of torrents keyed by infohash. completed_ratio of them are complete, and every fifth one is a single file"""
+    rng = random.Random(seed)
+    torrents: Dict[str, SyntheticTorrent] = {}
+    for i in range(count):
+        name = f"Synthetic.Torrent.{i:06d}"
+        infohash = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        if i % 5 == 0:
+            files = [(f"{name}.mkv", rng.randint(1 << 20, 1 << 32))]
+        else:
+            files = make_files(name, files_per_torrent, rng)
+        completed_time = 1700000000 + i if rng.random() < completed_ratio else 0
+        torrents[infohash] = SyntheticTorrent(i + 1, infohash, name, files, download_location, completed_time)
+    return torrents
+
+
+def write_tree(root: str, files: FileList, size: int = 0) -> None:
+    """Create the given files on disk under root. Every file gets size bytes (instead of its listed size), so large libraries fit on disk"""
+    data = os.urandom(size)
+    made_dirs = set()
+    for path, _ in files:
+        full_path = os.path.join(root, path)
+        parent = os.path.dirname(full_path)
+        if parent not in made_dirs:
+            os.makedirs(parent, exist_ok=True)
+            made_dirs.add(parent)
+        with open(full_path, "wb") as f:
+            f.write(data)
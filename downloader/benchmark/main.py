@@ -0,0 +1,671 @@
+from typing import List, Dict, Tuple, Any, Callable, Iterator, Optional
+import os
+import sys
+import json
+import time
+import threading
+import random
+import shutil
+import zipfile
+import contextlib
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+from downloader.state import config
+from downloader.state import state
+from downloader.model.download_obj import DownloadObject, transfer_batch
+from downloader.model.manifest import Manifest, classify_archive
+from downloader.model import metainfo
+from downloader.pipeline import rar_stream
+from downloader.pipeline import scheduler
+from downloader.pipeline import diskspace
+from downloader.pipeline import seedboxes
+from downloader.pipeline import polling
+from downloader.torrent_clients import deluge
+from downloader.torrent_clients import transmission
+from downloader.benchmark import fakes
+from downloader.benchmark import library
+
+log = logging.getLogger("benchmark")
+
+# A benchmark does its (untimed) setup in a work directory at the given scale,
+# then returns the function to time and the number of items that function processes
+BenchmarkSetup = Callable[[str, float], Tuple[Callable[[], Any], int]]
+
+
+def _scaled(count: int, scale: float) -> int:
+    return max(1, int(count * scale))
+
+
+def _watch_library(workdir: str, torrents: Dict[str, library.SyntheticTorrent]) -> None:
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    with state.batch():
+        for infohash, torrent in torrents.items():
+            state.add_watching_torrent(
+                infohash, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], torrent.name, watch_dir=watch_dir["directory"]
+            )
+
+
+def bench_state_add(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Individually committed adds"""
+    fakes.configure(workdir)
+    count = _scaled(1000, scale)
+    state.get_watching_torrents()
+
+    def run() -> None:
+        for i in range(count):
+            state.add_watching_torrent(f"{i:040x}", "/tmp", "/final", f"torrent {i}")
+
+    return run, count
+
+
+def bench_state_add_batch(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    fakes.configure(workdir)
+    count = _scaled(10000, scale)
+    state.get_watching_torrents()
+
+    def run() -> None:
+        with state.batch():
+            for i in range(count):
+                state.add_watching_torrent(f"{i:040x}", "/tmp", "/final", f"torrent {i}")
+
+    return run, count
+
+
+def bench_state_read(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Reads of the full watching index, as every poll does"""
+    fakes.configure(workdir)
+    _watch_library(workdir, library.make_library(_scaled(10000, scale), 0, 1, "/remote"))
+    reads = 100
+
+    def run() -> None:
+        for _ in range(reads):
+            state.get_watching_torrents()
+
+    return run, reads
+
+
+def bench_state_reopen(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Startup cost of loading a large state database"""
+    fakes.configure(workdir)
+    count = _scaled(10000, scale)
+    _watch_library(workdir, library.make_library(count, 0, 1, "/remote"))
+    state.close()
+    return state.get_watching_torrents, count
+
+
+def bench_ingest(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Watch directory scan, local infohash computation, submission to the (fake) client and state update"""
+    fakes.configure(workdir)
+    # Imported here since downloader.main selects the torrent client from the config on import
+    from downloader import main
+
+    watch_dir = config.get_torrent_watch_dirs()[0]["directory"]
+    torrents = library.make_library(_scaled(1000, scale), 0, 20, "/remote")
+    for torrent in torrents.values():
+        with open(os.path.join(watch_dir, f"{torrent.name}.torrent"), "wb") as f:
+            f.write(library.make_metainfo(torrent.files[0][0].split("/")[0], torrent.files))
+    fakes.install_deluge(fakes.FakeDelugeClient({}))
+    return main.ingest_watch_dirs, len(torrents)
+
+
+def _poll_library(workdir: str, scale: float) -> Dict[str, library.SyntheticTorrent]:
+    fakes.configure(workdir)
+    torrents = library.make_library(_scaled(10000, scale), 0.1, 20, "/remote/downloads")
+    _watch_library(workdir, torrents)
+    return torrents
+
+
+def bench_deluge_poll_cold(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """First poll of a large library, which fetches the file lists of every completed torrent"""
+    torrents = _poll_library(workdir, scale)
+    client = fakes.install_deluge(fakes.FakeDelugeClient(torrents))
+    watching = state.get_watching_torrents()
+    return lambda: client.get_download_objects_for_watching_torrents(watching), len(torrents)
+
+
+def bench_deluge_poll_warm(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Steady state poll of a large library where nothing changed"""
+    torrents = _poll_library(workdir, scale)
+    client = fakes.install_deluge(fakes.FakeDelugeClient(torrents))
+    watching = state.get_watching_torrents()
+    client.get_download_objects_for_watching_torrents(watching)
+    return lambda: client.get_download_objects_for_watching_torrents(watching), len(torrents)
+
+
+def _huge_torrent(workdir: str, scale: float) -> Dict[str, library.SyntheticTorrent]:
+    fakes.configure(workdir)
+    name = "Huge.Collection"
+    files = library.make_files(name, _scaled(50000, scale), random.Random(0))
+    torrents = {"f" * 40: library.SyntheticTorrent(1, "f" * 40, name, files, "/remote/downloads", 1700000000)}
+    _watch_library(workdir, torrents)
+    return torrents
+
+
+def bench_deluge_filter_huge(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Turning the status of a single torrent with a huge number of files into download objects"""
+    torrents = _huge_torrent(workdir, scale)
+    status = fakes.FakeDelugeClient(torrents).call("core.get_torrents_status", {}, ["completed_time", "download_location", "files"])
+    watching = state.get_watching_torrents()
+    return lambda: deluge._filter_torrents_status_results(status, watching), len(torrents["f" * 40].files)
+
+
+def bench_deluge_events(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Torrents of a large library completing one after another, each queued from its deluge completion event rather than a poll"""
+    torrents = _poll_library(workdir, scale)
+    incomplete = [torrent for torrent in torrents.values() if not torrent.completed_time]
+    events = fakes.FakeDelugeEventConnection()
+    fakes.install_deluge(fakes.FakeDelugeClient(torrents), events=events)
+    submitted: List[Any] = []
+    connected = threading.Event()
+
+    def submit(objs: List[Any]) -> int:
+        submitted.extend(objs)
+        connected.set()
+        return len(objs)
+
+    seedboxes.start_completion_events(submit)
+    # Connecting checks every watched torrent, since events could have been missed
+    connected.wait()
+    already_completed = len(submitted)
+
+    def run() -> None:
+        for torrent in incomplete:
+            torrent.completed_time = 1700000000
+            events.send_event("TorrentFinishedEvent", torrent.infohash)
+        while len({obj.infohash for obj in submitted[already_completed:]}) < len(incomplete):
+            time.sleep(0.001)
+
+    return run, len(incomplete)
+
+
+def bench_deluge_poll_scheduled(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """An hour of scheduled polls of a large library where a fifth of the incomplete torrents complete at some point and the rest are stalled"""
+    torrents = _poll_library(workdir, scale)
+    rng = random.Random(0)
+    completes_at = {infohash: rng.uniform(1, 3600) for infohash, torrent in torrents.items() if not torrent.completed_time and rng.random() < 0.2}
+    completing = len(completes_at)
+    fake = fakes.FakeDelugeClient(torrents)
+    client = fakes.install_deluge(fake)
+    watching = state.get_watching_torrents()
+
+    def run() -> None:
+        poll_schedule = polling.PollSchedule(15, 2, 300)
+        now = 0.0
+        latency = 0.0
+        while now < 3600:
+            for infohash, at in completes_at.items():
+                torrents[infohash].eta = max(0, int(at - now) + 1)
+                if at <= now and not torrents[infohash].completed_time:
+                    torrents[infohash].completed_time = 1700000000
+            due = poll_schedule.due(watching, now)
+            etas: Dict[str, float] = {}
+            for obj in client.get_download_objects_for_watching_torrents(watching, due, etas):
+                if obj.infohash in completes_at:
+                    latency += now - completes_at.pop(obj.infohash)
+                    watching.pop(obj.infohash)
+            poll_schedule.plan(watching, due, etas, now)
+            now += poll_schedule.seconds_until_next(now)
+        queries = fake.calls.count("core.get_torrents_status") - completing
+        log.debug(
+            f"{queries} status queries (rather than {3600 // 15}), {latency / max(1, completing):.2f}s mean latency from completion to being queued"
+        )
+
+    return run, len(torrents)
+
+
+def bench_transmission_poll_cold(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    torrents = _poll_library(workdir, scale)
+    client = fakes.install_transmission(fakes.FakeTransmissionClient(torrents))
+    watching = state.get_watching_torrents()
+    return lambda: client.get_download_objects_for_watching_torrents(watching), len(torrents)
+
+
+def bench_transmission_poll_warm(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Steady state poll, which only asks about recently active torrents"""
+    torrents = _poll_library(workdir, scale)
+    recently_active = [infohash for infohash, torrent in torrents.items() if not torrent.completed_time][:50]
+    client = fakes.install_transmission(fakes.FakeTransmissionClient(torrents, recently_active=recently_active))
+    watching = state.get_watching_torrents()
+    client.get_download_objects_for_watching_torrents(watching)
+    return lambda: client.get_download_objects_for_watching_torrents(watching), len(torrents)
+
+
+def bench_transmission_filter_huge(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    torrents = _huge_torrent(workdir, scale)
+    status = fakes.FakeTransmissionClient(torrents).get_torrents(None, ["hashString", "downloadDir", "doneDate", "files"])
+    watching = state.get_watching_torrents()
+    return lambda: transmission._filter_torrents_status_results(status, watching), len(torrents["f" * 40].files)
+
+
+def _write_huge_tree(workdir: str, scale: float) -> Tuple[str, int]:
+    files = library.make_files("Huge.Collection", _scaled(50000, scale), random.Random(0))
+    root = os.path.join(workdir, "temp")
+    library.write_tree(root, files)
+    return os.path.join(root, "Huge.Collection"), len(files)
+
+
+def bench_manifest_scan(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    fakes.configure(workdir)
+    root, count = _write_huge_tree(workdir, scale)
+    return lambda: Manifest.scan(root), count
+
+
+def bench_chmod(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Post-download chmod of a huge tree, including the walk"""
+    fakes.configure(workdir, chmod_download={"file": 0o664, "folder": 0o775})
+    root, count = _write_huge_tree(workdir, scale)
+    download = DownloadObject("f" * 40, "/remote/Huge.Collection", 0, True, os.path.dirname(root), "/final", False, False)
+    return lambda: download._chmod_if_necessary(download.get_temp_path()), count
+
+
+def bench_extract_zip(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Extraction of many small zips, through the shared extraction pool"""
+    fakes.configure(workdir)
+    root = os.path.join(workdir, "temp", "Zipped.Release")
+    count = _scaled(20, scale)
+    for i in range(count):
+        os.makedirs(os.path.join(root, f"disc{i}"))
+        with zipfile.ZipFile(os.path.join(root, f"disc{i}", f"disc{i}.zip"), "w") as archive:
+            for j in range(50):
+                archive.writestr(f"track{j:02d}.flac", os.urandom(4096))
+    download = DownloadObject("f" * 40, "/remote/Zipped.Release", 0, True, os.path.join(workdir, "temp"), "/final", True, True)
+    return lambda: download._extract_if_necessary(download.get_temp_path()), count
+
+
+def bench_rar_sets(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Archive classification and multipart rar set detection over many volumes"""
+    fakes.configure(workdir)
+    paths: List[str] = []
+    schemes = ("part", "digit", "old")
+    for i in range(_scaled(500, scale)):
+        paths.extend(path.split("/", 1)[1] for path, _ in library.make_rar_set(f"Release.{i:04d}", 30, 50 << 20, schemes[i % len(schemes)]))
+
+    def run() -> None:
+        for path in paths:
+            classify_archive(path)
+        rar_stream.find_volume_sets(paths)
+
+    return run, len(paths)
+
+
+def _remote_release(workdir: str, scale: float) -> DownloadObject:
+    files = library.make_files("Remote.Release", _scaled(500, scale), random.Random(0))
+    remote_root = os.path.join(workdir, "remote")
+    library.write_tree(remote_root, files, 64 << 10)
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    state.add_watching_torrent(
+        "f" * 40, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], "Remote.Release", watch_dir=watch_dir["directory"]
+    )
+    return DownloadObject(
+        "f" * 40,
+        os.path.join(remote_root, "Remote.Release"),
+        0,
+        True,
+        watch_dir["temp_download_dir"],
+        watch_dir["final_download_dir"],
+        False,
+        False,
+        watch_dir["directory"],
+        [(path.split("/", 1)[1], 64 << 10) for path, _ in files],
+    )
+
+
+def bench_transfer(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Transfer of a many-file release with the local transfer engine"""
+    fakes.configure(workdir)
+    download = _remote_release(workdir, scale)
+    return download.transfer, len(download.files)
+
+
+def bench_post_process(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """chmod and move of a transferred many-file release"""
+    fakes.configure(workdir, chmod_download={"file": 0o664, "folder": 0o775})
+    download = _remote_release(workdir, scale)
+    download.transfer()
+    return download.post_process, len(download.files)
+
+
+def bench_resume(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Restart after a many-file release was transferred and chmod-ed but not moved, which should only need the move"""
+    fakes.configure(workdir, chmod_download={"file": 0o664, "folder": 0o775})
+    download = _remote_release(workdir, scale)
+    download.transfer()
+    download._chmod_if_necessary(download.get_temp_path())
+    download._checkpoint("chmodded")
+    # Reopened like after a restart, with a new object from the next poll
+    state.close()
+    resumed = DownloadObject(
+        download.infohash,
+        download.remote_path,
+        download.timestamp,
+        download.directory,
+        download.temp_download_dir,
+        download.final_download_dir,
+        download.auto_extract,
+        download.auto_delete_extracted,
+        download.watch_dir,
+        download.files,
+    )
+
+    def run() -> None:
+        transfer_batch([resumed])
+        resumed.post_process()
+
+    return run, len(download.files)
+
+
+def bench_verify(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Piece verification of a transferred release, with a few corrupted pieces which are refetched, then its move"""
+    fakes.configure(workdir)
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    watch_dir["verify_pieces"] = True
+    files = [(f"Verify.Release/file{i:03d}.mkv", 4 << 20) for i in range(_scaled(64, scale))]
+    remote_root = os.path.join(workdir, "remote")
+    library.write_tree(remote_root, files, 4 << 20)
+    infohash = "d" * 40
+    state.add_watching_torrent(
+        infohash, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], "Verify.Release", watch_dir=watch_dir["directory"]
+    )
+    state.save_metainfo(infohash, metainfo.info_from_torrent(library.make_metainfo("Verify.Release", files, remote_root)))
+    local_root = os.path.join(watch_dir["temp_download_dir"], "Verify.Release")
+    shutil.copytree(os.path.join(remote_root, "Verify.Release"), local_root)
+    for path, _ in files[::16]:
+        with open(os.path.join(watch_dir["temp_download_dir"], path), "r+b") as f:
+            f.seek(1 << 20)
+            f.write(b"corrupt")
+    download = DownloadObject(
+        infohash,
+        os.path.join(remote_root, "Verify.Release"),
+        0,
+        True,
+        watch_dir["temp_download_dir"],
+        watch_dir["final_download_dir"],
+        False,
+        False,
+        watch_dir["directory"],
+        [(path.split("/", 1)[1], size) for path, size in files],
+    )
+    return download.post_process, len(files)
+
+
+def bench_root_files(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Scheduled transfer, post-process, and state update of a torrent made of many small files at its root"""
+    fakes.configure(workdir)
+    count = _scaled(300, scale)
+    remote_root = os.path.join(workdir, "remote")
+    library.write_tree(remote_root, [(f"file{i:04d}.flac", 0) for i in range(count)], 64 << 10)
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    infohash = "e" * 40
+    state.add_watching_torrent(
+        infohash, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], "Root.Files", watch_dir=watch_dir["directory"]
+    )
+    objs = [
+        DownloadObject(
+            infohash,
+            os.path.join(remote_root, f"file{i:04d}.flac"),
+            0,
+            False,
+            watch_dir["temp_download_dir"],
+            watch_dir["final_download_dir"],
+            False,
+            False,
+            watch_dir["directory"],
+            [(f"file{i:04d}.flac", 64 << 10)],
+        )
+        for i in range(count)
+    ]
+    download_scheduler = scheduler.DownloadScheduler(4, 32)
+    download_scheduler.start()
+
+    def run() -> None:
+        download_scheduler.submit(objs)
+        # The torrent stops being watched once every one of its files is done
+        while infohash in state.get_watching_torrents():
+            time.sleep(0.001)
+
+    return run, count
+
+
+def bench_disk_admission(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Scheduled transfers of small downloads queued behind downloads which can never fit on disk, which must wait rather than fail"""
+    fakes.configure(workdir)
+    count = _scaled(300, scale)
+    remote_root = os.path.join(workdir, "remote")
+    library.write_tree(remote_root, [(f"file{i:04d}.flac", 0) for i in range(count)], 64 << 10)
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    too_large = diskspace.free_bytes(watch_dir["temp_download_dir"]) + (1 << 40)
+    infohash = "f" * 40
+    state.add_watching_torrent(infohash, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], "Fits", watch_dir=watch_dir["directory"])
+    objs = []
+    for i in range(count):
+        if i % 10 == 0:
+            # Directories aren't batched, so each one is admitted (or not) on its own
+            name = f"Too.Large.{i:04d}"
+            objs.append(
+                DownloadObject(
+                    "0" * 40,
+                    os.path.join(remote_root, name),
+                    0,
+                    True,
+                    watch_dir["temp_download_dir"],
+                    watch_dir["final_download_dir"],
+                    False,
+                    False,
+                    watch_dir["directory"],
+                    [(f"{name}.mkv", too_large)],
+                )
+            )
+        objs.append(
+            DownloadObject(
+                infohash,
+                os.path.join(remote_root, f"file{i:04d}.flac"),
+                0,
+                False,
+                watch_dir["temp_download_dir"],
+                watch_dir["final_download_dir"],
+                False,
+                False,
+                watch_dir["directory"],
+                [(f"file{i:04d}.flac", 64 << 10)],
+            )
+        )
+    download_scheduler = scheduler.DownloadScheduler(4, 32)
+    download_scheduler.start()
+
+    def run() -> None:
+        download_scheduler.submit(objs)
+        while infohash in state.get_watching_torrents():
+            time.sleep(0.001)
+
+    return run, count
+
+
+def bench_early_transfer(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Completion of a many-file release whose other files were transferred while it was incomplete, which should only fetch the rest"""
+    fakes.configure(workdir)
+    config.get_torrent_watch_dirs()[0]["early_transfer"] = True
+    name = "Early.Release"
+    files = [(path, 64 << 10) for path, _ in library.make_files(name, _scaled(500, scale), random.Random(0))]
+    remote_root = os.path.join(workdir, "remote")
+    library.write_tree(remote_root, files, 64 << 10)
+    infohash = "f" * 40
+    torrent = library.SyntheticTorrent(1, infohash, name, files, remote_root, 0)
+    # Every file but the last tenth completed before the torrent did
+    torrent.completed_files = {path for path, _ in files[: len(files) * 9 // 10]}
+    _watch_library(workdir, {infohash: torrent})
+    client = fakes.install_deluge(fakes.FakeDelugeClient({infohash: torrent}))
+    download_scheduler = scheduler.DownloadScheduler(4, 32)
+    download_scheduler.start()
+    watching = state.get_watching_torrents()
+    download_scheduler.submit(client.get_download_objects_for_watching_torrents(watching))
+    while len(state.get_checkpoints(infohash)) < len(torrent.completed_files):
+        time.sleep(0.001)
+
+    def run() -> None:
+        torrent.completed_time = 1700000000
+        download_scheduler.submit(client.get_download_objects_for_watching_torrents(watching))
+        while infohash in state.get_watching_torrents():
+            time.sleep(0.001)
+
+    return run, len(files) - len(torrent.completed_files)
+
+
+def bench_fair_share(workdir: str, scale: float) -> Tuple[Callable[[], Any], int]:
+    """Scheduling a queue where one watch dir has a backlog of huge downloads and three others small ones, smallest first"""
+    fakes.configure(workdir)
+    watch_dir = config.get_torrent_watch_dirs()[0]
+    rng = random.Random(0)
+    objs = []
+    for i in range(_scaled(10000, scale)):
+        backlog = i % 2 == 0
+        name = f"Queued.{i:06d}"
+        objs.append(
+            DownloadObject(
+                f"{i:040x}",
+                f"/remote/downloads/{name}",
+                0,
+                True,
+                watch_dir["temp_download_dir"],
+                watch_dir["final_download_dir"],
+                False,
+                False,
+                "backlog" if backlog else f"small{i % 3}",
+                [(f"{name}.mkv", rng.randint(1 << 30, 1 << 33) if backlog else rng.randint(1 << 20, 1 << 28))],
+            )
+        )
+    download_scheduler = scheduler.DownloadScheduler(1, 0, {}, 1, 0, {}, {"small0": 2, "small1": 1, "small2": 1}, "sjf")
+
+    def run() -> None:
+        download_scheduler.submit(objs)
+        with download_scheduler._cond:
+            # Started one after another without transferring anything, so only the ordering is measured
+            runnable = download_scheduler._take_next_runnable()
+            while runnable is not None:
+                for obj in runnable[0]:
+                    download_scheduler._release_space(obj)
+                runnable = download_scheduler._take_next_runnable()
+
+    return run, len(objs)
+
+
+BENCHMARKS: Dict[str, BenchmarkSetup] = {
+    "state_add": bench_state_add,
+    "state_add_batch": bench_state_add_batch,
+    "state_read": bench_state_read,
+    "state_reopen": bench_state_reopen,
+    "ingest": bench_ingest,
+    "deluge_poll_cold": bench_deluge_poll_cold,
+    "deluge_poll_warm": bench_deluge_poll_warm,
+    "deluge_filter_huge": bench_deluge_filter_huge,
+    "deluge_events": bench_deluge_events,
+    "deluge_poll_scheduled": bench_deluge_poll_scheduled,
+    "transmission_poll_cold": bench_transmission_poll_cold,
+    "transmission_poll_warm": bench_transmission_poll_warm,
+    "transmission_filter_huge": bench_transmission_filter_huge,
+    "manifest_scan": bench_manifest_scan,
+    "chmod": bench_chmod,
+    "extract_zip": bench_extract_zip,
+    "rar_sets": bench_rar_sets,
+    "transfer": bench_transfer,
+    "post_process": bench_post_process,
+    "root_files": bench_root_files,
+    "verify": bench_verify,
+    "disk_admission": bench_disk_admission,
+    "resume": bench_resume,
+    "early_transfer": bench_early_transfer,
+    "fair_share": bench_fair_share,
+}
+
+
+@contextlib.contextmanager
+def _quiet_stdout() -> Iterator[None]:
+    """Silence stdout at the file descriptor level, so output of subprocesses (i.e. unzip) doesn't get mixed into the report"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def _run_once(setup: BenchmarkSetup, scale: float, measure_memory: bool) -> Tuple[float, int, int]:
+    """Returns (seconds, items, peak bytes allocated (0 if not measured))"""
+    workdir = tempfile.mkdtemp(prefix="rtd-bench-")
+    try:
+        with _quiet_stdout():
+            run, items = setup(workdir, scale)
+            if measure_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            peak = 0
+            if measure_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        return elapsed, items, peak
+    finally:
+        state.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmarks(names: List[str], scale: float, repeat: int, measure_memory: bool) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name in names:
+        # Best of repeat runs for timing; memory is measured in a separate run, since tracing slows everything down
+        seconds = min(_run_once(BENCHMARKS[name], scale, False)[0] for _ in range(repeat))
+        _, items, peak = _run_once(BENCHMARKS[name], scale, True) if measure_memory else (0.0, _run_once(BENCHMARKS[name], scale, False)[1], 0)
+        results[name] = {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds else 0.0, "peak_memory_bytes": peak}
+        print(f"{name:<28} {seconds:>10.4f}s {items:>9} items {results[name]['items_per_second']:>14.0f}/s {peak / (1 << 20):>10.2f} MiB", flush=True)
+    return results
+
+
+def _compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], max_regression: float) -> List[str]:
+    regressions: List[str] = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous or previous.get("items") != result["items"]:
+            continue
+        for key in ("seconds", "peak_memory_bytes"):
+            if previous.get(key) and result[key] > previous[key] * max_regression:
+                regressions.append(f"{name} {key}: {previous[key]:.4g} -> {result[key]:.4g}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the downloader hot paths, using fake torrent clients and local transfers")
+    parser.add_argument("benchmarks", nargs="*", choices=[[], *BENCHMARKS], help="benchmarks to run (default all)")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplier for the size of the synthetic libraries (default 1.0, i.e. 10k watched torrents)"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="number of timed runs of each benchmark; the fastest is reported (default 1)")
+    parser.add_argument("--no-memory", action="store_true", help="skip measuring peak memory with tracemalloc")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results json of a previous run to compare against")
+    parser.add_argument(
+        "--max-regression", type=float, default=1.5, help="fail if any result is this many times worse than the baseline (default 1.5)"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+
+    results = run_benchmarks(args.benchmarks or list(BENCHMARKS), args.scale, max(1, args.repeat), not args.no_memory)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions compared to baseline:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
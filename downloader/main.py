@@ -1,25 +1,49 @@
+from typing import Callable, List, Tuple, Dict, Any, Optional
 import os
 import time
 import pathlib
 import logging
+import threading
 
 from downloader.state import state
 from downloader.state import config
-
-# Conditionally import our torrent client based on the config type
-_torrent_client_type = config.get_torrent_client_type()
-if _torrent_client_type == "deluge":
-    from downloader.torrent_clients import deluge as torrent_client
-elif _torrent_client_type == "transmission":
-    from downloader.torrent_clients import transmission as torrent_client  # type: ignore
-else:
-    raise NotImplementedError(f"Torrent client type {_torrent_client_type} not implemented")
+from downloader.model import metainfo
+from downloader.pipeline import scheduler
+from downloader.pipeline import watcher
+from downloader.pipeline import mover
+from downloader.pipeline import seedboxes
+from downloader.pipeline import polling
+from downloader.metrics import metrics
+from downloader.metrics import server as metrics_server
 
 log = logging.getLogger("main")
 
+# A file next to a torrent file, named after it with this suffix, gives the torrent a priority of its own (its contents, or 1 if empty)
+_PRIORITY_SUFFIX = ".priority"
+
+# Plans when each torrent is polled, when polling isn't only a safety net for completion events
+_poll_schedule: Optional[polling.PollSchedule] = None
+
+
+def _read_priority(file_path: pathlib.Path) -> Optional[int]:
+    priority_path = pathlib.Path(str(file_path) + _PRIORITY_SUFFIX)
+    try:
+        contents = priority_path.read_text().strip()
+    except FileNotFoundError:
+        return None
+    try:
+        return int(contents) if contents else 1
+    except ValueError:
+        log.warning(f"Ignoring {priority_path}, which should contain an integer priority")
+        return None
 
-def main() -> None:
+
+def ingest_watch_dirs(new_files: Optional[Dict[str, List[str]]] = None) -> None:
+    """Add torrent files from the watch directories to the torrent clients (placing each on a seedbox), and start watching them.
+    If new_files (watch directory to file names) is provided, only those files are checked, otherwise the watch directories are fully scanned
+    """
     log.debug("Checking for torrents in watch directories")
+    candidates: List[Tuple[Dict[str, Any], pathlib.Path]] = []
     for watch_dir in config.get_torrent_watch_dirs():
         final_dir = pathlib.Path(watch_dir["final_download_dir"])
         if not final_dir.is_dir() or not final_dir.is_absolute():
@@ -30,38 +54,178 @@ def main() -> None:
         dir_path = pathlib.Path(watch_dir["directory"])
         if not dir_path.is_dir() or not dir_path.is_absolute():
             raise Exception("provided watch directory is either not absolute or does not exist")
-        auto_extract = watch_dir.get("attempt_extract", False)
-        auto_delete_extracted = watch_dir.get("auto_delete_extracted", False)
-
-        for f in os.listdir(dir_path):
-            file_path = pathlib.Path(dir_path, f)
-            if file_path.is_file():
-                log.info(f"Adding {file_path} to torrent client")
-                # Add torrent file to remote torrent daemon
-                infohash = torrent_client.add_torrent_by_file(str(file_path))
-                # Add torrent to persistent state for watching
-                ext = f.rfind(".")
-                state.add_watching_torrent(infohash, str(temp_dir), str(final_dir), f[:ext] if ext > 0 else f, auto_extract, auto_delete_extracted)
-                # Remove the processed torrent file
-                os.remove(file_path)
-
-    # Get currently watching torrents and try to download them if ready
-    watching_torrents = state.get_watching_torrents()
-    log.debug("Checking torrent client for completed torrents that should be downloaded")
-    for obj in torrent_client.get_download_objects_for_watching_torrents(watching_torrents):
+
+        if new_files is None:
+            with os.scandir(dir_path) as entries:
+                candidates.extend(
+                    (watch_dir, pathlib.Path(entry.path)) for entry in entries if entry.is_file() and not entry.name.endswith(_PRIORITY_SUFFIX)
+                )
+        else:
+            file_paths = [pathlib.Path(dir_path, f) for f in new_files.get(watch_dir["directory"], []) if not f.endswith(_PRIORITY_SUFFIX)]
+            candidates.extend((watch_dir, path) for path in file_paths if path.is_file())
+    if not candidates:
+        return
+
+    log.info(f"Adding {len(candidates)} torrent file(s) to torrent client")
+    with metrics.time_stage("ingest"):
+        # Add torrent files to remote torrent daemons (files which fail are left in place to be retried)
+        placed = seedboxes.add_torrents_by_files([str(file_path) for _, file_path in candidates], state.get_watching_torrents())
+        added = [(watch_dir, file_path, *placed[str(file_path)]) for watch_dir, file_path in candidates if str(file_path) in placed]
+        # Add torrents to persistent state for watching in a single commit
+        with state.batch():
+            for watch_dir, file_path, infohash, seedbox in added:
+                state.add_watching_torrent(
+                    infohash,
+                    watch_dir["temp_download_dir"],
+                    watch_dir["final_download_dir"],
+                    file_path.stem if file_path.suffix else file_path.name,
+                    watch_dir.get("attempt_extract", False),
+                    watch_dir.get("auto_delete_extracted", False),
+                    watch_dir["directory"],
+                    seedbox,
+                    _read_priority(file_path),
+                )
+                if watch_dir.get("verify_pieces", False):
+                    # Neither torrent client hands out piece hashes, so keep them from the torrent file for verifying the download later
+                    info = metainfo.read_info(str(file_path))
+                    if info is not None:
+                        state.save_metainfo(infohash, info)
+                metrics.record_event(infohash, "added")
+    # Torrents which were already complete when added never produce a completion event, so check those seedboxes now
+    seedboxes.check_added({infohash: seedbox for _, _, infohash, seedbox in added})
+    if _poll_schedule is not None and added:
+        _poll_schedule.check_soon(infohash for _, _, infohash, _ in added)
+    # Remove the processed torrent files
+    for _, file_path, _, _ in added:
+        os.remove(file_path)
+        pathlib.Path(str(file_path) + _PRIORITY_SUFFIX).unlink(missing_ok=True)
+
+
+def _run_inotify_ingest_forever(rescan_interval: float) -> None:
+    """Ingest torrent files as soon as they are closed after writing (or moved into) a watch directory.
+    While the watch directories can't be watched (i.e. one doesn't exist, or the inotify limits were reached), they are scanned every
+    watch interval instead, trying to watch them again each time
+    """
+    directories = [watch_dir["directory"] for watch_dir in config.get_torrent_watch_dirs()]
+    inotify_watcher: Optional[watcher.InotifyWatcher] = None
+    watch_error = ""
+    full_scan = True
+    while True:
         try:
-            obj.download()
+            if inotify_watcher is None:
+                try:
+                    inotify_watcher = watcher.InotifyWatcher(directories)
+                except OSError as e:
+                    if str(e) != watch_error:
+                        log.error(
+                            f"Could not watch the watch directories with inotify ({e}), scanning them every {config.get_watch_interval()}s instead"
+                        )
+                        watch_error = str(e)
+                    ingest_watch_dirs()
+                    time.sleep(config.get_watch_interval())
+                    continue
+                if watch_error:
+                    log.info("Watching the watch directories with inotify again")
+                    watch_error = ""
+                full_scan = True
+            if full_scan:
+                # Pick up anything which arrived before the watcher was started, or any events which were missed
+                ingest_watch_dirs()
+                full_scan = False
+            new_files = inotify_watcher.wait_for_batch(rescan_interval)
+            if new_files is None:
+                full_scan = True
+            else:
+                ingest_watch_dirs(new_files)
+        except watcher.WatchDirOverflow:
+            log.warning("inotify event queue overflowed, rescanning watch directories")
+            full_scan = True
+        except watcher.WatchDirLost as e:
+            log.warning(f"Watch directory {e} was deleted or moved, watching it again once it exists")
+            if inotify_watcher is not None:
+                inotify_watcher.close()
+                inotify_watcher = None
         except Exception:
-            log.exception(f"Error: Failure to download {obj.remote_path}")
+            log.exception("Unexpected exception in ingest stage")
+            full_scan = True
+            time.sleep(config.get_watch_interval())
 
-    log.debug("Completed main loop")
 
+def queue_completed_torrents(download_scheduler: scheduler.DownloadScheduler, poll_schedule: Optional[polling.PollSchedule] = None) -> None:
+    """Check the torrent clients of every seedbox for completed watching torrents and queue them for download.
+    With a poll schedule, only the torrents which are due are checked, and their next checks are planned from their ETAs
+    """
+    watching_torrents = state.get_watching_torrents()
+    if poll_schedule is None:
+        log.debug("Checking torrent clients for completed torrents that should be downloaded")
+        with metrics.time_stage("poll"):
+            completed = seedboxes.get_download_objects_for_watching_torrents(watching_torrents)
+    else:
+        now = time.monotonic()
+        due = poll_schedule.due(watching_torrents, now)
+        if not due:
+            return
+        log.debug(f"Checking {len(due)} of {len(watching_torrents)} watched torrents for completion")
+        etas: Dict[str, float] = {}
+        with metrics.time_stage("poll"):
+            completed = seedboxes.get_download_objects_for_watching_torrents(watching_torrents, due, etas)
+        poll_schedule.plan(watching_torrents, due, etas, now)
+    queued = download_scheduler.submit(completed)
+    if queued:
+        log.info(f"Queued {queued} new completed download(s)")
 
-if __name__ == "__main__":
-    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+def _run_stage_forever(name: str, stage: Callable[[], None], interval: float) -> None:
+    while True:
+        try:
+            stage()
+        except Exception:
+            log.exception(f"Unexpected exception in {name} stage")
+        time.sleep(interval)
+
+
+def _run_poll_forever(download_scheduler: scheduler.DownloadScheduler, poll_schedule: polling.PollSchedule) -> None:
     while True:
         try:
-            main()
-            time.sleep(15)
+            queue_completed_torrents(download_scheduler, poll_schedule)
+            timeout = poll_schedule.seconds_until_next(time.monotonic())
         except Exception:
-            log.exception("Unexpected exception in main")
+            log.exception("Unexpected exception in poll stage")
+            timeout = config.get_poll_interval()
+        poll_schedule.wait(timeout)
+
+
+def _start_stage(name: str, stage: Callable[[], None], interval: float) -> threading.Thread:
+    thread = threading.Thread(target=_run_stage_forever, args=(name, stage, interval), name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+    # Ingestion, completion polling, and transfers all run independently so a long transfer never delays new torrents
+    metrics_config = config.get_metrics_config()
+    if metrics_config:
+        metrics_server.start(metrics_config.get("bind", "127.0.0.1"), metrics_config["port"])
+    mover.probe_watch_dirs()
+    download_scheduler = scheduler.create_from_config()
+    download_scheduler.start()
+    # When every torrent client pushes completions, polling is only a safety net (i.e. for events missed during a reconnect)
+    if seedboxes.start_completion_events(download_scheduler.submit):
+        reconcile_interval = max(config.get_poll_interval(), config.get_reconcile_interval())
+        log.info(f"Listening for completed torrents, polling every {reconcile_interval}s to reconcile")
+        poll_thread = _start_stage("poll", lambda: queue_completed_torrents(download_scheduler), reconcile_interval)
+    else:
+        _poll_schedule = polling.PollSchedule(config.get_poll_interval(), config.get_poll_min_interval(), config.get_poll_max_interval())
+        poll_thread = threading.Thread(target=_run_poll_forever, args=(download_scheduler, _poll_schedule), name="poll", daemon=True)
+        poll_thread.start()
+    watch_mode = config.get_watch_mode()
+    if watch_mode == "inotify" or (watch_mode == "auto" and watcher.is_available()):
+        log.info("Watching for new torrent files with inotify")
+        ingest_thread = threading.Thread(target=_run_inotify_ingest_forever, args=(config.get_watch_rescan_interval(),), name="ingest", daemon=True)
+        ingest_thread.start()
+    else:
+        ingest_thread = _start_stage("ingest", ingest_watch_dirs, config.get_watch_interval())
+    stages = [ingest_thread, poll_thread]
+    for stage_thread in stages:
+        stage_thread.join()
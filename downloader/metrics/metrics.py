@@ -0,0 +1,161 @@
+from typing import Dict, Callable, ContextManager, Iterator, Sequence, Optional
+import time
+import threading
+import contextlib
+from collections import OrderedDict
+
+from downloader.metrics.registry import Registry, Counter, Histogram, CallbackMetric, LabelValues
+
+# Every instrumentation function returns immediately unless the metrics endpoint is enabled, so it costs nothing when disabled
+_enabled = False
+_null_context: ContextManager[None] = contextlib.nullcontext()
+
+registry = Registry()
+
+_stage_seconds = Histogram(
+    "rtd_stage_duration_seconds",
+    "Time spent in each pipeline stage",
+    (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600),
+    ("stage",),
+)
+_stage_errors = Counter("rtd_stage_errors_total", "Number of failures in each pipeline stage", ("stage",))
+_rpc_seconds = Histogram(
+    "rtd_rpc_duration_seconds",
+    "Latency of torrent client rpc calls",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    ("client", "method"),
+)
+_rpc_errors = Counter("rtd_rpc_errors_total", "Number of failed torrent client rpc calls", ("client", "method"))
+_transfer_bytes = Counter("rtd_transfer_bytes_total", "Bytes transferred from the seedbox", ("watch_dir",))
+_transfer_throughput = Histogram(
+    "rtd_transfer_throughput_bytes_per_second",
+    "Average throughput of each transfer",
+    (1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9),
+    ("watch_dir",),
+)
+_availability_delay = Histogram(
+    "rtd_completion_to_local_seconds",
+    "Time between a torrent completing on the seedbox and it being available in the final download dir",
+    (5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600),
+    ("watch_dir",),
+)
+_queue_wait = Histogram(
+    "rtd_queue_wait_seconds",
+    "Time downloads spent queued before their transfer started, per watch dir and priority",
+    (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400),
+    ("watch_dir", "priority"),
+)
+_pieces_verified = Counter("rtd_pieces_verified_total", "Pieces of downloaded data checked against their piece hash", ("watch_dir",))
+_pieces_repaired = Counter("rtd_pieces_repaired_total", "Pieces which failed verification and were refetched", ("watch_dir",))
+for _metric in (
+    _stage_seconds,
+    _stage_errors,
+    _rpc_seconds,
+    _rpc_errors,
+    _transfer_bytes,
+    _transfer_throughput,
+    _availability_delay,
+    _queue_wait,
+    _pieces_verified,
+    _pieces_repaired,
+):
+    registry.register(_metric)
+
+# Timeline events which keep the time they first happened (an infohash can have several download objects), rather than the latest
+_FIRST_EVENTS = {"added", "completed", "queued", "transfer_started"}
+_MAX_TIMELINES = 1000
+_timelines: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+_timelines_lock = threading.Lock()
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+@contextlib.contextmanager
+def _time(histogram: Histogram, errors: Counter, label_values: LabelValues) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        errors.inc(label_values)
+        raise
+    finally:
+        histogram.observe(time.monotonic() - start, label_values)
+
+
+def time_stage(stage: str) -> ContextManager[None]:
+    """Time a pipeline stage (i.e. poll, transfer, extract), counting it as an error if it raises"""
+    if not _enabled:
+        return _null_context
+    return _time(_stage_seconds, _stage_errors, (stage,))
+
+
+def time_rpc(client: str, method: str) -> ContextManager[None]:
+    """Time a torrent client rpc call, counting it as an error if it raises"""
+    if not _enabled:
+        return _null_context
+    return _time(_rpc_seconds, _rpc_errors, (client, method))
+
+
+def observe_transfer(watch_dir: str, num_bytes: int, seconds: float) -> None:
+    if not _enabled:
+        return
+    _transfer_bytes.inc((watch_dir,), num_bytes)
+    if seconds > 0 and num_bytes > 0:
+        _transfer_throughput.observe(num_bytes / seconds, (watch_dir,))
+
+
+def observe_verification(watch_dir: str, pieces_verified: int, pieces_repaired: int) -> None:
+    if not _enabled:
+        return
+    _pieces_verified.inc((watch_dir,), pieces_verified)
+    _pieces_repaired.inc((watch_dir,), pieces_repaired)
+
+
+def observe_availability(watch_dir: str, completed_timestamp: float) -> None:
+    """Record how long it took for a torrent which completed at completed_timestamp (unix time) to be available locally"""
+    if not _enabled or completed_timestamp <= 0:
+        return
+    _availability_delay.observe(max(0.0, time.time() - completed_timestamp), (watch_dir,))
+
+
+def observe_queue_wait(watch_dir: str, priority: int, seconds: float) -> None:
+    if not _enabled:
+        return
+    _queue_wait.observe(seconds, (watch_dir, str(priority)))
+
+
+def record_event(infohash: str, event: str, timestamp: Optional[float] = None) -> None:
+    """Add a stage timestamp (unix time, defaults to now) to the timeline of a torrent"""
+    if not _enabled:
+        return
+    timestamp = time.time() if timestamp is None else timestamp
+    with _timelines_lock:
+        timeline = _timelines.get(infohash)
+        if timeline is None:
+            timeline = _timelines[infohash] = {}
+            # Only keep the most recent torrents
+            while len(_timelines) > _MAX_TIMELINES:
+                _timelines.popitem(last=False)
+        if event in _FIRST_EVENTS:
+            timeline.setdefault(event, timestamp)
+        else:
+            timeline[event] = timestamp
+
+
+def get_timelines() -> Dict[str, Dict[str, float]]:
+    with _timelines_lock:
+        return {infohash: dict(timeline) for infohash, timeline in _timelines.items()}
+
+
+def register_callback(
+    name: str, help_text: str, metric_type: str, label_names: Sequence[str], collect: Callable[[], Dict[LabelValues, float]]
+) -> None:
+    """Register a gauge or counter whose values are read from collect when scraped"""
+    registry.register(CallbackMetric(name, help_text, metric_type, label_names, collect))
@@ -0,0 +1,51 @@
+from typing import Any
+import json
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from downloader.metrics import metrics
+from downloader.transfer import tuning
+
+log = logging.getLogger("metrics")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _respond(self, status: int, content_type: str, body: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/metrics":
+            self._respond(200, "text/plain; version=0.0.4; charset=utf-8", metrics.registry.expose())
+        elif path == "/timeline":
+            self._respond(200, "application/json", json.dumps(metrics.get_timelines()))
+        elif path.startswith("/timeline/"):
+            timeline = metrics.get_timelines().get(path[len("/timeline/") :].lower())
+            if timeline is None:
+                self._respond(404, "application/json", json.dumps({"error": "unknown infohash"}))
+            else:
+                self._respond(200, "application/json", json.dumps(timeline))
+        elif path == "/transfers":
+            self._respond(200, "application/json", json.dumps(tuning.get_history()))
+        else:
+            self._respond(404, "text/plain; charset=utf-8", "not found\n")
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        log.debug(f"{self.address_string()} {fmt % args}")
+
+
+def start(bind: str, port: int) -> ThreadingHTTPServer:
+    """Enable instrumentation and serve /metrics (prometheus format) /timeline (per-infohash stage timestamps as json),
+    and /transfers (connection counts chosen for recent transfers and the rates they achieved, as json) in the background"""
+    metrics.enable()
+    server = ThreadingHTTPServer((bind, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on http://{bind}:{port}/metrics")
+    return server
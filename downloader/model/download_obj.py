@@ -1,20 +1,51 @@
-from typing import List
-import re
+from typing import List, Dict, Tuple, Set, Any, Optional
 import os
-import sys
+import time
 import pathlib
-import shutil
-import subprocess
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
+from downloader.model.manifest import Manifest, ARCHIVE_NONE, ARCHIVE_ZIP, ARCHIVE_RAR, ARCHIVE_RAR_PART, classify_archive
+from downloader.model.metainfo import PieceLayout
 from downloader.state import config
 from downloader.state import state
+from downloader.transfer import engine as transfer_engine
+from downloader.transfer import tuning
+from downloader.pipeline import extractor
+from downloader.pipeline import rar_stream
+from downloader.pipeline import mover
+from downloader.pipeline import verifier
+from downloader.metrics import metrics
 
 log = logging.getLogger("download_obj")
 
+# Extracted files are roughly the size of their archives, since the media in them is usually stored rather than compressed
+_EXTRACTED_SIZE_RATIO = 1.0
+# Pipeline stages of a download object, in order. The last one finished is checkpointed in state, so a restart resumes after it.
+# "placed" is when the data is complete in the final download dir, but (if it was copied there) the temp copy may not be removed yet
+_STAGES = ("transferred", "verified", "extracted", "chmodded", "placed", "moved")
 
-_rar_digit_part_regex = re.compile(r"^\.\d{1,3}$")
-_rar_rdigit_part_regex = re.compile(r"^\.r\d{1,3}$")
+
+def _reached(last_stage: str, stage: str) -> bool:
+    """Whether stage was finished (or skipped over), given the last finished stage"""
+    return bool(last_stage) and _STAGES.index(last_stage) >= _STAGES.index(stage)
+
+
+class _ProgressLogger(object):
+    """Progress callback for transfer engines which periodically logs the progress of a download"""
+
+    def __init__(self, remote_path: str, interval: float = 30):
+        self.remote_path = remote_path
+        self.interval = interval
+        self._last_log = time.monotonic()
+        self._file_progress: Dict[str, int] = {}
+
+    def __call__(self, local_path: str, transferred: int, total: int) -> None:
+        self._file_progress[local_path] = transferred
+        now = time.monotonic()
+        if now - self._last_log >= self.interval:
+            self._last_log = now
+            log.info(f"Downloading {self.remote_path}: {sum(self._file_progress.values()) / (1 << 20):.1f} MiB transferred")
 
 
 def _get_unzip_cmd(zip_path: str, extract_dir: str) -> List[str]:
@@ -25,6 +56,14 @@ def _get_unrar_cmd(rar_path: str, extract_dir: str) -> List[str]:
     return ["unrar", "x", "-o+", "-y", rar_path, extract_dir]
 
 
+def _get_unzip_list_cmd(zip_path: str) -> List[str]:
+    return ["unzip", "-Z1", zip_path]
+
+
+def _get_unrar_list_cmd(rar_path: str) -> List[str]:
+    return ["unrar", "lb", rar_path]
+
+
 class DownloadObject(object):
     infohash: str
     remote_path: str
@@ -34,6 +73,11 @@ class DownloadObject(object):
     final_download_dir: str
     auto_extract: bool
     auto_delete_extracted: bool
+    watch_dir: str
+    files: List[Tuple[str, int]]
+    seedbox: str
+    partial: bool
+    part_of: str
 
     def __init__(
         self,
@@ -45,6 +89,11 @@ class DownloadObject(object):
         final_download_dir: str,
         auto_extract: bool,
         auto_delete_extracted: bool,
+        watch_dir: str = "",
+        files: Optional[List[Tuple[str, int]]] = None,
+        seedbox: str = "",
+        partial: bool = False,
+        part_of: str = "",
     ):
         self.infohash = infohash
         self.remote_path = remote_path
@@ -54,86 +103,390 @@ class DownloadObject(object):
         self.final_download_dir = final_download_dir
         self.auto_extract = auto_extract
         self.auto_delete_extracted = auto_delete_extracted
+        self.watch_dir = watch_dir
+        # (path relative to remote_path, size) of every file in this object, if known. For a single file, the path is its name
+        self.files = files or []
+        # Name of the seedbox the torrent is on ("" for the first configured seedbox)
+        self.seedbox = seedbox
+        # A file which is complete on the seedbox while the rest of its torrent isn't, so it is only transferred (see early_transfer).
+        # For a file within a directory of the torrent, part_of is the remote path of that directory
+        self.partial = partial
+        self.part_of = part_of
+        # Files of this (directory) object which were already transferred as partial objects, loaded when first needed
+        self._early_transferred: Optional[Set[str]] = None
+        # Paths of the first volumes of rar sets which were already extracted while streaming
+        self._stream_extracted: Set[str] = set()
+        # What was checkpointed about this object (loaded when first needed), and the last stage it finished
+        self._checkpoint_data: Optional[Dict[str, Any]] = None
+        self._last_stage = ""
+
+    def connections_needed(self) -> int:
+        """Get the maximum number of simultaneous sftp connections this download will open"""
+        return tuning.connection_ceiling(self.files, self.directory, config.get_sftp_options(self.seedbox))
+
+    def space_needed(self) -> Dict[str, int]:
+        """Get the most bytes this download will take up in each download dir at once, including extracted files (empty if the files aren't known)"""
+        total = sum(size for _, size in self.files)
+        if not total:
+            return {}
+        if self.partial or self.is_direct_to_final():
+            # Partial objects are only transferred; the rest is accounted for when the torrent's completed objects are
+            return {self._download_dir(): total}
+        archives = 0
+        if self.auto_extract:
+            archives = sum(size for path, size in self.files if classify_archive(pathlib.PurePosixPath(path).name) != ARCHIVE_NONE)
+        extracted = int(archives * _EXTRACTED_SIZE_RATIO)
+        # The archives are only deleted after everything is extracted, so at its peak the temp dir holds both.
+        # Files which were transferred before the torrent completed are already taking up their space
+        early = self._early_transferred_files()
+        needs = {self.temp_download_dir: total + extracted - sum(size for relative_path, size in self.files if relative_path in early)}
+        try:
+            same_device = mover.is_same_device(self.temp_download_dir, self.final_download_dir)
+        except OSError:
+            same_device = False
+        if not same_device:
+            # Moving copies everything into the final dir before anything is removed from the temp dir
+            final = total - archives + extracted if self.auto_delete_extracted else total + extracted
+            needs[self.final_download_dir] = needs.get(self.final_download_dir, 0) + final
+        return needs
+
+    def is_direct_to_final(self) -> bool:
+        """Whether this object is transferred straight into the final download dir, which is only possible when there's nothing to post-process"""
+        return not self.auto_extract and not config.get_chmod_config() and config.get_torrent_watch_dir(self.watch_dir).get("direct_to_final", False)
+
+    def _early_transferred_files(self) -> Set[str]:
+        """Get the files of this directory which were already transferred as partial objects, before the torrent completed"""
+        if self._early_transferred is None:
+            self._early_transferred = set()
+            if self.directory and not self.partial and config.get_torrent_watch_dir(self.watch_dir).get("early_transfer", False):
+                checkpoints = state.get_checkpoints(self.infohash)
+                temp_path = self.get_temp_path()
+                self._early_transferred = {
+                    relative_path
+                    for relative_path, _ in self.files
+                    if checkpoints.get(str(pathlib.PurePosixPath(self.remote_path, relative_path)), {}).get("stage") == "transferred"
+                    and pathlib.Path(temp_path, relative_path).exists()
+                }
+        return self._early_transferred
+
+    def _download_dir(self) -> str:
+        return self.final_download_dir if self.is_direct_to_final() else self.temp_download_dir
+
+    def get_temp_path(self) -> pathlib.Path:
+        if self.part_of:
+            # Where the file will be within its directory once the directory is transferred
+            return pathlib.Path(self._download_dir(), pathlib.PurePosixPath(self.part_of).name, self.files[0][0])
+        return pathlib.Path(self._download_dir(), pathlib.PurePosixPath(self.remote_path).name)
+
+    @staticmethod
+    def _wrap_path(temp_path: pathlib.Path) -> pathlib.Path:
+        """Where a single file archive is while a directory of its own is created for extracting it"""
+        return pathlib.Path(str(temp_path) + ".temp")
+
+    def _undo_partial_wrap(self, temp_path: pathlib.Path) -> None:
+        """Put back a single file archive which a previous run stopped moving into a directory of its own partway through"""
+        wrap_path = self._wrap_path(temp_path)
+        if self.directory or not wrap_path.exists():
+            return
+        log.info(f"Restoring {temp_path}, which was being moved into a directory for extraction")
+        if temp_path.is_dir():
+            # Only created, so it is still empty
+            temp_path.rmdir()
+        wrap_path.rename(temp_path)
+
+    def _last_finished_stage(self) -> str:
+        """Get the last stage this object finished, restoring what a previous run recorded about it the first time this is called.
+        A checkpoint is only trusted while the data it describes is still there
+        """
+        if self._checkpoint_data is None:
+            self._checkpoint_data = state.get_checkpoint(self.infohash, self.remote_path)
+            stage = self._checkpoint_data.get("stage", "")
+            temp_path = self.get_temp_path()
+            if stage and not _reached(stage, "extracted"):
+                self._undo_partial_wrap(temp_path)
+            if stage == "chmodded" and not temp_path.exists() and self._is_placed(pathlib.Path(self.final_download_dir, temp_path.name)):
+                # Renamed into place, but the process stopped before recording it
+                stage = self._checkpoint_data["stage"] = "placed"
+            if stage and not _reached(stage, "placed") and not temp_path.exists():
+                log.warning(f"{temp_path} is missing, starting {self.remote_path} over")
+                self._checkpoint_data = {}
+            elif stage:
+                log.info(f"Resuming {self.remote_path}, which was already {stage}")
+                self._last_stage = stage
+                self.directory = self._checkpoint_data["directory"]
+                self._stream_extracted = set(self._checkpoint_data["stream_extracted"])
+        return self._last_stage
+
+    def _is_placed(self, target: pathlib.Path) -> bool:
+        """Whether target holds exactly the files (and sizes) this object was checkpointed with, rather than something else of the same name"""
+        if target.is_symlink() or not target.exists():
+            return False
+        if not target.is_dir():
+            return not self.directory and target.stat().st_size == self.files[0][1]
+        entries = (self._checkpoint_data or {}).get("manifest")
+        if entries is not None:
+            expected = {(entry.relative_path, entry.size) for entry in Manifest.from_list(str(target), entries).files()}
+        elif self.directory:
+            expected = {(os.path.normpath(path), size) for path, size in self.files}
+        else:
+            return False
+        return {(entry.relative_path, entry.size) for entry in Manifest.scan(str(target)).files()} == expected
+
+    def transferred(self) -> bool:
+        """Whether this object was already transferred (by this or a previous run)"""
+        return _reached(self._last_finished_stage(), "transferred")
 
-    def download(self) -> None:
+    def _checkpoint(self, stage: str, manifest: Optional[Manifest] = None) -> None:
+        self._checkpoint_data = {
+            "stage": stage,
+            "directory": self.directory,
+            "stream_extracted": sorted(self._stream_extracted),
+            "manifest": manifest.to_list() if manifest else None,
+        }
+        self._last_stage = stage
+        state.save_checkpoint(self.infohash, self.remote_path, self._checkpoint_data)
+
+    def _checkpointed_manifest(self, temp_path: pathlib.Path) -> Optional[Manifest]:
+        entries = (self._checkpoint_data or {}).get("manifest")
+        return Manifest.from_list(str(temp_path), entries) if entries is not None else None
+
+    def download(self, connection_limit: int = 0) -> None:
+        """Transfer, post-process, and move this object. Whoever calls this is responsible for no longer watching the torrent"""
+        self.transfer(connection_limit)
+        self.post_process()
+
+    def transfer(self, connection_limit: int = 0) -> None:
+        """Transfer this object to the temp download dir. If connection_limit is provided, at most that many connections are opened"""
+        if _reached(self._last_finished_stage(), "transferred"):
+            return
+        metrics.record_event(self.infohash, "transfer_started")
+        start = time.monotonic()
+        with metrics.time_stage("transfer"):
+            self._transfer(connection_limit)
+        metrics.observe_transfer(self.watch_dir, sum(size for _, size in self.files), time.monotonic() - start)
+        metrics.record_event(self.infohash, "transferred")
+        self._checkpoint("transferred")
+
+    def _transfer(self, connection_limit: int) -> None:
         log.info(f"Starting download for {self.remote_path}")
-        sftp_opts = config.get_sftp_options()
-        open_cmd = f"open -p {sftp_opts['port']} sftp://{sftp_opts['username']}:{sftp_opts['password']}@{sftp_opts['host']}"
-        fetch_cmd = ""
-        escaped_remote = self.remote_path.replace('"', '\\"')
-        temp_path = pathlib.Path(self.temp_download_dir, pathlib.PurePosixPath(self.remote_path).name)
-        escaped_temp = str(temp_path).replace('"', '\\"')
-        if self.directory:
-            temp_path.mkdir(parents=True, exist_ok=True)
-            fetch_cmd = (
-                f'mirror -c --parallel={sftp_opts["mirror_parallel"]} --use-pget-n={sftp_opts["mirror_conn"]} "{escaped_remote}" "{escaped_temp}"'
+        files = self.files
+        early = self._early_transferred_files()
+        if early:
+            files = [(relative_path, size) for relative_path, size in self.files if relative_path not in early]
+            if not files:
+                # The last of them may be transferred early just before the torrent is reported complete
+                log.info(f"Every file of {self.remote_path} was transferred before it completed")
+                return
+            log.info(f"{len(early)} files of {self.remote_path} were transferred before it completed, transferring the other {len(files)}")
+        # Choose connection counts for this object's files (within the configured ceilings), which are then tuned while transferring
+        plan = tuning.plan_transfer(files, self.directory, config.get_sftp_options(self.seedbox), connection_limit)
+        tuner = tuning.TransferTuner(self.remote_path, plan, self.directory, _ProgressLogger(self.remote_path))
+        engine = transfer_engine.get_engine(self.seedbox)
+        temp_path = self.get_temp_path()
+        volume_sets: List[List[str]] = []
+        if self.directory and self.auto_extract and self.files and config.get_torrent_watch_dir(self.watch_dir).get("stream_extract", False):
+            volume_sets = rar_stream.find_volume_sets([relative_path for relative_path, _ in self.files])
+        if early:
+            # Only the remaining files, so the ones already here aren't even looked at again
+            for relative_path, _ in files:
+                pathlib.Path(temp_path, relative_path).parent.mkdir(parents=True, exist_ok=True)
+            remote_path = pathlib.PurePosixPath(self.remote_path)
+            engine.fetch_files(
+                [(str(remote_path / relative_path), str(pathlib.Path(temp_path, relative_path))) for relative_path, _ in files],
+                plan.parallel_files,
+                tuner,
+                tuner,
             )
+        elif volume_sets:
+            self._transfer_streaming(engine, temp_path, volume_sets, plan, tuner)
+        elif self.directory:
+            temp_path.mkdir(parents=True, exist_ok=True)
+            engine.fetch_directory(self.remote_path, str(temp_path), plan.parallel_files, plan.connections, tuner, tuner)
         else:
-            fetch_cmd = f'pget -c -n {sftp_opts["pget_conn"]} "{escaped_remote}" -o "{escaped_temp}"'
-        # Run the lftp command, linking up its stdout/stderr with host's stdout and stderr
-        subprocess.run(["lftp", "-c", f"{open_cmd} && {fetch_cmd}"], check=True, stdout=sys.stdout, stderr=sys.stderr)
+            if self.part_of:
+                temp_path.parent.mkdir(parents=True, exist_ok=True)
+            engine.fetch_file(self.remote_path, str(temp_path), plan.connections, tuner, tuner)
+        tuner.finish()
         log.info(f"Finished downloading {self.remote_path}")
-        if self.auto_extract:
-            self._extract_if_necessary(temp_path)
-        # optional chmod stuff
-        self._chmod_if_necessary(temp_path)
-        # move final data
-        shutil.move(str(temp_path), self.final_download_dir)
-        # If completed, stop watching this torrent
-        state.remove_watching_torrent(self.infohash)
+
+    def _transfer_streaming(
+        self,
+        engine: transfer_engine.TransferEngine,
+        temp_path: pathlib.Path,
+        volume_sets: List[List[str]],
+        plan: tuning.TransferPlan,
+        progress: transfer_engine.ProgressCallback,
+    ) -> None:
+        """Transfer rar volumes one at a time and in order, extracting each set while later volumes are still being transferred.
+        The remaining files are transferred afterwards
+        """
+        sizes = dict(self.files)
+        for relative_path, _ in self.files:
+            pathlib.Path(temp_path, relative_path).parent.mkdir(parents=True, exist_ok=True)
+
+        def fetch_volume(relative_path: str, local_volume: str) -> None:
+            if not (os.path.exists(local_volume) and os.path.getsize(local_volume) == sizes[relative_path]):
+                # Transfer to a different name, so that unrar never sees a partially transferred volume
+                partial_path = local_volume + ".rtd-partial"
+                remote_volume = str(pathlib.PurePosixPath(self.remote_path, relative_path))
+                # Volumes are fetched one at a time, so each can use the whole connection budget
+                engine.fetch_file(remote_volume, partial_path, min(config.get_sftp_options(self.seedbox)["pget_conn"], plan.budget), progress)
+                os.replace(partial_path, local_volume)
+
+        for volumes in volume_sets:
+            local_volumes = [str(pathlib.Path(temp_path, relative_path)) for relative_path in volumes]
+            stream_extractor = rar_stream.RarStreamExtractor(local_volumes, os.path.dirname(local_volumes[0]), self.auto_delete_extracted)
+            try:
+                for relative_path, local_volume in zip(volumes, local_volumes):
+                    fetch_volume(relative_path, local_volume)
+                    stream_extractor.volume_ready()
+                stream_extractor.finish()
+            except rar_stream.StreamExtractionError:
+                log.warning(f"Could not extract {local_volumes[0]} while transferring it, it will be extracted once transferred")
+                # Volumes which were consumed (and removed) before it failed are needed again
+                for relative_path, local_volume in zip(volumes, local_volumes):
+                    fetch_volume(relative_path, local_volume)
+                continue
+            except BaseException:
+                stream_extractor.abort()
+                raise
+            self._stream_extracted.add(local_volumes[0])
+        streamed = {relative_path for volumes in volume_sets for relative_path in volumes}
+        remaining = [(relative_path, size) for relative_path, size in self.files if relative_path not in streamed]
+        with ThreadPoolExecutor(max_workers=plan.parallel_files) as executor:
+            futures = [
+                executor.submit(
+                    engine.fetch_file,
+                    str(pathlib.PurePosixPath(self.remote_path, relative_path)),
+                    str(pathlib.Path(temp_path, relative_path)),
+                    plan.connections,
+                    progress,
+                )
+                for relative_path, _ in remaining
+            ]
+            for future in futures:
+                future.result()
+
+    def post_process(self) -> None:
+        """Verify, extract, chmod, and move this object after it has been transferred, skipping stages a previous run already finished"""
+        temp_path = self.get_temp_path()
+        last_stage = self._last_finished_stage()
+        if _reached(last_stage, "moved"):
+            return
+        if config.get_torrent_watch_dir(self.watch_dir).get("verify_pieces", False) and not _reached(last_stage, "verified"):
+            with metrics.time_stage("verify"):
+                self._verify(temp_path)
+            metrics.record_event(self.infohash, "verified")
+            self._checkpoint("verified")
+        if self.is_direct_to_final():
+            mover.record_direct(self.watch_dir, sum(size for _, size in self.files))
+        else:
+            manifest = None
+            if self.auto_extract:
+                if _reached(last_stage, "extracted"):
+                    manifest = self._checkpointed_manifest(temp_path)
+                else:
+                    with metrics.time_stage("extract"):
+                        manifest = self._extract_if_necessary(temp_path)
+                    metrics.record_event(self.infohash, "extracted")
+                    self._checkpoint("extracted", manifest)
+            # optional chmod stuff
+            if not _reached(last_stage, "chmodded"):
+                with metrics.time_stage("chmod"):
+                    self._chmod_if_necessary(temp_path, manifest)
+                metrics.record_event(self.infohash, "chmodded")
+                self._checkpoint("chmodded", manifest)
+            # move final data
+            with metrics.time_stage("move"):
+                if _reached(last_stage, "placed"):
+                    mover.remove_source(str(temp_path))
+                else:
+                    mover.move(
+                        str(temp_path),
+                        self.final_download_dir,
+                        self.watch_dir,
+                        manifest.total_size() if manifest else sum(size for _, size in self.files),
+                        lambda: self._checkpoint("placed", manifest),
+                    )
+        metrics.record_event(self.infohash, "moved")
+        self._checkpoint("moved")
+        metrics.observe_availability(self.watch_dir, self.timestamp)
         log.info(f"Processing {self.remote_path} complete")
 
-    def _extract_if_necessary(self, temp_path: pathlib.Path) -> None:
+    def _verify(self, temp_path: pathlib.Path) -> None:
+        """Check the transferred files against the torrent's piece hashes, refetching only the pieces which fail"""
+        info = state.get_metainfo(self.infohash)
+        if info is None:
+            log.debug(f"No piece hashes for {self.remote_path} (i.e. it was added by magnet), skipping verification")
+            return
+        layout = PieceLayout(info)
+        if not layout.verifiable:
+            log.info(f"{self.remote_path} is a v{layout.meta_version} torrent without v1 piece hashes, skipping verification")
+            return
+        name = pathlib.PurePosixPath(self.remote_path).name
+        local_paths: Dict[str, str] = {}
+        remote_paths: Dict[str, str] = {}
+        for relative_path, _ in self.files:
+            local_path = pathlib.Path(temp_path, relative_path) if self.directory else temp_path
+            # Rar volumes which were extracted while streaming may already be deleted, so only existing files are verified
+            if local_path.exists():
+                torrent_path = f"{name}/{relative_path}" if self.directory else name
+                local_paths[torrent_path] = str(local_path)
+                remote_paths[torrent_path] = str(pathlib.PurePosixPath(self.remote_path, relative_path)) if self.directory else self.remote_path
+        checked, repaired = verifier.verify_and_repair(layout, local_paths, remote_paths, transfer_engine.get_engine(self.seedbox))
+        metrics.observe_verification(self.watch_dir, checked, repaired)
+        log.info(f"Verified {checked} pieces of {self.remote_path}" + (f", {repaired} of which were refetched" if repaired else ""))
+
+    def _extract_if_necessary(self, temp_path: pathlib.Path) -> Optional[Manifest]:
+        """Extract any archives within the download, returning the manifest of the resulting tree (or None if nothing needed extracting)"""
         if not self.directory:
             if temp_path.suffix == ".rar" or temp_path.suffix == ".zip":
-                # Create directory for extraction if single file
-                temp_rename_path = pathlib.Path(str(temp_path) + ".temp")
-                temp_path.rename(temp_rename_path)
-                temp_path.mkdir()
-                temp_rename_path.rename(pathlib.Path(temp_path, temp_path.name))
+                # Create directory for extraction if single file, unless a previous run did before stopping (see _undo_partial_wrap)
+                if not temp_path.is_dir():
+                    temp_rename_path = self._wrap_path(temp_path)
+                    temp_path.rename(temp_rename_path)
+                    temp_path.mkdir()
+                    temp_rename_path.rename(pathlib.Path(temp_path, temp_path.name))
                 self.directory = True
             else:
-                return
+                return None
 
-        extract_commands: List[List[str]] = []
-        files_to_remove: List[pathlib.Path] = []
-        # Walk through all dirs recursively to look for files to extract
-        for dirpath, _, filenames in os.walk(temp_path):
-            for fname in filenames:
-                curr_file = pathlib.Path(dirpath, fname)
-                if curr_file.suffix.lower() == ".zip":
-                    files_to_remove.append(curr_file)
-                    extract_commands.append(_get_unzip_cmd(str(curr_file), dirpath))
-                elif curr_file.suffix.lower() == ".rar":
-                    files_to_remove.append(curr_file)
-                    first_part = True
-                    if len(curr_file.suffixes) > 1:
-                        # Rar files can be split into parts; If this is a multipart rar, we don't want to extract anything except the first part
-                        # https://support.winzip.com/hc/en-us/articles/115011771188-Split-RAR-files-what-they-look-like-and-how-they-work-with-WinZip
-                        part_suffix = curr_file.suffixes[-2].lower()
-                        if part_suffix.startswith(".part"):
-                            if part_suffix != ".part1" and part_suffix != ".part01" and part_suffix != ".part001":
-                                first_part = False
-                        elif _rar_digit_part_regex.match(part_suffix):
-                            if part_suffix != ".1" and part_suffix != ".01" and part_suffix != ".001":
-                                first_part = False
-                    if first_part:
-                        extract_commands.append(_get_unrar_cmd(str(curr_file), dirpath))
-                elif _rar_rdigit_part_regex.match(curr_file.suffix.lower()):
-                    # Ensure we remove .r## files after extraction as well
-                    files_to_remove.append(curr_file)
-        # Run actual extract commands
-        if extract_commands:
+        manifest = Manifest.scan(str(temp_path))
+        archives: List[Tuple[str, List[str], List[str]]] = []  # (directory, extract command, list command)
+        files_to_remove: List[str] = []
+        for entry in manifest.files():
+            curr_file = os.path.join(manifest.root, entry.relative_path)
+            dirpath = os.path.dirname(curr_file)
+            if entry.archive == ARCHIVE_ZIP:
+                files_to_remove.append(entry.relative_path)
+                archives.append((dirpath, _get_unzip_cmd(curr_file, dirpath), _get_unzip_list_cmd(curr_file)))
+            elif entry.archive == ARCHIVE_RAR:
+                files_to_remove.append(entry.relative_path)
+                if curr_file not in self._stream_extracted:
+                    archives.append((dirpath, _get_unrar_cmd(curr_file, dirpath), _get_unrar_list_cmd(curr_file)))
+            elif entry.archive == ARCHIVE_RAR_PART:
+                # Ensure we remove later rar volumes after extraction as well
+                files_to_remove.append(entry.relative_path)
+        # Run actual extract commands (independent archives are extracted concurrently)
+        if archives:
             log.info(f"Extracting local files from {self.remote_path}")
-        for cmd in extract_commands:
-            log.debug(f"running extract command: {cmd}")
-            subprocess.run(cmd, check=True)
+            contents = extractor.list_contents([list_cmd for _, _, list_cmd in archives])
+            extractor.run_commands([extract_cmd for _, extract_cmd, _ in archives])
+            # Add the extracted files to the manifest, rather than scanning the whole tree again
+            for (dirpath, _, _), archive_contents in zip(archives, contents):
+                relative_dir = os.path.relpath(dirpath, manifest.root)
+                if archive_contents is None:
+                    manifest.rescan_dir(relative_dir)
+                else:
+                    manifest.add_paths(os.path.join(relative_dir, path) for path in archive_contents)
         # Remove residual archive files if necessary
         if self.auto_delete_extracted:
-            for path in files_to_remove:
-                path.unlink()
+            for relative_path in files_to_remove:
+                os.unlink(os.path.join(manifest.root, relative_path))
+                manifest.remove(relative_path)
+        return manifest
 
-    def _chmod_if_necessary(self, temp_path: pathlib.Path) -> None:
+    def _chmod_if_necessary(self, temp_path: pathlib.Path, manifest: Optional[Manifest] = None) -> None:
         chmod_config = config.get_chmod_config()
         if chmod_config:
             file_mode = chmod_config["file"]
@@ -142,9 +495,96 @@ class DownloadObject(object):
             if not self.directory:
                 os.chmod(temp_path, file_mode)
             else:
+                if manifest is None:
+                    manifest = Manifest.scan(str(temp_path))
                 os.chmod(temp_path, folder_mode)
-                for dirpath, dirnames, filenames in os.walk(temp_path):
-                    for dname in dirnames:
-                        os.chmod(os.path.join(dirpath, dname), folder_mode)
-                    for fname in filenames:
-                        os.chmod(os.path.join(dirpath, fname), file_mode)
+                use_dir_fd = os.chmod in os.supports_dir_fd and hasattr(os, "O_DIRECTORY")
+                for parent, entries in manifest.by_parent().items():
+                    parent_path = os.path.join(manifest.root, parent)
+                    # chmod relative to an open fd of the parent, so the kernel doesn't have to resolve the full path for every entry
+                    dir_fd = os.open(parent_path, os.O_RDONLY | os.O_DIRECTORY) if use_dir_fd else None
+                    try:
+                        for entry in entries:
+                            # Symlinks are skipped, so nothing outside of the download is modified
+                            if entry.is_dir or entry.is_file:
+                                name = os.path.basename(entry.relative_path)
+                                mode = folder_mode if entry.is_dir else file_mode
+                                if dir_fd is not None:
+                                    os.chmod(name, mode, dir_fd=dir_fd)
+                                else:
+                                    os.chmod(os.path.join(parent_path, name), mode)
+                    finally:
+                        if dir_fd is not None:
+                            os.close(dir_fd)
+
+
+def transfer_batch(objs: List[DownloadObject], connection_limit: int = 0) -> None:
+    """Transfer several single file objects of the same torrent (i.e. small files at its root) as one job over shared connections.
+    If connection_limit is provided, at most that many connections are opened
+    """
+    # Objects which a previous run already transferred are skipped
+    objs = [obj for obj in objs if not _reached(obj._last_finished_stage(), "transferred")]
+    if len(objs) <= 1:
+        for obj in objs:
+            obj.transfer(connection_limit)
+        return
+    files = [file for obj in objs for file in obj.files]
+    remote_path = f"{len(objs)} files of {pathlib.PurePosixPath(objs[0].remote_path).parent}"
+    log.info(f"Starting download for {remote_path}")
+    for obj in objs:
+        metrics.record_event(obj.infohash, "transfer_started")
+    start = time.monotonic()
+    for obj in objs:
+        if obj.part_of:
+            obj.get_temp_path().parent.mkdir(parents=True, exist_ok=True)
+    # Planned like a directory, so the files are fetched in parallel with a connection each
+    plan = tuning.plan_transfer(files, True, config.get_sftp_options(objs[0].seedbox), connection_limit)
+    tuner = tuning.TransferTuner(remote_path, plan, True, _ProgressLogger(remote_path))
+    with metrics.time_stage("transfer"):
+        transfer_engine.get_engine(objs[0].seedbox).fetch_files(
+            [(obj.remote_path, str(obj.get_temp_path())) for obj in objs], plan.parallel_files, tuner, tuner
+        )
+    tuner.finish()
+    # Batches are only made of objects of the same torrent, so they share a watch dir
+    metrics.observe_transfer(objs[0].watch_dir, sum(size for _, size in files), time.monotonic() - start)
+    with state.batch():
+        for obj in objs:
+            metrics.record_event(obj.infohash, "transferred")
+            obj._checkpoint("transferred")
+    log.info(f"Finished downloading {remote_path}")
+
+
+def is_early_transfer(watching_data: Dict[str, Any]) -> bool:
+    """Whether files of a watched torrent are transferred as soon as they are complete, rather than once the whole torrent is"""
+    return config.get_torrent_watch_dir(watching_data.get("watch_dir", "")).get("early_transfer", False)
+
+
+def partial_download_objects(infohash: str, watching_data: Dict[str, Any], base_dir: str, files: List[Tuple[str, int, bool]]) -> List[DownloadObject]:
+    """Partial download objects for the files of an incomplete torrent which are already complete on the seedbox.
+    files are (path within the torrent, size, whether it is complete) of every file in the torrent
+    """
+    download_list: List[DownloadObject] = []
+    for path, size, complete in files:
+        if not complete:
+            continue
+        parts = pathlib.PurePosixPath(path).parts
+        # Files in a directory of the torrent go where they will be once the directory is transferred
+        part_of = str(pathlib.PurePosixPath(base_dir, parts[0])) if len(parts) > 1 else ""
+        download_list.append(
+            DownloadObject(
+                infohash,
+                str(pathlib.PurePosixPath(base_dir, path)),
+                0,
+                False,
+                watching_data["temp_dir"],
+                watching_data["final_dir"],
+                watching_data.get("auto_extract", False),
+                watching_data.get("auto_delete_extracted", False),
+                watching_data.get("watch_dir", ""),
+                [(str(pathlib.PurePosixPath(*parts[1:])) if part_of else path, size)],
+                watching_data.get("seedbox", ""),
+                True,
+                part_of,
+            )
+        )
+    return download_list
@@ -0,0 +1,226 @@
+from typing import List, Tuple
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.model.download_obj import DownloadObject, partial_download_objects
+from downloader.state import config
+from downloader.state import state
+from downloader.transfer.engine import TransferEngine
+
+_INFOHASH = "f" * 40
+
+
+class DownloadObjectResumeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        self.temp_dir = watch_dir["temp_download_dir"]
+        self.final_dir = watch_dir["final_download_dir"]
+        self.watch_dir = watch_dir["directory"]
+        state.add_watching_torrent(_INFOHASH, self.temp_dir, self.final_dir, "Show", watch_dir=self.watch_dir)
+
+    def _new_object(self, files: List[Tuple[str, int]]) -> DownloadObject:
+        """A download object as the next poll (or the next run) would create it"""
+        return DownloadObject(_INFOHASH, "/remote/Show", 0, True, self.temp_dir, self.final_dir, False, False, self.watch_dir, files, "", False, "")
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def _transferred(self) -> DownloadObject:
+        self._write(os.path.join(self.temp_dir, "Show", "episode.mkv"), b"new")
+        obj = self._new_object([("episode.mkv", 3)])
+        obj._checkpoint("transferred")
+        return obj
+
+    def test_single_file_archive_interrupted_while_moved_into_a_directory(self) -> None:
+        temp_path = os.path.join(self.temp_dir, "a.zip")
+        wrap_path = temp_path + ".temp"
+        # After each step of moving the archive into a directory of its own
+        for step in ("renamed", "created", "moved"):
+            with self.subTest(step=step):
+                os.makedirs(self.temp_dir, exist_ok=True)
+                with zipfile.ZipFile(wrap_path if step != "moved" else os.path.join(self.workdir, "a.zip"), "w") as archive:
+                    archive.writestr("inner.txt", "extracted")
+                if step == "created":
+                    os.mkdir(temp_path)
+                elif step == "moved":
+                    os.mkdir(temp_path)
+                    os.rename(os.path.join(self.workdir, "a.zip"), os.path.join(temp_path, "a.zip"))
+                obj = DownloadObject(_INFOHASH, "/remote/a.zip", 0, False, self.temp_dir, self.final_dir, True, True, self.watch_dir, [("a.zip", 1)])
+                state.save_checkpoint(
+                    _INFOHASH, "/remote/a.zip", {"stage": "transferred", "directory": False, "stream_extracted": [], "manifest": None}
+                )
+                obj.post_process()
+                final_path = os.path.join(self.final_dir, "a.zip")
+                self.assertEqual(os.listdir(final_path), ["inner.txt"])
+                self.assertFalse(os.path.exists(wrap_path))
+                shutil.rmtree(final_path)
+
+    def test_existing_destination_is_never_taken_for_a_finished_move(self) -> None:
+        self._write(os.path.join(self.final_dir, "Show", "unrelated.mkv"), b"old")
+        with self.assertRaises(Exception):
+            self._transferred().post_process()
+        self.assertEqual(state.get_checkpoint(_INFOHASH, "/remote/Show")["stage"], "chmodded")
+        # The next poll retries with the checkpoint, and must fail the same way rather than delete the download
+        with self.assertRaises(Exception):
+            self._new_object([("episode.mkv", 3)]).post_process()
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "Show", "episode.mkv")))
+        self.assertEqual(os.listdir(os.path.join(self.final_dir, "Show")), ["unrelated.mkv"])
+
+    def test_resume_after_chmod_only_moves(self) -> None:
+        config.config_cache["chmod_download"] = {"file": 0o600, "folder": 0o700}
+        obj = self._transferred()
+        obj._checkpoint("chmodded")
+        os.chmod(os.path.join(self.temp_dir, "Show", "episode.mkv"), 0o644)
+        self._new_object([("episode.mkv", 3)]).post_process()
+        moved = os.path.join(self.final_dir, "Show", "episode.mkv")
+        self.assertTrue(os.path.exists(moved))
+        # chmod was not run again
+        self.assertEqual(os.stat(moved).st_mode & 0o777, 0o644)
+        self.assertEqual(state.get_checkpoint(_INFOHASH, "/remote/Show")["stage"], "moved")
+
+    def test_rename_which_was_not_recorded_is_finished(self) -> None:
+        self._transferred()._checkpoint("chmodded")
+        os.rename(os.path.join(self.temp_dir, "Show"), os.path.join(self.final_dir, "Show"))
+        self._new_object([("episode.mkv", 3)]).post_process()
+        self.assertEqual(state.get_checkpoint(_INFOHASH, "/remote/Show")["stage"], "moved")
+
+    def test_unrelated_destination_is_not_taken_for_an_unrecorded_rename(self) -> None:
+        self._transferred()._checkpoint("chmodded")
+        shutil.rmtree(os.path.join(self.temp_dir, "Show"))
+        self._write(os.path.join(self.final_dir, "Show", "unrelated.mkv"), b"old")
+        # With its data gone, the object starts over rather than being marked as moved
+        self.assertFalse(self._new_object([("episode.mkv", 3)]).transferred())
+
+    def test_interrupted_copy_removes_the_temp_copy(self) -> None:
+        obj = self._transferred()
+        shutil.copytree(os.path.join(self.temp_dir, "Show"), os.path.join(self.final_dir, "Show"))
+        obj._checkpoint("placed")
+        self._new_object([("episode.mkv", 3)]).post_process()
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "Show")))
+        self.assertTrue(os.path.exists(os.path.join(self.final_dir, "Show", "episode.mkv")))
+        self.assertEqual(state.get_checkpoint(_INFOHASH, "/remote/Show")["stage"], "moved")
+
+
+class EarlyTransferTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        watch_dir["early_transfer"] = True
+        self.temp_dir = watch_dir["temp_download_dir"]
+        self.final_dir = watch_dir["final_download_dir"]
+        self.watch_dir = watch_dir["directory"]
+        state.add_watching_torrent(_INFOHASH, self.temp_dir, self.final_dir, "Show", watch_dir=self.watch_dir)
+        # The local transfer engine reads "remote" paths straight from disk
+        self.remote_dir = os.path.join(self.workdir, "remote")
+        for name in ("e01.mkv", "e02.mkv"):
+            self._write_remote(os.path.join("Show", name), b"complete")
+
+    def _write_remote(self, path: str, data: bytes) -> None:
+        full_path = os.path.join(self.remote_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(data)
+
+    def _read_temp(self, path: str) -> bytes:
+        with open(os.path.join(self.temp_dir, path), "rb") as f:
+            return f.read()
+
+    def _partials(self) -> List[DownloadObject]:
+        watching_data = state.get_watching_torrents()[_INFOHASH]
+        files = [("Show/e01.mkv", 8, True), ("Show/e02.mkv", 8, False), ("extra.nfo", 3, True)]
+        return partial_download_objects(_INFOHASH, watching_data, self.remote_dir, files)
+
+    def test_partial_objects(self) -> None:
+        episode, extra = self._partials()
+        self.assertTrue(episode.partial)
+        self.assertEqual(episode.remote_path, os.path.join(self.remote_dir, "Show", "e01.mkv"))
+        self.assertEqual(episode.part_of, os.path.join(self.remote_dir, "Show"))
+        self.assertEqual(episode.files, [("e01.mkv", 8)])
+        # Transferred to where the file will be once its directory is
+        self.assertEqual(str(episode.get_temp_path()), os.path.join(self.temp_dir, "Show", "e01.mkv"))
+        self.assertEqual(extra.part_of, "")
+        self.assertEqual(str(extra.get_temp_path()), os.path.join(self.temp_dir, "extra.nfo"))
+
+    def test_directory_only_transfers_the_remaining_files(self) -> None:
+        episode = self._partials()[0]
+        episode.transfer()
+        self.assertEqual(self._read_temp(os.path.join("Show", "e01.mkv")), b"complete")
+        # Change the seedbox copy, so fetching it again would show
+        self._write_remote(os.path.join("Show", "e01.mkv"), b"fetched again")
+        show = DownloadObject(
+            _INFOHASH,
+            os.path.join(self.remote_dir, "Show"),
+            0,
+            True,
+            self.temp_dir,
+            self.final_dir,
+            False,
+            False,
+            self.watch_dir,
+            [("e01.mkv", 8), ("e02.mkv", 8)],
+        )
+        # The early file already takes up its space
+        self.assertEqual(show.space_needed(), {self.temp_dir: 8})
+        show.transfer()
+        self.assertEqual(self._read_temp(os.path.join("Show", "e01.mkv")), b"complete")
+        self.assertEqual(self._read_temp(os.path.join("Show", "e02.mkv")), b"complete")
+        self.assertTrue(show.transferred())
+
+    def test_directory_whose_files_were_all_transferred_early(self) -> None:
+        watching_data = state.get_watching_torrents()[_INFOHASH]
+        # The last file completed between the torrent's status and file progress being read
+        for episode in partial_download_objects(_INFOHASH, watching_data, self.remote_dir, [("Show/e01.mkv", 8, True), ("Show/e02.mkv", 8, True)]):
+            episode.transfer()
+        show = DownloadObject(
+            _INFOHASH,
+            os.path.join(self.remote_dir, "Show"),
+            0,
+            True,
+            self.temp_dir,
+            self.final_dir,
+            False,
+            False,
+            self.watch_dir,
+            [("e01.mkv", 8), ("e02.mkv", 8)],
+        )
+        with mock.patch.object(TransferEngine, "fetch_files", side_effect=AssertionError("nothing is left to fetch")):
+            show.transfer()
+        self.assertTrue(show.transferred())
+
+    def test_early_file_which_is_gone_is_transferred_again(self) -> None:
+        episode = self._partials()[0]
+        episode.transfer()
+        os.unlink(os.path.join(self.temp_dir, "Show", "e01.mkv"))
+        show = DownloadObject(
+            _INFOHASH,
+            os.path.join(self.remote_dir, "Show"),
+            0,
+            True,
+            self.temp_dir,
+            self.final_dir,
+            False,
+            False,
+            self.watch_dir,
+            [("e01.mkv", 8), ("e02.mkv", 8)],
+        )
+        self.assertEqual(show.space_needed(), {self.temp_dir: 16})
+        show.transfer()
+        self.assertEqual(self._read_temp(os.path.join("Show", "e01.mkv")), b"complete")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+from typing import List, Dict, Iterable, Any
+import re
+import os
+import stat
+import pathlib
+import logging
+
+log = logging.getLogger("manifest")
+
+_rar_digit_part_regex = re.compile(r"^\.\d{1,3}$")
+_rar_rdigit_part_regex = re.compile(r"^\.r\d{1,3}$")
+
+# Archive classifications of files
+ARCHIVE_NONE = ""
+ARCHIVE_ZIP = "zip"
+ARCHIVE_RAR = "rar"  # A rar file to extract (single rar, or the first volume of a multipart rar)
+ARCHIVE_RAR_PART = "rar_part"  # A later volume of a multipart rar, which is extracted via its first volume
+
+
+def classify_archive(name: str) -> str:
+    path = pathlib.PurePath(name)
+    suffix = path.suffix.lower()
+    if suffix == ".zip":
+        return ARCHIVE_ZIP
+    if suffix == ".rar":
+        if len(path.suffixes) > 1:
+            # Rar files can be split into parts; If this is a multipart rar, we don't want to extract anything except the first part
+            # https://support.winzip.com/hc/en-us/articles/115011771188-Split-RAR-files-what-they-look-like-and-how-they-work-with-WinZip
+            part_suffix = path.suffixes[-2].lower()
+            if part_suffix.startswith(".part"):
+                if part_suffix != ".part1" and part_suffix != ".part01" and part_suffix != ".part001":
+                    return ARCHIVE_RAR_PART
+            elif _rar_digit_part_regex.match(part_suffix):
+                if part_suffix != ".1" and part_suffix != ".01" and part_suffix != ".001":
+                    return ARCHIVE_RAR_PART
+        return ARCHIVE_RAR
+    if _rar_rdigit_part_regex.match(suffix):
+        return ARCHIVE_RAR_PART
+    return ARCHIVE_NONE
+
+
+class ManifestEntry(object):
+    __slots__ = ("relative_path", "is_dir", "is_file", "size", "archive")
+
+    def __init__(self, relative_path: str, is_dir: bool, is_file: bool, size: int, archive: str):
+        self.relative_path = relative_path
+        self.is_dir = is_dir
+        self.is_file = is_file
+        self.size = size
+        self.archive = archive
+
+
+class Manifest(object):
+    """Every file and directory within a downloaded tree, built with a single scandir walk.
+    Paths are relative to root; the root itself is the entry with an empty path
+    """
+
+    root: str
+    entries: Dict[str, ManifestEntry]
+
+    def __init__(self, root: str):
+        self.root = root
+        self.entries = {}
+
+    @classmethod
+    def scan(cls, root: str) -> "Manifest":
+        manifest = cls(root)
+        manifest.entries[""] = ManifestEntry("", True, False, 0, ARCHIVE_NONE)
+        manifest._scan_dir("")
+        return manifest
+
+    def _add_dir_entry(self, relative_path: str, dir_entry: "os.DirEntry[str]") -> ManifestEntry:
+        is_dir = dir_entry.is_dir(follow_symlinks=False)
+        is_file = dir_entry.is_file(follow_symlinks=False)
+        entry = ManifestEntry(
+            relative_path,
+            is_dir,
+            is_file,
+            dir_entry.stat(follow_symlinks=False).st_size if is_file else 0,
+            classify_archive(dir_entry.name) if is_file else ARCHIVE_NONE,
+        )
+        self.entries[relative_path] = entry
+        return entry
+
+    def _scan_dir(self, relative_dir: str) -> None:
+        stack = [relative_dir]
+        while stack:
+            current = stack.pop()
+            with os.scandir(os.path.join(self.root, current)) as dir_entries:
+                for dir_entry in dir_entries:
+                    entry = self._add_dir_entry(os.path.join(current, dir_entry.name), dir_entry)
+                    if entry.is_dir:
+                        stack.append(entry.relative_path)
+
+    def add_paths(self, relative_paths: Iterable[str]) -> None:
+        """Add (or update) specific paths, i.e. newly extracted files, without rescanning the tree. Missing parent directories are added too"""
+        for relative_path in relative_paths:
+            relative_path = os.path.normpath(relative_path)
+            if relative_path.startswith(".."):
+                continue
+            parts = pathlib.PurePath(relative_path).parts
+            for i in range(1, len(parts) + 1):
+                partial = os.path.join(*parts[:i])
+                if i < len(parts) and partial in self.entries:
+                    continue
+                try:
+                    attrs = os.lstat(os.path.join(self.root, partial))
+                except FileNotFoundError:
+                    break
+                is_file = stat.S_ISREG(attrs.st_mode)
+                self.entries[partial] = ManifestEntry(
+                    partial,
+                    stat.S_ISDIR(attrs.st_mode),
+                    is_file,
+                    attrs.st_size if is_file else 0,
+                    classify_archive(parts[i - 1]) if is_file else ARCHIVE_NONE,
+                )
+
+    def rescan_dir(self, relative_dir: str) -> None:
+        """Rescan a single directory subtree, for when the paths added within it are not known"""
+        relative_dir = os.path.normpath(relative_dir)
+        self._scan_dir("" if relative_dir == "." else relative_dir)
+
+    def to_list(self) -> List[List[Any]]:
+        """Entries as json serializable lists, i.e. to be saved and later restored with from_list without scanning again"""
+        return [[entry.relative_path, entry.is_dir, entry.is_file, entry.size, entry.archive] for entry in self.entries.values()]
+
+    @classmethod
+    def from_list(cls, root: str, entries: List[List[Any]]) -> "Manifest":
+        manifest = cls(root)
+        for relative_path, is_dir, is_file, size, archive in entries:
+            manifest.entries[relative_path] = ManifestEntry(relative_path, is_dir, is_file, size, archive)
+        return manifest
+
+    def remove(self, relative_path: str) -> None:
+        self.entries.pop(relative_path, None)
+
+    def files(self) -> List[ManifestEntry]:
+        return [entry for entry in self.entries.values() if entry.is_file]
+
+    def total_size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def by_parent(self) -> Dict[str, List[ManifestEntry]]:
+        """Group entries (except the root) by their parent directory"""
+        grouped: Dict[str, List[ManifestEntry]] = {}
+        for entry in self.entries.values():
+            if entry.relative_path:
+                grouped.setdefault(os.path.dirname(entry.relative_path), []).append(entry)
+        return grouped
@@ -0,0 +1,121 @@
+from typing import Dict
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from downloader.benchmark import fakes
+from downloader.model import manifest as manifest_module
+from downloader.model.manifest import Manifest
+from downloader.model.download_obj import DownloadObject
+from downloader.state import config
+from downloader.state import state
+
+
+def _touch(path: str, data: bytes = b"") -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class ClassifyArchiveTest(unittest.TestCase):
+    def test_classify(self) -> None:
+        cases = {
+            "a.zip": manifest_module.ARCHIVE_ZIP,
+            "a.rar": manifest_module.ARCHIVE_RAR,
+            "a.part01.rar": manifest_module.ARCHIVE_RAR,
+            "a.part02.rar": manifest_module.ARCHIVE_RAR_PART,
+            "a.001.rar": manifest_module.ARCHIVE_RAR,
+            "a.002.rar": manifest_module.ARCHIVE_RAR_PART,
+            "a.r00": manifest_module.ARCHIVE_RAR_PART,
+            "a.mkv": manifest_module.ARCHIVE_NONE,
+        }
+        for name, archive in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(manifest_module.classify_archive(name), archive)
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        _touch(os.path.join(self.root, "a.rar"), b"rar")
+        _touch(os.path.join(self.root, "sub", "b.mkv"), b"video")
+
+    def test_scan(self) -> None:
+        manifest = Manifest.scan(self.root)
+        self.assertEqual(set(manifest.entries), {"", "a.rar", "sub", os.path.join("sub", "b.mkv")})
+        self.assertTrue(manifest.entries["sub"].is_dir)
+        self.assertEqual(manifest.entries["a.rar"].archive, manifest_module.ARCHIVE_RAR)
+        self.assertEqual(manifest.total_size(), 8)
+
+    def test_add_paths(self) -> None:
+        manifest = Manifest.scan(self.root)
+        _touch(os.path.join(self.root, "extracted", "deep", "c.mkv"), b"cc")
+        manifest.add_paths([os.path.join("extracted", "deep", "c.mkv"), "../outside", "missing.mkv", os.path.join("missing", "d.mkv")])
+        # Parents of the added file are added too, and paths which don't exist or are outside of the root are not
+        self.assertTrue(manifest.entries["extracted"].is_dir)
+        self.assertTrue(manifest.entries[os.path.join("extracted", "deep")].is_dir)
+        self.assertEqual(manifest.entries[os.path.join("extracted", "deep", "c.mkv")].size, 2)
+        self.assertNotIn("missing.mkv", manifest.entries)
+        self.assertNotIn("missing", manifest.entries)
+        self.assertFalse(any(path.startswith("..") for path in manifest.entries))
+        # Updating an existing file picks up its new size
+        _touch(os.path.join(self.root, "a.rar"), b"longer rar")
+        manifest.add_paths(["a.rar"])
+        self.assertEqual(manifest.entries["a.rar"].size, 10)
+
+    def test_list_round_trip(self) -> None:
+        manifest = Manifest.scan(self.root)
+        restored = Manifest.from_list(self.root, manifest.to_list())
+        self.assertEqual(
+            {path: (entry.is_dir, entry.is_file, entry.size, entry.archive) for path, entry in restored.entries.items()},
+            {path: (entry.is_dir, entry.is_file, entry.size, entry.archive) for path, entry in manifest.entries.items()},
+        )
+
+
+class ChmodTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir, chmod_download={"file": 0o640, "folder": 0o750})
+        self.addCleanup(state.close)
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        self.download = os.path.join(watch_dir["temp_download_dir"], "Show")
+        _touch(os.path.join(self.download, "sub", "a.mkv"))
+        self.outside = os.path.join(self.workdir, "outside")
+        _touch(self.outside)
+        os.chmod(self.outside, 0o604)
+        os.symlink(self.outside, os.path.join(self.download, "link"))
+        self.obj = DownloadObject(
+            "f" * 40,
+            "/remote/Show",
+            0,
+            True,
+            watch_dir["temp_download_dir"],
+            watch_dir["final_download_dir"],
+            False,
+            False,
+            watch_dir["directory"],
+            [("sub/a.mkv", 0)],
+        )
+
+    def _modes(self) -> Dict[str, int]:
+        return {path: stat.S_IMODE(os.lstat(os.path.join(self.download, path)).st_mode) for path in ("", "sub", os.path.join("sub", "a.mkv"))}
+
+    def test_chmod_from_manifest(self) -> None:
+        manifest = Manifest.scan(self.download)
+        self.obj._chmod_if_necessary(self.obj.get_temp_path(), manifest)
+        self.assertEqual(self._modes(), {"": 0o750, "sub": 0o750, os.path.join("sub", "a.mkv"): 0o640})
+        # Symlinks aren't followed out of the download
+        self.assertEqual(stat.S_IMODE(os.stat(self.outside).st_mode), 0o604)
+
+    def test_chmod_scans_without_manifest(self) -> None:
+        self.obj._chmod_if_necessary(self.obj.get_temp_path())
+        self.assertEqual(self._modes(), {"": 0o750, "sub": 0o750, os.path.join("sub", "a.mkv"): 0o640})
+        self.assertEqual(stat.S_IMODE(os.stat(self.outside).st_mode), 0o604)
+
+
+if __name__ == "__main__":
+    unittest.main()
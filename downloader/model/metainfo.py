@@ -0,0 +1,173 @@
+from typing import Any, List, Tuple, Optional, Dict
+import re
+import base64
+import hashlib
+import logging
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+log = logging.getLogger("metainfo")
+
+_btih_regex = re.compile(r"^urn:btih:([0-9a-fA-F]{40}|[A-Za-z2-7]{32})$")
+
+
+class BencodeError(Exception):
+    pass
+
+
+def _decode(data: bytes, pos: int) -> Tuple[Any, int]:
+    """Decode the bencoded value starting at pos, returning the value and the position after it"""
+    try:
+        token = data[pos : pos + 1]
+        if token == b"i":
+            end = data.index(b"e", pos)
+            return int(data[pos + 1 : end]), end + 1
+        if token == b"l":
+            pos += 1
+            items = []
+            while data[pos : pos + 1] != b"e":
+                item, pos = _decode(data, pos)
+                items.append(item)
+            return items, pos + 1
+        if token == b"d":
+            pos += 1
+            dictionary: Dict[bytes, Any] = {}
+            while data[pos : pos + 1] != b"e":
+                key, pos = _decode(data, pos)
+                dictionary[key], pos = _decode(data, pos)
+            return dictionary, pos + 1
+        if token.isdigit():
+            colon = data.index(b":", pos)
+            length = int(data[pos:colon])
+            if colon + 1 + length > len(data):
+                raise BencodeError("string runs past end of data")
+            return data[colon + 1 : colon + 1 + length], colon + 1 + length
+    except ValueError as e:
+        raise BencodeError(str(e))
+    raise BencodeError(f"unexpected token {token!r} at position {pos}")
+
+
+def bdecode(data: bytes) -> Any:
+    value, pos = _decode(data, 0)
+    if pos != len(data):
+        raise BencodeError("trailing data after bencoded value")
+    return value
+
+
+def _info_span(data: bytes) -> Tuple[int, int]:
+    """Find the start and end positions of the raw bencoded info dict in torrent file data"""
+    if data[:1] != b"d":
+        raise BencodeError("torrent file is not a dictionary")
+    pos = 1
+    while data[pos : pos + 1] != b"e":
+        key, pos = _decode(data, pos)
+        value_start = pos
+        _, pos = _decode(data, pos)
+        if key == b"info":
+            return value_start, pos
+    raise BencodeError("torrent file has no info dictionary")
+
+
+def infohash_from_torrent(data: bytes) -> str:
+    """Compute the (v1) infohash of a torrent file, as lowercase hex"""
+    start, end = _info_span(data)
+    return hashlib.sha1(data[start:end]).hexdigest()
+
+
+def info_from_torrent(data: bytes) -> bytes:
+    """Get the raw bencoded info dict of a torrent file, which holds its file layout and piece hashes"""
+    start, end = _info_span(data)
+    return data[start:end]
+
+
+def infohash_from_magnet(uri: str) -> Optional[str]:
+    """Get the (v1) infohash of a magnet uri as lowercase hex, or None if it doesn't have one"""
+    parsed = urlparse(uri.strip())
+    if parsed.scheme != "magnet":
+        return None
+    for exact_topic in parse_qs(parsed.query).get("xt", []):
+        match = _btih_regex.match(exact_topic)
+        if match:
+            btih = match.group(1)
+            if len(btih) == 32:
+                return base64.b32decode(btih.upper()).hex()
+            return btih.lower()
+    return None
+
+
+def read_infohash(torrent_file_path: str) -> Optional[str]:
+    """Get the infohash of a .torrent or .magnet file without contacting the torrent client, or None if it can't be determined locally"""
+    path = Path(torrent_file_path)
+    try:
+        if path.suffix == ".magnet":
+            return infohash_from_magnet(path.read_text())
+        return infohash_from_torrent(path.read_bytes())
+    except (OSError, UnicodeDecodeError, BencodeError) as e:
+        log.debug(f"Could not compute infohash of {torrent_file_path} locally: {e}")
+        return None
+
+
+def read_info(torrent_file_path: str) -> Optional[bytes]:
+    """Get the raw info dict of a .torrent file, or None if it isn't a readable torrent file (i.e. a magnet)"""
+    path = Path(torrent_file_path)
+    if path.suffix == ".magnet":
+        return None
+    try:
+        return info_from_torrent(path.read_bytes())
+    except (OSError, BencodeError) as e:
+        log.debug(f"Could not read info of {torrent_file_path}: {e}")
+        return None
+
+
+class PieceLayout(object):
+    """Where the pieces of a (v1) torrent are, from its info dict.
+    Every file is listed with its path as torrent clients report it (starting with the torrent name), its length, and its offset in the torrent.
+    v2 only torrents (BEP 52) have a file tree and per file hashes instead, so they have no v1 piece hashes (see verifiable).
+    Hybrid torrents carry both, and their v1 pieces are used
+    """
+
+    def __init__(self, info: bytes):
+        decoded = bdecode(info)
+        self.meta_version: int = decoded.get(b"meta version", 1)
+        self.piece_length: int = decoded[b"piece length"]
+        pieces: bytes = decoded.get(b"pieces", b"")
+        self.hashes = [pieces[i : i + 20] for i in range(0, len(pieces), 20)]
+        name = decoded[b"name"].decode("utf-8", "replace")
+        # (path, length, offset, whether it is a padding file which is never downloaded, and is all zeros)
+        self.files: List[Tuple[str, int, int, bool]] = []
+        if b"files" in decoded:
+            offset = 0
+            for file_info in decoded[b"files"]:
+                path = "/".join([name] + [part.decode("utf-8", "replace") for part in file_info[b"path"]])
+                self.files.append((path, file_info[b"length"], offset, b"p" in file_info.get(b"attr", b"")))
+                offset += file_info[b"length"]
+        elif b"length" in decoded:
+            self.files.append((name, decoded[b"length"], 0, False))
+        else:
+            tree = decoded.get(b"file tree", {})
+            if len(tree) == 1 and b"" in next(iter(tree.values())):
+                # A single file torrent's tree holds just the file, under the torrent name
+                self.files.append((name, next(iter(tree.values()))[b""][b"length"], 0, False))
+            else:
+                self._add_file_tree(name, tree)
+        self.total_length = sum(length for _, length, _, _ in self.files)
+
+    def _add_file_tree(self, path: str, tree: Dict[bytes, Any]) -> None:
+        """Add the files of a v2 file tree, where a file is a dict with an empty key holding its length.
+        Each file starts at a piece boundary, though that doesn't matter without v1 pieces to check
+        """
+        if b"" in tree:
+            self.files.append((path, tree[b""][b"length"], sum(length for _, length, _, _ in self.files), False))
+            return
+        for part, subtree in sorted(tree.items()):
+            self._add_file_tree(f"{path}/{part.decode('utf-8', 'replace')}", subtree)
+
+    @property
+    def verifiable(self) -> bool:
+        """Whether there are v1 piece hashes to check local files against"""
+        return bool(self.hashes)
+
+    def piece_span(self, index: int) -> Tuple[int, int]:
+        """Start (inclusive) and end (exclusive) offsets of a piece within the torrent"""
+        start = index * self.piece_length
+        return start, min(start + self.piece_length, self.total_length)
@@ -0,0 +1,112 @@
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from downloader.benchmark.library import bencode, make_metainfo
+from downloader.model import metainfo
+
+
+class BencodeTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        value = {b"announce": b"http://tracker.invalid", b"info": {b"length": 5, b"name": b"a", b"list": [1, -2, b"x", []]}}
+        self.assertEqual(metainfo.bdecode(bencode(value)), value)
+
+    def test_invalid_data(self) -> None:
+        for data in (b"i1ee", b"5:abc", b"x", b"i12", b"l", b"d1:ai1e"):
+            with self.subTest(data=data), self.assertRaises(metainfo.BencodeError):
+                metainfo.bdecode(data)
+
+
+class InfohashTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def test_torrent_infohash_is_of_the_raw_info_dict(self) -> None:
+        # Keys after info must not change the hash, and info is hashed exactly as it appears in the file (even if not canonical)
+        info = b"d6:lengthi5e4:name1:a12:piece lengthi16384e6:pieces20:" + b"\x00" * 20 + b"e"
+        data = b"d8:announce3:url4:info" + info + b"7:comment3:abce"
+        self.assertEqual(metainfo.info_from_torrent(data), info)
+        self.assertEqual(metainfo.infohash_from_torrent(data), hashlib.sha1(info).hexdigest())
+
+    def test_torrent_without_info(self) -> None:
+        with self.assertRaises(metainfo.BencodeError):
+            metainfo.infohash_from_torrent(b"d8:announce3:urle")
+        with self.assertRaises(metainfo.BencodeError):
+            metainfo.infohash_from_torrent(b"l4:infoe")
+
+    def test_magnet_infohash(self) -> None:
+        infohash = hashlib.sha1(b"torrent").hexdigest()
+        self.assertEqual(metainfo.infohash_from_magnet(f"magnet:?xt=urn:btih:{infohash.upper()}&dn=name"), infohash)
+        base32 = base64.b32encode(bytes.fromhex(infohash)).decode("ascii")
+        self.assertEqual(metainfo.infohash_from_magnet(f"magnet:?dn=name&xt=urn:btih:{base32.lower()}\n"), infohash)
+        self.assertIsNone(metainfo.infohash_from_magnet("magnet:?xt=urn:btmh:1220" + "0" * 64))
+        self.assertIsNone(metainfo.infohash_from_magnet(f"http://example.invalid/?xt=urn:btih:{infohash}"))
+
+    def test_read_infohash(self) -> None:
+        torrent_path = os.path.join(self.workdir, "a.torrent")
+        data = make_metainfo("a", [("a", 5)])
+        with open(torrent_path, "wb") as f:
+            f.write(data)
+        self.assertEqual(metainfo.read_infohash(torrent_path), metainfo.infohash_from_torrent(data))
+        magnet_path = os.path.join(self.workdir, "b.magnet")
+        with open(magnet_path, "w") as f:
+            f.write("magnet:?xt=urn:btih:" + "a" * 40)
+        self.assertEqual(metainfo.read_infohash(magnet_path), "a" * 40)
+        self.assertIsNone(metainfo.read_info(magnet_path))
+        broken_path = os.path.join(self.workdir, "c.torrent")
+        with open(broken_path, "wb") as f:
+            f.write(b"not a torrent")
+        self.assertIsNone(metainfo.read_infohash(broken_path))
+        self.assertIsNone(metainfo.read_infohash(os.path.join(self.workdir, "missing.torrent")))
+
+
+class PieceLayoutTest(unittest.TestCase):
+    def test_multi_file(self) -> None:
+        info = bencode(
+            {
+                "name": "Show",
+                "piece length": 4,
+                "pieces": b"\x01" * 20 * 3,
+                "files": [
+                    {"length": 3, "path": ["a.mkv"]},
+                    {"length": 1, "path": [".pad", "1"], "attr": "p"},
+                    {"length": 5, "path": ["sub", "b.nfo"]},
+                ],
+            }
+        )
+        layout = metainfo.PieceLayout(info)
+        self.assertEqual(layout.files, [("Show/a.mkv", 3, 0, False), ("Show/.pad/1", 1, 3, True), ("Show/sub/b.nfo", 5, 4, False)])
+        self.assertEqual(len(layout.hashes), 3)
+        self.assertEqual(layout.total_length, 9)
+        self.assertEqual(layout.piece_span(0), (0, 4))
+        # The last piece is short
+        self.assertEqual(layout.piece_span(2), (8, 9))
+
+    def test_single_file(self) -> None:
+        layout = metainfo.PieceLayout(bencode({"name": "a.mkv", "piece length": 4, "pieces": b"\x01" * 20, "length": 3}))
+        self.assertEqual(layout.files, [("a.mkv", 3, 0, False)])
+
+    def test_v2_only(self) -> None:
+        tree = {"a.mkv": {"": {"length": 3, "pieces root": b"\x01" * 32}}, "sub": {"b.nfo": {"": {"length": 5, "pieces root": b"\x02" * 32}}}}
+        layout = metainfo.PieceLayout(bencode({"name": "Show", "piece length": 16384, "meta version": 2, "file tree": tree}))
+        self.assertFalse(layout.verifiable)
+        self.assertEqual([(path, length) for path, length, _, _ in layout.files], [("Show/a.mkv", 3), ("Show/sub/b.nfo", 5)])
+        self.assertEqual(layout.total_length, 8)
+        single = {"a.mkv": {"": {"length": 3, "pieces root": b"\x01" * 32}}}
+        layout = metainfo.PieceLayout(bencode({"name": "a.mkv", "piece length": 16384, "meta version": 2, "file tree": single}))
+        self.assertEqual(layout.files, [("a.mkv", 3, 0, False)])
+
+    def test_hybrid_uses_v1_pieces(self) -> None:
+        tree = {"a.mkv": {"": {"length": 3, "pieces root": b"\x01" * 32}}}
+        info = {"name": "a.mkv", "piece length": 4, "meta version": 2, "file tree": tree, "pieces": b"\x01" * 20, "length": 3}
+        layout = metainfo.PieceLayout(bencode(info))
+        self.assertTrue(layout.verifiable)
+        self.assertEqual(layout.files, [("a.mkv", 3, 0, False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
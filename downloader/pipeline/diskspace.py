@@ -0,0 +1,66 @@
+from typing import Dict, Tuple, Optional
+import os
+import logging
+
+log = logging.getLogger("diskspace")
+
+
+def _existing(path: str) -> str:
+    """Download dirs may not exist until the first download, so the filesystem they will be on is that of their nearest existing parent"""
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def _device_of(path: str) -> int:
+    return os.stat(_existing(path)).st_dev
+
+
+def free_bytes(path: str) -> int:
+    """Bytes available to unprivileged users on the filesystem a path is (or will be) on"""
+    stats = os.statvfs(_existing(path))
+    return stats.f_bavail * stats.f_frsize
+
+
+class SpaceReservations(object):
+    """Space reserved on each filesystem for downloads from when they start transferring until they are moved into place.
+    Reservations are only released when a download finishes (rather than as its data lands on disk, which is already counted as used),
+    so admission errs on the side of waiting. Not thread safe; the scheduler calls it with its lock held
+    """
+
+    def __init__(self, min_free: int = 0):
+        self.min_free = min_free
+        self._reserved: Dict[int, int] = {}
+
+    def try_reserve(self, needs: Dict[str, int], free_cache: Dict[str, Tuple[int, int]]) -> Optional[Dict[int, int]]:
+        """Reserve bytes in each of the given directories if they all have room, returning the reservation (or None if something doesn't fit).
+        free_cache holds the filesystem and free space of each directory, so a single pass over the queue only checks each directory once
+        """
+        by_device: Dict[int, int] = {}
+        free: Dict[int, int] = {}
+        for directory, num_bytes in needs.items():
+            if directory not in free_cache:
+                try:
+                    free_cache[directory] = (_device_of(directory), free_bytes(directory))
+                except OSError:
+                    # Leave it to the transfer to fail with a more useful error
+                    log.debug(f"Could not check the free space of {directory}")
+                    continue
+            device, free_on_device = free_cache[directory]
+            free[device] = free_on_device
+            by_device[device] = by_device.get(device, 0) + num_bytes
+        for device, num_bytes in by_device.items():
+            if free[device] - self._reserved.get(device, 0) - num_bytes < self.min_free:
+                return None
+        for device, num_bytes in by_device.items():
+            self._reserved[device] = self._reserved.get(device, 0) + num_bytes
+        return by_device
+
+    def release(self, reservation: Dict[int, int]) -> None:
+        for device, num_bytes in reservation.items():
+            self._reserved[device] -= num_bytes
+            if not self._reserved[device]:
+                del self._reserved[device]
+
+    def reserved(self) -> int:
+        return sum(self._reserved.values())
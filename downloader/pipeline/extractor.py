@@ -0,0 +1,59 @@
+from typing import Any, Callable, List, Optional
+import os
+import logging
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from downloader.state import config
+
+log = logging.getLogger("extractor")
+
+# Shared by all downloads, so the total number of extract processes running at once is bounded
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = config.get_extract_workers() or os.cpu_count() or 1
+            log.debug(f"Starting extraction pool with {workers} workers")
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract")
+        return _executor
+
+
+def submit(task: Callable[..., Any], *args: Any) -> "Future[Any]":
+    """Run a task which extracts (i.e. a long-running extract process) on the extraction pool, so it counts towards its limit"""
+    return _get_executor().submit(task, *args)
+
+
+def _run_command(cmd: List[str]) -> None:
+    log.debug(f"running extract command: {cmd}")
+    subprocess.run(cmd, check=True)
+
+
+def run_commands(commands: List[List[str]]) -> None:
+    """Run independent extract commands concurrently on the extraction pool, and wait for them all to finish.
+    Raises the first failure (after all commands have finished)
+    """
+    futures = [_get_executor().submit(_run_command, cmd) for cmd in commands]
+    for future in futures:
+        future.exception()
+    for future in futures:
+        future.result()
+
+
+def _list_contents(cmd: List[str]) -> Optional[List[str]]:
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        log.debug(f"Could not list archive contents with {cmd}: {result.stderr.strip()}")
+        return None
+    return [line.rstrip("/") for line in result.stdout.splitlines() if line.strip()]
+
+
+def list_contents(commands: List[List[str]]) -> List[Optional[List[str]]]:
+    """Run archive listing commands concurrently on the extraction pool, returning the listed paths for each (or None if listing failed)"""
+    futures = [_get_executor().submit(_list_contents, cmd) for cmd in commands]
+    return [future.result() for future in futures]
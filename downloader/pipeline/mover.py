@@ -0,0 +1,220 @@
+from typing import Callable, Dict, List, Tuple, Optional
+import os
+import errno
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.model.manifest import Manifest
+from downloader.state import config
+from downloader.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Not available on windows
+    fcntl = None  # type: ignore
+
+log = logging.getLogger("mover")
+
+# ioctl which makes a file share the extents of another (reflink) on filesystems which support it (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+# Errors which mean a zero-copy method isn't supported for a pair of files, rather than the copy itself failing
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF}
+_PARTIAL_SUFFIX = ".rtd-partial"
+
+_lock = threading.Lock()
+# (temp dir, final dir) -> whether they are on the same filesystem, so a move is a rename
+_same_device: Dict[Tuple[str, str], bool] = {}
+# watch dir -> {"bytes_renamed": int, "bytes_copied": int, "bytes_direct": int}
+_stats: Dict[str, Dict[str, int]] = {}
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _collect_stats() -> Dict[Tuple[str, ...], float]:
+    with _lock:
+        return {(watch_dir, key[len("bytes_") :]): value for watch_dir, stats in _stats.items() for key, value in stats.items()}
+
+
+metrics.register_callback(
+    "rtd_move_bytes_total", "Bytes placed in final download dirs, by how they got there", "counter", ("watch_dir", "method"), _collect_stats
+)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.get_move_workers(), thread_name_prefix="move")
+        return _executor
+
+
+def is_same_device(temp_dir: str, final_dir: str) -> bool:
+    key = (temp_dir, final_dir)
+    with _lock:
+        same = _same_device.get(key)
+    if same is None:
+        same = os.stat(temp_dir).st_dev == os.stat(final_dir).st_dev
+        with _lock:
+            _same_device[key] = same
+    return same
+
+
+def probe_watch_dirs() -> None:
+    """Check which watch directories have their temp and final download directories on different filesystems, so it's known up front which moves will be copies"""
+    for watch_dir in config.get_torrent_watch_dirs():
+        temp_dir, final_dir = watch_dir["temp_download_dir"], watch_dir["final_download_dir"]
+        try:
+            same = is_same_device(temp_dir, final_dir)
+        except OSError:
+            log.exception(f"Could not check the filesystems of {temp_dir} and {final_dir}")
+            continue
+        if same:
+            log.info(f"{temp_dir} and {final_dir} are on the same filesystem; finished downloads will be renamed into place")
+        else:
+            log.info(f"{temp_dir} and {final_dir} are on different filesystems; finished downloads will be copied")
+
+
+def _record(watch_dir: str, key: str, num_bytes: int) -> Dict[str, int]:
+    with _lock:
+        stats = _stats.setdefault(watch_dir, {"bytes_renamed": 0, "bytes_copied": 0, "bytes_direct": 0})
+        stats[key] += num_bytes
+        return dict(stats)
+
+
+def record_direct(watch_dir: str, num_bytes: int) -> None:
+    """Record bytes which were transferred straight into the final download dir"""
+    stats = _record(watch_dir, "bytes_direct", num_bytes)
+    log.debug(f"Move stats for {watch_dir or 'unknown watch dir'}: {stats}")
+
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    """Get the number of bytes which were renamed, copied, or transferred directly into place, per watch dir"""
+    with _lock:
+        return {watch_dir: dict(stats) for watch_dir, stats in _stats.items()}
+
+
+def _try_reflink(src_fd: int, dst_fd: int) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+
+
+def _try_copy_file_range(src_fd: int, dst_fd: int, size: int) -> bool:
+    """Copy in-kernel with copy_file_range, which lets the filesystem (i.e. NFS server-side copy) avoid moving the data through userspace.
+    Returns False if it isn't supported at all; any unsupported error after the first chunk continues from the current file offsets
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            written = os.copy_file_range(src_fd, dst_fd, min(size - copied, 1 << 30))
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_ERRNOS and copied == 0:
+                return False
+            raise
+        if written == 0:
+            break
+        copied += written
+    return True
+
+
+def _copy_file(src: str, dst: str) -> int:
+    size = os.path.getsize(src)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if not _try_reflink(fsrc.fileno(), fdst.fileno()) and not _try_copy_file_range(fsrc.fileno(), fdst.fileno(), size):
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+    return size
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _copy_tree(src: str, dst: str) -> int:
+    """Copy src to dst, copying the files of a directory in parallel. Returns the number of bytes copied"""
+    if not os.path.isdir(src) or os.path.islink(src):
+        return _copy_file(src, dst)
+    manifest = Manifest.scan(src)
+    directories: List[str] = []
+    files: List[str] = []
+    # Sorted so parents are created before their contents
+    for relative_path in sorted(manifest.entries):
+        entry = manifest.entries[relative_path]
+        src_path = os.path.join(src, relative_path)
+        dst_path = os.path.join(dst, relative_path)
+        if entry.is_dir:
+            os.makedirs(dst_path, exist_ok=True)
+            directories.append(relative_path)
+        elif entry.is_file:
+            files.append(relative_path)
+        elif os.path.islink(src_path):
+            os.symlink(os.readlink(src_path), dst_path)
+    copied = sum(_get_executor().map(lambda relative_path: _copy_file(os.path.join(src, relative_path), os.path.join(dst, relative_path)), files))
+    # Copy directory metadata last (deepest first), since copying files into them changes their mtimes
+    for relative_path in reversed(directories):
+        shutil.copystat(os.path.join(src, relative_path), os.path.join(dst, relative_path))
+    return copied
+
+
+def remove_source(src: str) -> None:
+    """Remove what is left of a download whose copy into place finished (see move's placed), if it wasn't removed already"""
+    if os.path.lexists(src):
+        log.info(f"Removing {src}, which was already copied into place")
+        _remove(src)
+
+
+def move(src: str, final_dir: str, watch_dir: str, size: int, placed: Optional[Callable[[], None]] = None) -> None:
+    """Move a finished download into final_dir. Within a filesystem this is a rename; across filesystems the data is copied
+    (zero-copy where possible) to a partial name first, so nothing half-copied ever appears in final_dir.
+    size is the size of the download, only used for stats when it is renamed.
+    placed is called as soon as the download is complete in final_dir (before a copy's source is removed), so whoever records that
+    can finish an interrupted move with remove_source rather than ever mistaking an existing destination for a finished move
+    """
+    target = os.path.join(final_dir, os.path.basename(src))
+    if os.path.lexists(target):
+        raise Exception(f"Destination path {target} already exists")
+    temp_dir = os.path.dirname(src)
+    if is_same_device(temp_dir, final_dir):
+        try:
+            os.rename(src, target)
+            if placed is not None:
+                placed()
+            stats = _record(watch_dir, "bytes_renamed", size)
+            log.debug(f"Renamed {src} into {final_dir}. Move stats for {watch_dir or 'unknown watch dir'}: {stats}")
+            return
+        except OSError as e:
+            # i.e. separate bind mounts of the same filesystem
+            if e.errno != errno.EXDEV:
+                raise
+            with _lock:
+                _same_device[(temp_dir, final_dir)] = False
+    partial = target + _PARTIAL_SUFFIX
+    if os.path.lexists(partial):
+        # Left behind by an interrupted copy
+        _remove(partial)
+    log.info(f"Copying {src} to {final_dir} across filesystems")
+    try:
+        copied = _copy_tree(src, partial)
+        os.rename(partial, target)
+    except BaseException:
+        if os.path.lexists(partial):
+            _remove(partial)
+        raise
+    if placed is not None:
+        placed()
+    _remove(src)
+    stats = _record(watch_dir, "bytes_copied", copied)
+    log.info(f"Copied {copied} bytes from {src} into {final_dir}. Move stats for {watch_dir or 'unknown watch dir'}: {stats}")
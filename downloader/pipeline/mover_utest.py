@@ -0,0 +1,137 @@
+from typing import List
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.pipeline import mover
+from downloader.state import state
+
+
+class MoverTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        self.temp_dir = os.path.join(self.workdir, "move_temp")
+        self.final_dir = os.path.join(self.workdir, "move_final")
+        os.makedirs(self.temp_dir)
+        os.makedirs(self.final_dir)
+        self.src = os.path.join(self.temp_dir, "Show")
+        os.makedirs(os.path.join(self.src, "sub"))
+        with open(os.path.join(self.src, "a.mkv"), "wb") as f:
+            f.write(b"a" * 1000)
+        with open(os.path.join(self.src, "sub", "b.nfo"), "wb") as f:
+            f.write(b"b")
+        os.symlink("a.mkv", os.path.join(self.src, "link"))
+        self.target = os.path.join(self.final_dir, "Show")
+        mover._same_device.clear()
+        self.addCleanup(mover._same_device.clear)
+
+    def _assert_moved(self) -> None:
+        self.assertFalse(os.path.lexists(self.src))
+        with open(os.path.join(self.target, "a.mkv"), "rb") as f:
+            self.assertEqual(f.read(), b"a" * 1000)
+        with open(os.path.join(self.target, "sub", "b.nfo"), "rb") as f:
+            self.assertEqual(f.read(), b"b")
+        self.assertEqual(os.readlink(os.path.join(self.target, "link")), "a.mkv")
+        self.assertEqual(os.listdir(self.final_dir), ["Show"])
+
+    def _copy(self) -> None:
+        """Move as if temp and final dirs were on different filesystems"""
+        mover._same_device[(self.temp_dir, self.final_dir)] = False
+        mover.move(self.src, self.final_dir, "", 0)
+
+    def test_rename_within_a_filesystem(self) -> None:
+        with mock.patch.object(mover, "_copy_tree") as copy_tree:
+            mover.move(self.src, self.final_dir, "", 1001)
+        copy_tree.assert_not_called()
+        self._assert_moved()
+
+    def test_cross_device_rename_falls_back_to_copy(self) -> None:
+        rename = os.rename
+
+        def cross_device_rename(src: str, dst: str) -> None:
+            if src == self.src:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(src, dst)
+
+        with mock.patch("os.rename", cross_device_rename):
+            mover.move(self.src, self.final_dir, "", 0)
+        self._assert_moved()
+        # Later moves go straight to copying
+        self.assertFalse(mover._same_device[(self.temp_dir, self.final_dir)])
+
+    def test_copy_with_reflink(self) -> None:
+        with (
+            mock.patch.object(mover, "_try_reflink", return_value=True) as reflink,
+            mock.patch.object(mover, "_try_copy_file_range") as copy_file_range,
+        ):
+            self._copy()
+        self.assertEqual(reflink.call_count, 2)
+        copy_file_range.assert_not_called()
+        # The mocked reflink wrote nothing
+        self.assertEqual(os.path.getsize(os.path.join(self.target, "a.mkv")), 0)
+
+    def test_copy_falls_back_to_copy_file_range(self) -> None:
+        if not hasattr(os, "copy_file_range"):
+            self.skipTest("copy_file_range is not available")
+        with mock.patch.object(mover, "_try_reflink", return_value=False), mock.patch("shutil.copyfileobj") as copyfileobj:
+            self._copy()
+        copyfileobj.assert_not_called()
+        self._assert_moved()
+
+    def test_copy_falls_back_to_copying_through_userspace(self) -> None:
+        def unsupported(*args: object) -> int:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        with mock.patch.object(mover, "_try_reflink", return_value=False), mock.patch("os.copy_file_range", unsupported, create=True):
+            self._copy()
+        self._assert_moved()
+
+    def test_failed_copy_leaves_no_partial(self) -> None:
+        with mock.patch.object(mover, "_copy_file", side_effect=OSError(errno.ENOSPC, "No space left on device")):
+            with self.assertRaises(OSError):
+                self._copy()
+        self.assertEqual(os.listdir(self.final_dir), [])
+        self.assertTrue(os.path.exists(os.path.join(self.src, "a.mkv")))
+
+    def test_partial_from_an_interrupted_copy_is_replaced(self) -> None:
+        os.makedirs(self.target + mover._PARTIAL_SUFFIX)
+        with open(os.path.join(self.target + mover._PARTIAL_SUFFIX, "stale"), "wb") as f:
+            f.write(b"stale")
+        self._copy()
+        self._assert_moved()
+        self.assertFalse(os.path.exists(os.path.join(self.target, "stale")))
+
+    def test_existing_target_is_not_replaced(self) -> None:
+        os.makedirs(self.target)
+        with self.assertRaises(Exception):
+            mover.move(self.src, self.final_dir, "", 0)
+        self.assertEqual(os.listdir(self.target), [])
+        self.assertTrue(os.path.exists(self.src))
+
+    def test_placed_is_called_before_the_source_is_removed(self) -> None:
+        calls: List[bool] = []
+
+        def placed() -> None:
+            calls.append(os.path.exists(self.src) and os.path.exists(os.path.join(self.target, "a.mkv")))
+
+        mover._same_device[(self.temp_dir, self.final_dir)] = False
+        mover.move(self.src, self.final_dir, "", 0, placed)
+        self.assertEqual(calls, [True])
+        self.assertFalse(os.path.exists(self.src))
+
+    def test_remove_source(self) -> None:
+        mover.remove_source(self.src)
+        self.assertFalse(os.path.lexists(self.src))
+        # Nothing left to remove
+        mover.remove_source(self.src)
+
+
+if __name__ == "__main__":
+    unittest.main()
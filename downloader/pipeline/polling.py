@@ -0,0 +1,93 @@
+from typing import Dict, Set, Any, Iterable
+import time
+import logging
+import threading
+
+from downloader.model.download_obj import is_early_transfer
+
+log = logging.getLogger("polling")
+
+# Torrents due within this fraction of their interval are checked along with the ones which are due, so checks are coalesced into fewer polls
+_COALESCE_FRACTION = 0.25
+
+
+class PollSchedule(object):
+    """When each watched torrent is next checked for completion, planned from the ETA its torrent client reported when it was last checked.
+    A torrent is checked again at half its ETA (or right at it, once close), so checks converge on its completion. Torrents without an ETA
+    (stalled, queued, or complete and waiting to be downloaded or retried) back off exponentially from the idle interval.
+    Torrents which were never checked are due immediately
+    """
+
+    def __init__(self, idle_interval: float, min_interval: float, max_interval: float):
+        self.idle_interval = idle_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._due_at: Dict[str, float] = {}
+        self._intervals: Dict[str, float] = {}
+        # Torrents without an ETA, and the interval they were last checked at
+        self._backoff: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._woken = False
+
+    def _forget(self, infohash: str) -> None:
+        self._due_at.pop(infohash, None)
+        self._intervals.pop(infohash, None)
+        self._backoff.pop(infohash, None)
+
+    def due(self, watching_torrents: Dict[str, Dict[str, Any]], now: float) -> Set[str]:
+        """Watched torrents which should be checked now"""
+        with self._cond:
+            for infohash in [infohash for infohash in self._due_at if infohash not in watching_torrents]:
+                self._forget(infohash)
+            return {
+                infohash
+                for infohash in watching_torrents
+                if infohash not in self._due_at or self._due_at[infohash] - now <= self._intervals[infohash] * _COALESCE_FRACTION
+            }
+
+    def _interval(self, infohash: str, eta: float) -> float:
+        if eta > 0:
+            self._backoff.pop(infohash, None)
+            # Once an ETA is within two checks, check right when it should complete
+            return eta if eta <= 2 * self.min_interval else eta / 2
+        interval = self._backoff[infohash] * 2 if infohash in self._backoff else self.idle_interval
+        self._backoff[infohash] = min(interval, self.max_interval)
+        return interval
+
+    def plan(self, watching_torrents: Dict[str, Dict[str, Any]], checked: Iterable[str], etas: Dict[str, float], now: float) -> None:
+        """Plan the next check of each checked torrent from its ETA in seconds (missing, 0 or negative if it has none)"""
+        with self._cond:
+            for infohash in checked:
+                if infohash not in watching_torrents:
+                    continue
+                interval = min(max(self._interval(infohash, etas.get(infohash, -1.0)), self.min_interval), self.max_interval)
+                if is_early_transfer(watching_torrents[infohash]):
+                    # Files can complete long before the whole torrent does
+                    interval = min(interval, self.idle_interval)
+                self._due_at[infohash] = now + interval
+                self._intervals[infohash] = interval
+
+    def seconds_until_next(self, now: float) -> float:
+        with self._cond:
+            if not self._due_at:
+                return self.idle_interval
+            return min(max(0.0, min(self._due_at.values()) - now), self.max_interval)
+
+    def check_soon(self, infohashes: Iterable[str]) -> None:
+        """Check the given torrents (i.e. which were just added) on the next poll, and wake the poll stage for it"""
+        with self._cond:
+            for infohash in infohashes:
+                self._forget(infohash)
+            self._woken = True
+            self._cond.notify_all()
+
+    def wait(self, timeout: float) -> None:
+        """Sleep until the next poll is due, or check_soon is called"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._woken:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._woken = False
@@ -0,0 +1,96 @@
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from downloader.benchmark import fakes
+from downloader.pipeline.polling import PollSchedule
+from downloader.state import config
+from downloader.state import state
+
+_A = "a" * 40
+_B = "b" * 40
+
+
+class PollScheduleTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        self.schedule = PollSchedule(idle_interval=60, min_interval=10, max_interval=3600)
+        self.watching = {_A: {"watch_dir": ""}, _B: {"watch_dir": ""}}
+
+    def _next_interval(self, infohash: str, eta: float) -> float:
+        self.schedule.plan(self.watching, [infohash], {infohash: eta}, 1000)
+        return self.schedule._due_at[infohash] - 1000
+
+    def test_new_torrents_are_due(self) -> None:
+        self.assertEqual(self.schedule.due(self.watching, 0), {_A, _B})
+
+    def test_checked_at_half_the_eta(self) -> None:
+        self.assertEqual(self._next_interval(_A, 600), 300)
+
+    def test_checked_at_the_eta_once_close(self) -> None:
+        self.assertEqual(self._next_interval(_A, 15), 15)
+
+    def test_interval_is_clamped(self) -> None:
+        self.assertEqual(self._next_interval(_A, 4), 10)
+        self.assertEqual(self._next_interval(_A, 86400), 3600)
+
+    def test_torrents_without_eta_back_off(self) -> None:
+        self.assertEqual([self._next_interval(_A, 0) for _ in range(8)], [60, 120, 240, 480, 960, 1920, 3600, 3600])
+        # An ETA ends the backoff
+        self.assertEqual(self._next_interval(_A, 600), 300)
+        self.assertEqual(self._next_interval(_A, -1), 60)
+
+    def test_missing_eta_backs_off(self) -> None:
+        self.schedule.plan(self.watching, [_A], {}, 1000)
+        self.assertEqual(self.schedule._due_at[_A], 1060)
+
+    def test_due(self) -> None:
+        self.schedule.plan(self.watching, [_A, _B], {_A: 200, _B: 2000}, 0)
+        self.assertEqual(self.schedule.due(self.watching, 50), set())
+        self.assertEqual(self.schedule.due(self.watching, 100), {_A})
+        self.assertEqual(self.schedule.seconds_until_next(50), 50)
+
+    def test_checks_due_soon_are_coalesced(self) -> None:
+        self.schedule.plan(self.watching, [_A, _B], {_A: 200, _B: 220}, 0)
+        # _B is due at 110, within a quarter of its interval of _A's check
+        self.assertEqual(self.schedule.due(self.watching, 100), {_A, _B})
+
+    def test_unwatched_torrents_are_forgotten(self) -> None:
+        self.schedule.plan(self.watching, [_A, _B], {_A: 200, _B: 200}, 0)
+        del self.watching[_B]
+        self.assertEqual(self.schedule.due(self.watching, 0), set())
+        self.assertNotIn(_B, self.schedule._due_at)
+        # And never planned after a poll which raced with their removal
+        self.schedule.plan(self.watching, [_B], {_B: 200}, 0)
+        self.assertNotIn(_B, self.schedule._due_at)
+
+    def test_early_transfer_torrents_are_checked_at_least_every_idle_interval(self) -> None:
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        watch_dir["early_transfer"] = True
+        self.watching[_A] = {"watch_dir": watch_dir["directory"]}
+        self.assertEqual(self._next_interval(_A, 7200), 60)
+
+    def test_seconds_until_next(self) -> None:
+        self.assertEqual(self.schedule.seconds_until_next(0), 60)
+        self.schedule.plan(self.watching, [_A], {_A: 200}, 0)
+        self.assertEqual(self.schedule.seconds_until_next(500), 0)
+
+    def test_check_soon(self) -> None:
+        self.schedule.plan(self.watching, [_A], {_A: 2000}, 0)
+        self.assertEqual(self.schedule.due(self.watching, 0), {_B})
+        thread = threading.Timer(0.05, self.schedule.check_soon, [[_A]])
+        thread.start()
+        self.addCleanup(thread.join)
+        start = time.monotonic()
+        self.schedule.wait(10)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.schedule.due(self.watching, 0), {_A, _B})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+from typing import List, Dict, Set, Tuple, Optional
+import re
+import os
+import codecs
+import logging
+import threading
+import posixpath
+import contextlib
+import subprocess
+from concurrent.futures import Future
+
+from downloader.pipeline import extractor
+
+log = logging.getLogger("rar_stream")
+
+# Volume naming schemes, checked in order: name.part01.rar, name.001.rar, name.rar + name.r00
+_part_volume_regex = re.compile(r"^(?P<base>.+)\.part(?P<num>\d+)\.rar$", re.IGNORECASE)
+_digit_volume_regex = re.compile(r"^(?P<base>.+)\.(?P<num>\d{1,3})\.rar$", re.IGNORECASE)
+_first_old_volume_regex = re.compile(r"^(?P<base>.+)\.rar$", re.IGNORECASE)
+_old_volume_regex = re.compile(r"^(?P<base>.+)\.r(?P<num>\d{1,3})$", re.IGNORECASE)
+_extracting_from_regex = re.compile(r"^Extracting from (?P<path>.+)$")
+# unrar asks for a volume which isn't present with "Insert disk with <volume>", then "[C]ontinue, [Q]uit" (without a newline)
+_volume_prompt_regex = re.compile(r"Insert disk with (?P<path>.+?)\s*\[C\]ontinue, \[Q\]uit\s*$")
+# Any other question, such as the choices for overwriting a file, or a password
+_prompt_regex = re.compile(r"\[[A-Z]\][a-z]+\s*$|password.*:\s*$", re.IGNORECASE)
+
+
+def _volume_key(path: str) -> Optional[Tuple[Tuple[str, str, str], int]]:
+    """Get ((directory, base name, naming scheme), order within the set) for a rar volume, or None if path is not a rar volume"""
+    directory, name = posixpath.split(path)
+    match = _part_volume_regex.match(name)
+    if match:
+        return (directory, match.group("base"), "part"), int(match.group("num"))
+    match = _digit_volume_regex.match(name)
+    if match:
+        return (directory, match.group("base"), "digit"), int(match.group("num"))
+    match = _first_old_volume_regex.match(name)
+    if match:
+        return (directory, match.group("base"), "old"), -1
+    match = _old_volume_regex.match(name)
+    if match:
+        return (directory, match.group("base"), "old"), int(match.group("num"))
+    return None
+
+
+def find_volume_sets(paths: List[str]) -> List[List[str]]:
+    """Group the rar volumes among paths into sets, each ordered from the first volume to the last"""
+    sets: Dict[Tuple[str, str, str], List[Tuple[int, str]]] = {}
+    for path in paths:
+        key = _volume_key(path)
+        if key:
+            sets.setdefault(key[0], []).append((key[1], path))
+    volume_sets = []
+    for (_, _, scheme), volumes in sets.items():
+        volumes.sort()
+        # Without the first volume (.rar for the old scheme, otherwise number 0 or 1) there is nothing to start extracting with
+        if (scheme == "old" and volumes[0][0] != -1) or (scheme != "old" and volumes[0][0] > 1):
+            continue
+        volume_sets.append([path for _, path in volumes])
+    return volume_sets
+
+
+class StreamExtractionError(Exception):
+    """Raised when a rar set could not be extracted while streaming, so it should be extracted normally once all of its volumes are present"""
+
+
+class RarStreamExtractor(object):
+    """Extracts a multipart rar set while its volumes are still arriving, as a task on the extraction pool.
+    unrar is started as soon as the first volume is present. When it reaches a volume which doesn't exist yet it asks whether to continue,
+    which is answered (once) as soon as that volume is available. Any other question (i.e. for a password), or being asked again for a
+    volume which is present, fails the extraction
+    """
+
+    def __init__(self, volume_paths: List[str], extract_dir: str, delete_consumed: bool):
+        self.volume_paths = volume_paths
+        self.extract_dir = extract_dir
+        self.delete_consumed = delete_consumed
+        self._volume_indexes = {os.path.abspath(path): i for i, path in enumerate(volume_paths)}
+        self._lock = threading.Lock()
+        self._future: Optional["Future[int]"] = None
+        self._process: Optional["subprocess.Popen[bytes]"] = None
+        self._ready = 0
+        # The volume unrar is waiting for, and the volumes it was told are present
+        self._asking: Optional[int] = None
+        self._answered: Set[int] = set()
+        self._error = ""
+        self._aborted = False
+
+    def _fail(self, error: str) -> None:
+        """Must be called with the lock held"""
+        if not self._error:
+            log.warning(f"Streaming extraction of {self.volume_paths[0]} failed: {error}")
+            self._error = error
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+
+    def _answer_if_ready(self) -> None:
+        """Must be called with the lock held"""
+        if self._asking is None or self._asking >= self._ready or self._process is None or self._process.stdin is None:
+            return
+        log.debug(f"Continuing extraction with {self.volume_paths[self._asking]}")
+        self._answered.add(self._asking)
+        self._asking = None
+        try:
+            self._process.stdin.write(b"C\n")
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+    def _handle_line(self, line: str) -> None:
+        if line:
+            log.debug(f"unrar: {line}")
+        match = _extracting_from_regex.match(line)
+        if match and self.delete_consumed:
+            current = self._volume_indexes.get(os.path.abspath(match.group("path")), 0)
+            # unrar never goes back to an earlier volume, so those can be removed to free disk space
+            for path in self.volume_paths[:current]:
+                if os.path.exists(path):
+                    log.debug(f"Removing consumed rar volume {path}")
+                    os.remove(path)
+
+    def _handle_prompt(self, last_line: str, prompt: str) -> bool:
+        """Handle what unrar printed without finishing the line, returning whether it was a question"""
+        volume_prompt = _volume_prompt_regex.search(f"{last_line} {prompt}")
+        with self._lock:
+            if volume_prompt:
+                index = self._volume_indexes.get(os.path.abspath(volume_prompt.group("path")))
+                if index is None:
+                    self._fail(f"unrar asked for {volume_prompt.group('path')}, which is not a volume of the set")
+                elif index in self._answered:
+                    self._fail(f"unrar could not continue with {volume_prompt.group('path')}")
+                else:
+                    self._asking = index
+                    self._answer_if_ready()
+                return True
+            if _prompt_regex.search(prompt):
+                self._fail(f"unrar asked {last_line} {prompt}".strip())
+                return True
+        return False
+
+    def _run(self) -> int:
+        with self._lock:
+            if self._aborted:
+                return -1
+            log.info(f"Starting streaming extraction of {self.volume_paths[0]}")
+            # Without -y unrar asks before going on to a volume which isn't present yet. -p- makes it fail rather than ask for a password,
+            # and -idp leaves out the progress percentages, so whatever it prints without a newline is a question
+            self._process = subprocess.Popen(
+                ["unrar", "x", "-o+", "-p-", "-idp", self.volume_paths[0], self.extract_dir],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        assert self._process.stdout is not None
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+        last_line = ""
+        while True:
+            # Read whatever is available rather than whole lines, since questions don't end with a newline
+            data = os.read(self._process.stdout.fileno(), 4096)
+            if not data:
+                break
+            pending += decoder.decode(data)
+            *lines, pending = pending.replace("\r", "").split("\n")
+            for line in lines:
+                self._handle_line(line.strip())
+                if line.strip():
+                    last_line = line.strip()
+            if pending.strip() and self._handle_prompt(last_line, pending.strip()):
+                pending = ""
+        returncode = self._process.wait()
+        self._process.stdout.close()
+        if self._process.stdin is not None:
+            with contextlib.suppress(OSError):
+                self._process.stdin.close()
+        return returncode
+
+    def volume_ready(self) -> None:
+        """Signal that the next volume (in order) has been fully written"""
+        with self._lock:
+            self._ready += 1
+            if self._future is None:
+                self._future = extractor.submit(self._run)
+            else:
+                self._answer_if_ready()
+
+    def finish(self) -> None:
+        """Wait for extraction to complete, raising StreamExtractionError if it failed"""
+        if self._future is None:
+            raise StreamExtractionError(f"Streaming extraction of {self.volume_paths[0]} was never started")
+        try:
+            returncode = self._future.result()
+        except Exception as e:
+            raise StreamExtractionError(f"Could not run unrar: {e}") from e
+        if self._error:
+            raise StreamExtractionError(self._error)
+        if returncode != 0:
+            raise StreamExtractionError(f"unrar exited with status {returncode}")
+
+    def abort(self) -> None:
+        with self._lock:
+            self._aborted = True
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+        if self._future is not None and not self._future.cancel():
+            with contextlib.suppress(Exception):
+                self._future.result()
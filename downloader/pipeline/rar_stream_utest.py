@@ -0,0 +1,125 @@
+from typing import List
+import os
+import sys
+import time
+import shutil
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.pipeline import rar_stream
+from downloader.state import state
+
+# Stands in for unrar: goes through the volumes listed in its environment, asking like unrar does for each one which isn't there yet
+_FAKE_UNRAR = textwrap.dedent("""\
+    import os
+    import sys
+
+    volumes = os.environ["FAKE_UNRAR_VOLUMES"].split(os.pathsep)
+    extract_dir = sys.argv[-1]
+    if os.environ.get("FAKE_UNRAR_QUESTION"):
+        sys.stdout.write(os.environ["FAKE_UNRAR_QUESTION"])
+        sys.stdout.flush()
+        sys.exit(0 if sys.stdin.readline() else 3)
+    for volume in volumes:
+        while not os.path.exists(volume):
+            sys.stdout.write(f"\\nInsert disk with {volume}\\n [C]ontinue, [Q]uit ")
+            sys.stdout.flush()
+            if sys.stdin.readline().strip() != "C":
+                sys.exit(255)
+        print(f"Extracting from {volume}")
+        print(f"Extracting  {os.path.basename(volume)}.out      OK")
+        with open(os.path.join(extract_dir, os.path.basename(volume) + ".out"), "w") as f:
+            f.write("extracted")
+    print("All OK")
+    """)
+
+
+class RarStreamExtractorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(bin_dir)
+        unrar = os.path.join(bin_dir, "unrar")
+        with open(unrar, "w") as f:
+            f.write(f"#!{sys.executable}\n{_FAKE_UNRAR}")
+        os.chmod(unrar, 0o755)
+        self.volumes = [os.path.join(self.workdir, f"a.part{i}.rar") for i in range(1, 4)]
+        environ = mock.patch.dict(
+            os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"], "FAKE_UNRAR_VOLUMES": os.pathsep.join(self.volumes)}
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def _extractor(self, delete_consumed: bool) -> rar_stream.RarStreamExtractor:
+        stream_extractor = rar_stream.RarStreamExtractor(self.volumes, self.workdir, delete_consumed)
+        # Never leave unrar waiting on the extraction pool
+        self.addCleanup(stream_extractor.abort)
+        return stream_extractor
+
+    def _write(self, path: str) -> None:
+        with open(path, "w") as f:
+            f.write("volume")
+
+    def _extracted(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.workdir) if name.endswith(".out"))
+
+    def test_volumes_are_extracted_as_they_arrive(self) -> None:
+        stream_extractor = self._extractor(True)
+        for volume in self.volumes:
+            self._write(volume)
+            stream_extractor.volume_ready()
+        stream_extractor.finish()
+        self.assertEqual(self._extracted(), ["a.part1.rar.out", "a.part2.rar.out", "a.part3.rar.out"])
+        # Consumed volumes were removed, but never the one unrar could still be reading
+        self.assertEqual([os.path.exists(volume) for volume in self.volumes], [False, False, True])
+
+    def test_question_is_answered_once_the_volume_arrives(self) -> None:
+        stream_extractor = self._extractor(False)
+        self._write(self.volumes[0])
+        stream_extractor.volume_ready()
+        # Wait for unrar to ask for the second volume before it exists
+        deadline = time.monotonic() + 10
+        while stream_extractor._asking != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(stream_extractor._asking, 1)
+        for volume in self.volumes[1:]:
+            self._write(volume)
+            stream_extractor.volume_ready()
+        stream_extractor.finish()
+        self.assertIn(1, stream_extractor._answered)
+        self.assertEqual(len(self._extracted()), 3)
+
+    def test_volume_which_is_asked_for_again_fails(self) -> None:
+        stream_extractor = self._extractor(False)
+        self._write(self.volumes[0])
+        stream_extractor.volume_ready()
+        # Reported as present, but unrar can't find (or use) it
+        stream_extractor.volume_ready()
+        with self.assertRaises(rar_stream.StreamExtractionError):
+            stream_extractor.finish()
+
+    def test_other_questions_fail(self) -> None:
+        for question in ("Enter password (will not be echoed) for a.mkv: ", "\na.mkv already exists. Overwrite it ?\n[Y]es, [N]o, [A]ll "):
+            with self.subTest(question=question), mock.patch.dict(os.environ, {"FAKE_UNRAR_QUESTION": question}):
+                stream_extractor = self._extractor(False)
+                self._write(self.volumes[0])
+                stream_extractor.volume_ready()
+                with self.assertRaises(rar_stream.StreamExtractionError):
+                    stream_extractor.finish()
+
+    def test_abort(self) -> None:
+        stream_extractor = self._extractor(False)
+        self._write(self.volumes[0])
+        stream_extractor.volume_ready()
+        stream_extractor.abort()
+        self.assertIsNotNone(stream_extractor._future)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,462 @@
+from typing import List, Dict, Set, Tuple, Iterator, Optional
+import time
+import bisect
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.model.download_obj import DownloadObject, transfer_batch
+from downloader.pipeline.diskspace import SpaceReservations
+from downloader.state import config
+from downloader.state import state
+from downloader.transfer import tuning
+from downloader.transfer import engine as transfer_engine
+from downloader.metrics import metrics
+
+log = logging.getLogger("scheduler")
+
+# Single files at the root of a torrent smaller than this are transferred together with the torrent's other small root files
+_BATCH_MAX_FILE_SIZE = 16 << 20
+_BATCH_MAX_FILES = 200
+# Seconds between checks of whether downloads waiting for disk space fit yet (space can be freed by anything, so it isn't notified)
+_SPACE_RECHECK_INTERVAL = 30.0
+
+
+def _object_key(obj: DownloadObject) -> Tuple[str, str]:
+    return (obj.infohash, obj.remote_path)
+
+
+def _is_batchable(obj: DownloadObject) -> bool:
+    return not obj.directory and len(obj.files) == 1 and obj.files[0][1] < _BATCH_MAX_FILE_SIZE
+
+
+def _size(obj: DownloadObject) -> int:
+    return sum(size for _, size in obj.files)
+
+
+class DownloadScheduler(object):
+    """Runs transfers on a pool of worker threads, then hands transferred objects to a separate post-processing pool
+    (extract, chmod, move) so the next transfer can start immediately.
+    Limits the total number of sftp connections used across all transfers (including those idle sessions keep open for reuse), and the number
+    of concurrent transfers per watch directory.
+    Small root files of the same torrent are transferred as one batch, and a torrent stops being watched once all of its objects are done.
+    Downloads only start once their download dirs have room for them (including extracted files); until then they wait in the queue.
+    Partial objects (files of incomplete torrents, see early_transfer) are only transferred, and the completed objects of their torrent
+    wait for them to finish.
+    Queued objects are grouped into classes by priority (of their torrent, or otherwise their watch dir) and watch dir. Higher priority
+    classes always go first. Within a priority, watch dirs share transfers in proportion to their weights by bytes started (a watch dir
+    which is furthest behind its share goes next), so a large backlog in one watch dir doesn't hold up the others.
+    Within a class objects are started in the order they were queued ('fifo'), or smallest first ('sjf')
+    """
+
+    workers: int
+    max_connections: int
+    watch_dir_limits: Dict[str, int]
+    watch_dir_priorities: Dict[str, int]
+    watch_dir_weights: Dict[str, float]
+    policy: str
+
+    def __init__(
+        self,
+        workers: int,
+        max_connections: int = 0,
+        watch_dir_limits: Optional[Dict[str, int]] = None,
+        post_process_workers: int = 2,
+        min_free_space: int = 0,
+        watch_dir_priorities: Optional[Dict[str, int]] = None,
+        watch_dir_weights: Optional[Dict[str, float]] = None,
+        policy: str = "fifo",
+    ):
+        self.workers = workers
+        self.max_connections = max_connections
+        self.watch_dir_limits = watch_dir_limits or {}
+        self.watch_dir_priorities = watch_dir_priorities or {}
+        self.watch_dir_weights = watch_dir_weights or {}
+        self.policy = policy
+        self._post_process_executor = ThreadPoolExecutor(max_workers=post_process_workers, thread_name_prefix="post-process")
+        self._cond = threading.Condition()
+        # Queued objects per (priority, watch dir) class, and when each object was queued
+        self._queues: Dict[Tuple[int, str], List[DownloadObject]] = {}
+        self._queued_at: Dict[Tuple[str, str], float] = {}
+        # Bytes started per watch dir divided by its weight, and that of the watch dir which last started a transfer.
+        # A watch dir with nothing queued catches up to the latter when it next queues something, so it can't bank its idle time
+        self._service: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        # Objects which are queued, transferring, or post-processing, used to avoid scheduling the same object twice
+        self._pending: Set[Tuple[str, str]] = set()
+        self._connections_in_use = 0
+        self._active_per_watch_dir: Dict[str, int] = {}
+        self._space = SpaceReservations(min_free_space)
+        # Disk space reserved by each object from when its transfer starts until it is finished, and the objects waiting for space
+        self._reservations: Dict[Tuple[str, str], Dict[int, int]] = {}
+        # Space each queued object needs, which is looked up (in state and on disk) before it is queued rather than with the lock held
+        self._space_needs: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._waiting_for_space: Set[Tuple[str, str]] = set()
+        # Per infohash: number of objects not yet done, whether any of them failed, and remote paths of the objects which succeeded
+        self._outstanding: Dict[str, int] = {}
+        self._failed: Set[str] = set()
+        self._done: Dict[str, Set[str]] = {}
+        # Partial objects which are queued or transferring (also counted per infohash), and remote paths of those which were transferred
+        self._partials_pending: Set[Tuple[str, str]] = set()
+        self._partials_in_flight: Dict[str, int] = {}
+        self._partials_done: Dict[str, Set[str]] = {}
+        # Completed objects which were submitted while a partial object of the same file was in flight, queued once it finishes
+        self._deferred: Dict[Tuple[str, str], DownloadObject] = {}
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        metrics.register_callback(
+            "rtd_queue_depth", "Number of downloads waiting for a transfer slot", "gauge", (), lambda: {(): self._queue_depth()}
+        )
+        metrics.register_callback(
+            "rtd_queue_depth_by_class",
+            "Number of downloads waiting for a transfer slot per watch dir and priority",
+            "gauge",
+            ("watch_dir", "priority"),
+            self._collect_queued,
+        )
+        metrics.register_callback("rtd_transfers_active", "Number of running transfers per watch dir", "gauge", ("watch_dir",), self._collect_active)
+        metrics.register_callback(
+            "rtd_sftp_connections_in_use",
+            "Number of sftp connections reserved by running transfers",
+            "gauge",
+            (),
+            lambda: {(): self._connections_in_use},
+        )
+        metrics.register_callback(
+            "rtd_downloads_pending",
+            "Number of downloads which are queued, transferring, or post-processing",
+            "gauge",
+            (),
+            lambda: {(): len(self._pending)},
+        )
+        metrics.register_callback(
+            "rtd_downloads_waiting_for_space",
+            "Number of queued downloads which don't fit in their download dirs yet",
+            "gauge",
+            (),
+            lambda: {(): len(self._waiting_for_space)},
+        )
+        metrics.register_callback(
+            "rtd_disk_space_reserved_bytes", "Bytes of disk space reserved by running downloads", "gauge", (), lambda: {(): self._space.reserved()}
+        )
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"download-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log.info(f"Started {self.workers} download workers (max sftp connections: {self.max_connections or 'unlimited'})")
+
+    def _queue_depth(self) -> int:
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _collect_queued(self) -> Dict[Tuple[str, ...], float]:
+        with self._cond:
+            return {(watch_dir, str(priority)): len(queue) for (priority, watch_dir), queue in self._queues.items()}
+
+    def _enqueue(self, obj: DownloadObject, priority: Optional[int], space_needs: Dict[str, int]) -> None:
+        """Must be called with the condition lock held"""
+        if priority is None:
+            priority = self.watch_dir_priorities.get(obj.watch_dir, 0)
+        if not any(queue for (_, watch_dir), queue in self._queues.items() if watch_dir == obj.watch_dir):
+            self._service[obj.watch_dir] = max(self._service.get(obj.watch_dir, 0.0), self._virtual_time)
+        self._space_needs[_object_key(obj)] = space_needs
+        queue = self._queues.setdefault((priority, obj.watch_dir), [])
+        if self.policy == "sjf":
+            # After any queued objects of the same size, so ties stay in the order they were queued
+            bisect.insort_right(queue, obj, key=_size)
+        else:
+            queue.append(obj)
+        self._queued_at[_object_key(obj)] = time.monotonic()
+
+    def _may_queue(self, obj: DownloadObject) -> bool:
+        """Whether submitting an object could queue it. Must be called with the condition lock held"""
+        key = _object_key(obj)
+        if key in self._pending:
+            return False
+        if obj.partial:
+            return obj.remote_path not in self._partials_done.get(obj.infohash, ())
+        # Objects which succeeded while others of their torrent failed aren't transferred again when the torrent is retried
+        return key not in self._partials_pending and obj.remote_path not in self._done.get(obj.infohash, ())
+
+    def submit(self, objs: List[DownloadObject]) -> int:
+        """Queue objects for download (in order) if they aren't already queued or downloading. Returns the number of newly queued objects"""
+        queued = 0
+        # Torrents can be given a priority of their own when they are added (see main.ingest_watch_dirs)
+        watching_torrents = state.get_watching_torrents() if objs else {}
+        with self._cond:
+            candidates = [obj for obj in objs if self._may_queue(obj)]
+        # Objects are submitted on every poll, so only those which could be queued are looked up, and without holding the lock
+        transferred = {_object_key(obj) for obj in candidates if obj.partial and obj.transferred()}
+        space_needs = {_object_key(obj): obj.space_needed() for obj in candidates if _object_key(obj) not in transferred}
+        with self._cond:
+            for obj in objs:
+                key = _object_key(obj)
+                priority = watching_torrents.get(obj.infohash, {}).get("priority")
+                if obj.partial:
+                    queued += self._submit_partial(obj, priority, key in transferred, space_needs.get(key))
+                    continue
+                if key in self._partials_pending:
+                    # The file itself is still being transferred early, so take this over once that is done
+                    self._deferred[key] = obj
+                    continue
+                # Objects which weren't looked up were pending a moment ago, and if they need queueing again the next poll does it
+                if key in space_needs and self._may_queue(obj):
+                    self._pending.add(key)
+                    self._outstanding[obj.infohash] = self._outstanding.get(obj.infohash, 0) + 1
+                    self._enqueue(obj, priority, space_needs[key])
+                    queued += 1
+                    metrics.record_event(obj.infohash, "completed", obj.timestamp)
+                    metrics.record_event(obj.infohash, "queued")
+            if queued:
+                self._cond.notify_all()
+        return queued
+
+    def _submit_partial(self, obj: DownloadObject, priority: Optional[int], transferred: bool, space_needs: Optional[Dict[str, int]]) -> int:
+        """Must be called with the condition lock held"""
+        key = _object_key(obj)
+        done = self._partials_done.setdefault(obj.infohash, set())
+        if key in self._pending or obj.remote_path in done:
+            return 0
+        # Partial objects are submitted on every poll until their torrent completes, so each is only looked up in state once
+        if transferred:
+            done.add(obj.remote_path)
+            return 0
+        if space_needs is None:
+            return 0
+        self._pending.add(key)
+        self._partials_pending.add(key)
+        self._partials_in_flight[obj.infohash] = self._partials_in_flight.get(obj.infohash, 0) + 1
+        self._enqueue(obj, priority, space_needs)
+        return 1
+
+    def _finish_partial(self, obj: DownloadObject, succeeded: bool) -> None:
+        with self._cond:
+            key = _object_key(obj)
+            self._pending.discard(key)
+            self._partials_pending.discard(key)
+            self._release_space(obj)
+            if succeeded:
+                self._partials_done.setdefault(obj.infohash, set()).add(obj.remote_path)
+            self._partials_in_flight[obj.infohash] -= 1
+            if not self._partials_in_flight[obj.infohash]:
+                del self._partials_in_flight[obj.infohash]
+            deferred = self._deferred.pop(key, None)
+            waiting = [] if obj.infohash in self._partials_in_flight else self._queued_of(obj.infohash)
+            self._cond.notify_all()
+        if waiting:
+            self._refresh_space_needs(waiting)
+        if deferred is not None:
+            self.submit([deferred])
+
+    def _queued_of(self, infohash: str) -> List[DownloadObject]:
+        """Must be called with the condition lock held"""
+        return [obj for queue in self._queues.values() for obj in queue if obj.infohash == infohash]
+
+    def _refresh_space_needs(self, objs: List[DownloadObject]) -> None:
+        """Look up the space queued objects need again, since files which were transferred early already take up theirs"""
+        space_needs = {_object_key(obj): obj.space_needed() for obj in objs}
+        with self._cond:
+            for key, needs in space_needs.items():
+                if key in self._space_needs:
+                    self._space_needs[key] = needs
+            self._cond.notify_all()
+
+    def _collect_active(self) -> Dict[Tuple[str, ...], float]:
+        with self._cond:
+            return {(watch_dir,): active for watch_dir, active in self._active_per_watch_dir.items()}
+
+    def _connections_for(self, objs: List[DownloadObject]) -> int:
+        if len(objs) == 1:
+            needed = objs[0].connections_needed()
+        else:
+            needed = tuning.connection_ceiling([file for obj in objs for file in obj.files], True, config.get_sftp_options(objs[0].seedbox))
+        if self.max_connections > 0:
+            return min(needed, self.max_connections)
+        return needed
+
+    def _batches(self, queue: List[DownloadObject]) -> Iterator[Tuple[DownloadObject, List[DownloadObject]]]:
+        """Each object of a class's queue with the batch it would start: itself, and if it is a small root file, the small root files of its
+        torrent queued after it. The queue is only indexed by torrent once a small root file is reached, so it's a single pass either way
+        """
+        batchable: Optional[Dict[str, List[DownloadObject]]] = None
+        offsets: Dict[str, int] = {}
+        for obj in queue:
+            if not _is_batchable(obj):
+                yield obj, [obj]
+                continue
+            if batchable is None:
+                batchable = {}
+                for other in queue:
+                    if _is_batchable(other):
+                        batchable.setdefault(other.infohash, []).append(other)
+            offset = offsets.get(obj.infohash, 0)
+            offsets[obj.infohash] = offset + 1
+            yield obj, batchable[obj.infohash][offset : offset + _BATCH_MAX_FILES]
+
+    def _reserve_space(self, batch: List[DownloadObject], free_cache: Dict[str, Tuple[int, int]]) -> bool:
+        needs: Dict[str, int] = {}
+        for obj in batch:
+            for directory, num_bytes in self._space_needs[_object_key(obj)].items():
+                needs[directory] = needs.get(directory, 0) + num_bytes
+        reservation = self._space.try_reserve(needs, free_cache)
+        if reservation is None:
+            for obj in batch:
+                if _object_key(obj) not in self._waiting_for_space:
+                    self._waiting_for_space.add(_object_key(obj))
+                    log.warning(
+                        f"Not enough disk space for {obj.remote_path} yet ({sum(needs.values()) / (1 << 30):.1f} GiB needed), leaving it queued"
+                    )
+            return False
+        # Every object of a batch holds the batch's reservation, which is released once the last of them finishes
+        for obj in batch:
+            self._waiting_for_space.discard(_object_key(obj))
+            self._reservations[_object_key(obj)] = reservation
+        return True
+
+    def _classes_in_order(self) -> List[Tuple[int, str]]:
+        """Classes with queued objects, highest priority first, then the watch dir furthest behind its share first"""
+        return sorted((cls for cls, queue in self._queues.items() if queue), key=lambda cls: (-cls[0], self._service.get(cls[1], 0.0), cls[1]))
+
+    def _dequeue(self, cls: Tuple[int, str], batch: List[DownloadObject]) -> None:
+        """Remove a batch which is starting from its class's queue, charging its watch dir for it. Must be called with the condition lock held"""
+        priority, watch_dir = cls
+        batched = {id(batch_obj) for batch_obj in batch}
+        self._queues[cls] = [queued for queued in self._queues[cls] if id(queued) not in batched]
+        if not self._queues[cls]:
+            del self._queues[cls]
+        self._virtual_time = self._service.get(watch_dir, 0.0)
+        self._service[watch_dir] = self._virtual_time + sum(_size(obj) for obj in batch) / self.watch_dir_weights.get(watch_dir, 1)
+        now = time.monotonic()
+        for obj in batch:
+            self._space_needs.pop(_object_key(obj), None)
+            metrics.observe_queue_wait(watch_dir, priority, now - self._queued_at.pop(_object_key(obj), now))
+
+    def _take_next_runnable(self) -> Optional[Tuple[List[DownloadObject], int]]:
+        """Pop the next object (or batch of objects) which can run with the current limits. Must be called with the condition lock held"""
+        free_cache: Dict[str, Tuple[int, int]] = {}
+        for cls in self._classes_in_order():
+            queue = self._queues[cls]
+            for obj, batch in self._batches(queue):
+                if not obj.partial and obj.infohash in self._partials_in_flight:
+                    # Its files may still be being transferred early, which it would otherwise fetch again at the same time
+                    continue
+                limit = self.watch_dir_limits.get(obj.watch_dir, 0)
+                if limit > 0 and self._active_per_watch_dir.get(obj.watch_dir, 0) >= limit:
+                    # This watch dir is saturated, but other classes may still run
+                    break
+                connections = self._connections_for(batch)
+                if self.max_connections > 0 and self._connections_in_use + connections > self.max_connections:
+                    # Don't let later objects jump ahead of this one for connections, otherwise large downloads could starve
+                    return None
+                if not self._reserve_space(batch, free_cache):
+                    # Unlike connections, disk space may never be enough for this object, so objects which do fit can go ahead of it
+                    continue
+                self._dequeue(cls, batch)
+                self._connections_in_use += connections
+                self._active_per_watch_dir[obj.watch_dir] = self._active_per_watch_dir.get(obj.watch_dir, 0) + 1
+                return batch, connections
+        return None
+
+    def _close_idle_connections(self) -> None:
+        """Close pooled sessions which would keep more connections open than the limit allows alongside the running transfers.
+        Those of the transfer which is starting may be closed too, which only costs it a new handshake while the limit is reached
+        """
+        with self._cond:
+            in_use = self._connections_in_use
+        excess = in_use + transfer_engine.idle_connections() - self.max_connections
+        if excess > 0:
+            log.debug(f"Closing idle sessions holding {excess} connections, to stay within {self.max_connections} connections")
+            transfer_engine.close_idle_connections(excess)
+
+    def _release_transfer(self, obj: DownloadObject, connections: int) -> None:
+        with self._cond:
+            self._connections_in_use -= connections
+            self._active_per_watch_dir[obj.watch_dir] -= 1
+            self._cond.notify_all()
+
+    def _finish(self, obj: DownloadObject, succeeded: bool) -> None:
+        with self._cond:
+            self._pending.discard(_object_key(obj))
+            self._release_space(obj)
+            if succeeded:
+                self._done.setdefault(obj.infohash, set()).add(obj.remote_path)
+            else:
+                self._failed.add(obj.infohash)
+            self._outstanding[obj.infohash] -= 1
+            if self._outstanding[obj.infohash] > 0:
+                return
+            del self._outstanding[obj.infohash]
+            if obj.infohash in self._failed:
+                # Keep watching the torrent, so its failed objects are retried on a later poll
+                self._failed.discard(obj.infohash)
+                return
+            self._done.pop(obj.infohash, None)
+            self._partials_done.pop(obj.infohash, None)
+        # Every object of the torrent is done, so stop watching it (once, rather than for every object)
+        state.remove_watching_torrent(obj.infohash)
+
+    def _release_space(self, obj: DownloadObject) -> None:
+        """Must be called with the condition lock held"""
+        reservation = self._reservations.pop(_object_key(obj), None)
+        if reservation is not None and not any(other is reservation for other in self._reservations.values()):
+            self._space.release(reservation)
+            self._cond.notify_all()
+
+    def _post_process(self, obj: DownloadObject) -> None:
+        succeeded = False
+        try:
+            obj.post_process()
+            succeeded = True
+        except Exception:
+            log.exception(f"Error: Failure to process {obj.remote_path}")
+        finally:
+            self._finish(obj, succeeded)
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                runnable = self._take_next_runnable()
+                while runnable is None:
+                    self._cond.wait(_SPACE_RECHECK_INTERVAL if self._waiting_for_space else None)
+                    runnable = self._take_next_runnable()
+            objs, connections = runnable
+            try:
+                if self.max_connections > 0:
+                    self._close_idle_connections()
+                transfer_batch(objs, connections if self.max_connections > 0 else 0)
+            except Exception:
+                log.exception(f"Error: Failure to download {', '.join(obj.remote_path for obj in objs)}")
+                self._release_transfer(objs[0], connections)
+                for obj in objs:
+                    if obj.partial:
+                        self._finish_partial(obj, False)
+                    else:
+                        self._finish(obj, False)
+                continue
+            self._release_transfer(objs[0], connections)
+            for obj in objs:
+                if obj.partial:
+                    self._finish_partial(obj, True)
+                else:
+                    self._post_process_executor.submit(self._post_process, obj)
+
+
+def create_from_config() -> DownloadScheduler:
+    watch_dir_limits = {}
+    watch_dir_priorities = {}
+    watch_dir_weights = {}
+    for watch_dir in config.get_torrent_watch_dirs():
+        watch_dir_limits[watch_dir["directory"]] = watch_dir.get("max_concurrent_downloads", 0)
+        watch_dir_priorities[watch_dir["directory"]] = watch_dir.get("priority", 0)
+        watch_dir_weights[watch_dir["directory"]] = watch_dir.get("weight", 1)
+    return DownloadScheduler(
+        config.get_download_workers(),
+        config.get_max_sftp_connections(),
+        watch_dir_limits,
+        config.get_post_process_workers(),
+        config.get_min_free_space(),
+        watch_dir_priorities,
+        watch_dir_weights,
+        config.get_queue_policy(),
+    )
@@ -0,0 +1,245 @@
+from typing import Any, Dict, List, Optional
+import os
+import contextlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.model.download_obj import DownloadObject
+from downloader.pipeline.scheduler import DownloadScheduler
+from downloader.state import config
+from downloader.state import state
+from downloader.transfer import engine as transfer_engine
+from downloader.transfer.local import LocalEngine
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        self.temp_dir = watch_dir["temp_download_dir"]
+        self.final_dir = watch_dir["final_download_dir"]
+
+    def _obj(self, name: str, size: int = 100, watch_dir: str = "a", infohash: str = "", **kwargs: Any) -> DownloadObject:
+        """A directory of a torrent (one per name unless infohash is given) with a single file of the given size"""
+        infohash = infohash or name.ljust(40, "0")
+        if infohash not in state.get_watching_torrents():
+            state.add_watching_torrent(infohash, self.temp_dir, self.final_dir, name, watch_dir=watch_dir)
+        kwargs.setdefault("directory", True)
+        directory = kwargs.pop("directory")
+        files = [("file.mkv", size)] if directory else [(name, size)]
+        return DownloadObject(infohash, f"/remote/{name}", 0, directory, self.temp_dir, self.final_dir, False, False, watch_dir, files, **kwargs)
+
+    def _take(self, scheduler: DownloadScheduler) -> Optional[List[str]]:
+        with scheduler._cond:
+            runnable = scheduler._take_next_runnable()
+        if runnable is None:
+            return None
+        return [os.path.basename(obj.remote_path) for obj in runnable[0]]
+
+    def _take_all(self, scheduler: DownloadScheduler) -> List[str]:
+        taken: List[str] = []
+        while True:
+            names = self._take(scheduler)
+            if names is None:
+                return taken
+            taken.extend(names)
+
+    def _release(self, scheduler: DownloadScheduler, obj: DownloadObject, succeeded: bool = True) -> None:
+        """Finish an object's transfer and post-processing"""
+        scheduler._release_transfer(obj, obj.connections_needed())
+        if obj.partial:
+            scheduler._finish_partial(obj, succeeded)
+        else:
+            scheduler._finish(obj, succeeded)
+
+    def test_fifo(self) -> None:
+        scheduler = DownloadScheduler(1)
+        scheduler.submit([self._obj("big", 300), self._obj("small", 100), self._obj("medium", 200)])
+        self.assertEqual(self._take_all(scheduler), ["big", "small", "medium"])
+
+    def test_shortest_job_first(self) -> None:
+        scheduler = DownloadScheduler(1, policy="sjf")
+        scheduler.submit([self._obj("big", 300), self._obj("small", 100), self._obj("medium", 200), self._obj("small2", 100)])
+        self.assertEqual(self._take_all(scheduler), ["small", "small2", "medium", "big"])
+
+    def test_higher_priority_goes_first(self) -> None:
+        scheduler = DownloadScheduler(1, watch_dir_priorities={"b": 5})
+        scheduler.submit([self._obj("a1"), self._obj("a2")])
+        scheduler.submit([self._obj("b1", watch_dir="b")])
+        self.assertEqual(self._take_all(scheduler), ["b1", "a1", "a2"])
+
+    def test_torrent_priority_overrides_watch_dir_priority(self) -> None:
+        scheduler = DownloadScheduler(1, watch_dir_priorities={"b": 5})
+        a1 = self._obj("a1")
+        urgent = self._obj("urgent")
+        state.add_watching_torrent(urgent.infohash, self.temp_dir, self.final_dir, "urgent", watch_dir="a", priority=10)
+        scheduler.submit([a1, urgent, self._obj("b1", watch_dir="b")])
+        self.assertEqual(self._take_all(scheduler), ["urgent", "b1", "a1"])
+
+    def test_watch_dirs_share_by_weight(self) -> None:
+        scheduler = DownloadScheduler(1, watch_dir_weights={"b": 2})
+        scheduler.submit([self._obj(f"a{i}") for i in range(4)] + [self._obj(f"b{i}", watch_dir="b") for i in range(6)])
+        self.assertEqual(self._take_all(scheduler)[:9], ["a0", "b0", "b1", "a1", "b2", "b3", "a2", "b4", "b5"])
+
+    def test_share_is_by_bytes(self) -> None:
+        scheduler = DownloadScheduler(1)
+        scheduler.submit([self._obj("a_big", 300), self._obj("a_next", 100)] + [self._obj(f"b{i}", watch_dir="b") for i in range(4)])
+        self.assertEqual(self._take_all(scheduler), ["a_big", "b0", "b1", "b2", "a_next", "b3"])
+
+    def test_idle_watch_dir_does_not_bank_its_share(self) -> None:
+        scheduler = DownloadScheduler(1)
+        scheduler.submit([self._obj(f"a{i}") for i in range(4)])
+        self.assertEqual(self._take(scheduler), ["a0"])
+        self.assertEqual(self._take(scheduler), ["a1"])
+        # b was idle while a ran, so it starts level with a's last transfer rather than taking turns until it has caught up with a
+        scheduler.submit([self._obj(f"b{i}", watch_dir="b") for i in range(3)])
+        self.assertEqual(self._take_all(scheduler), ["b0", "a2", "b1", "a3", "b2"])
+
+    def test_watch_dir_limit(self) -> None:
+        scheduler = DownloadScheduler(1, watch_dir_limits={"a": 1})
+        a1 = self._obj("a1")
+        scheduler.submit([a1, self._obj("a2"), self._obj("b1", watch_dir="b")])
+        self.assertEqual(self._take_all(scheduler), ["a1", "b1"])
+        self._release(scheduler, a1)
+        self.assertEqual(self._take(scheduler), ["a2"])
+
+    def test_connection_limit_keeps_queue_order(self) -> None:
+        scheduler = DownloadScheduler(1, max_connections=1, watch_dir_priorities={"b": 5})
+        first = self._obj("b1", watch_dir="b")
+        scheduler.submit([first, self._obj("a1")])
+        self.assertEqual(self._take(scheduler), ["b1"])
+        # Nothing starts until the connection is released, and then the higher priority class still goes first
+        scheduler.submit([self._obj("b2", watch_dir="b")])
+        self.assertIsNone(self._take(scheduler))
+        scheduler._release_transfer(first, 1)
+        self.assertEqual(self._take_all(scheduler), ["b2"])
+
+    def test_small_root_files_are_batched(self) -> None:
+        scheduler = DownloadScheduler(1)
+        infohash = "c" * 40
+        scheduler.submit([self._obj(f"c{i}.nfo", 10, infohash=infohash, directory=False) for i in range(3)] + [self._obj("other")])
+        self.assertEqual(self._take(scheduler), ["c0.nfo", "c1.nfo", "c2.nfo"])
+        self.assertEqual(self._take(scheduler), ["other"])
+
+    def test_batches_of_interleaved_torrents(self) -> None:
+        scheduler = DownloadScheduler(1)
+        objs = [self._obj(f"{name}{i}.nfo", 10, infohash=name * 40, directory=False) for i in range(2) for name in ("c", "d")]
+        scheduler.submit(objs)
+        self.assertEqual(self._take(scheduler), ["c0.nfo", "c1.nfo"])
+        self.assertEqual(self._take(scheduler), ["d0.nfo", "d1.nfo"])
+
+    def test_objects_are_looked_up_without_the_lock(self) -> None:
+        scheduler = DownloadScheduler(1)
+        held: List[bool] = []
+        space_needed = DownloadObject.space_needed
+        transferred = DownloadObject.transferred
+
+        def record_space_needed(obj: DownloadObject) -> Dict[str, int]:
+            held.append(scheduler._cond._is_owned())  # type: ignore
+            return space_needed(obj)
+
+        def record_transferred(obj: DownloadObject) -> bool:
+            held.append(scheduler._cond._is_owned())  # type: ignore
+            return transferred(obj)
+
+        infohash = "g" * 40
+        part = self._obj("Show/e01.mkv", infohash=infohash, directory=False, partial=True, part_of="/remote/Show")
+        with (
+            mock.patch.object(DownloadObject, "space_needed", record_space_needed),
+            mock.patch.object(DownloadObject, "transferred", record_transferred),
+        ):
+            scheduler.submit([part, self._obj("other")])
+            self.assertEqual(self._take_all(scheduler), ["e01.mkv", "other"])
+            scheduler.submit([self._obj("Show", infohash=infohash)])
+            self._release(scheduler, part)
+            self.assertEqual(self._take(scheduler), ["Show"])
+        # Looked up when submitted, and the torrent's queued object again once its files were transferred early
+        self.assertEqual(len(held), 5)
+        self.assertFalse(any(held))
+
+    def test_resubmitted_object_is_not_queued_twice(self) -> None:
+        scheduler = DownloadScheduler(1)
+        self.assertEqual(scheduler.submit([self._obj("a1")]), 1)
+        self.assertEqual(scheduler.submit([self._obj("a1")]), 0)
+        self.assertEqual(self._take_all(scheduler), ["a1"])
+
+    def test_completed_objects_wait_for_partial_transfers(self) -> None:
+        scheduler = DownloadScheduler(1)
+        infohash = "d" * 40
+        part = self._obj("Show/e01.mkv", infohash=infohash, directory=False, partial=True, part_of="/remote/Show")
+        self.assertEqual(scheduler.submit([part]), 1)
+        self.assertEqual(self._take(scheduler), ["e01.mkv"])
+        # The torrent completes while its first file is still being transferred early
+        whole = self._obj("Show", infohash=infohash)
+        self.assertEqual(scheduler.submit([whole, self._obj("other")]), 2)
+        self.assertEqual(self._take_all(scheduler), ["other"])
+        self._release(scheduler, part)
+        self.assertEqual(self._take(scheduler), ["Show"])
+
+    def test_file_completing_during_its_partial_transfer_is_deferred(self) -> None:
+        scheduler = DownloadScheduler(1)
+        infohash = "e" * 40
+        part = self._obj("e01.mkv", infohash=infohash, directory=False, partial=True)
+        scheduler.submit([part])
+        self.assertEqual(self._take(scheduler), ["e01.mkv"])
+        # A single file torrent completes, which is the same remote path as the partial object
+        self.assertEqual(scheduler.submit([self._obj("e01.mkv", infohash=infohash, directory=False)]), 0)
+        self.assertIsNone(self._take(scheduler))
+        self._release(scheduler, part)
+        self.assertEqual(self._take(scheduler), ["e01.mkv"])
+
+    def test_transferred_partial_is_not_queued_again(self) -> None:
+        scheduler = DownloadScheduler(1)
+        infohash = "f" * 40
+        part = self._obj("e01.mkv", infohash=infohash, directory=False, partial=True)
+        scheduler.submit([part])
+        self._take(scheduler)
+        self._release(scheduler, part)
+        self.assertEqual(scheduler.submit([self._obj("e01.mkv", infohash=infohash, directory=False, partial=True)]), 0)
+
+
+class IdleConnectionsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.engines = {"a": LocalEngine(), "b": LocalEngine()}
+        with transfer_engine._engine_lock:
+            saved = dict(transfer_engine._engines)
+            transfer_engine._engines.clear()
+            transfer_engine._engines.update(self.engines)
+        self.addCleanup(self._restore, saved)
+
+    def _restore(self, saved: Dict[str, transfer_engine.TransferEngine]) -> None:
+        with transfer_engine._engine_lock:
+            transfer_engine._engines.clear()
+            transfer_engine._engines.update(saved)
+
+    def _pool(self, engine: LocalEngine, sessions: int) -> None:
+        """Leave the given number of sessions idle in an engine's pool, as transfers do when they finish"""
+        with contextlib.ExitStack() as stack:
+            for _ in range(sessions):
+                stack.enter_context(engine._session())
+
+    def test_idle_sessions_count_against_the_limit(self) -> None:
+        self._pool(self.engines["a"], 3)
+        self._pool(self.engines["b"], 2)
+        self.assertEqual(transfer_engine.idle_connections(), 5)
+        scheduler = DownloadScheduler(1, max_connections=6)
+        scheduler._connections_in_use = 4
+        scheduler._close_idle_connections()
+        self.assertEqual(transfer_engine.idle_connections(), 2)
+
+    def test_idle_sessions_within_the_limit_are_kept(self) -> None:
+        self._pool(self.engines["a"], 2)
+        scheduler = DownloadScheduler(1, max_connections=6)
+        scheduler._connections_in_use = 4
+        scheduler._close_idle_connections()
+        self.assertEqual(transfer_engine.idle_connections(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
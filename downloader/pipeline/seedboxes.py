@@ -0,0 +1,249 @@
+from typing import List, Dict, Set, Tuple, Any, Callable, Optional, Collection
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.model.download_obj import DownloadObject, is_early_transfer
+from downloader.model import metainfo
+from downloader.state import config
+from downloader.state import state
+
+log = logging.getLogger("seedboxes")
+
+
+class Seedbox(object):
+    """A seedbox: its torrent client (deluge.DelugeClient or transmission.TransmissionClient). Its sftp options are in the config"""
+
+    def __init__(self, name: str, client: Any):
+        self.name = name
+        self.client = client
+
+
+_seedboxes: List[Seedbox] = []
+_seedboxes_lock = threading.Lock()
+# Called with newly completed download objects of the seedboxes which push completions (by name)
+_submit: Optional[Callable[[List[DownloadObject]], Any]] = None
+_pushing: Set[str] = set()
+# Torrents on seedboxes which are no longer configured, which are only warned about once rather than on every poll
+_unconfigured_warned: Set[str] = set()
+
+
+def _create_client(name: str) -> Any:
+    client_type = config.get_torrent_client_type(name)
+    # Conditionally import torrent clients, so dependencies of unused clients aren't required
+    if client_type == "deluge":
+        from downloader.torrent_clients.deluge import DelugeClient
+
+        return DelugeClient(config.get_torrent_client_config(name))
+    elif client_type == "transmission":
+        from downloader.torrent_clients.transmission import TransmissionClient
+
+        return TransmissionClient(config.get_torrent_client_config(name))
+    raise NotImplementedError(f"Torrent client type {client_type} not implemented")
+
+
+def get_seedboxes() -> List[Seedbox]:
+    """Get every configured seedbox, in config order"""
+    with _seedboxes_lock:
+        if not _seedboxes:
+            _seedboxes.extend(Seedbox(name, _create_client(name)) for name in config.get_seedbox_names())
+        return list(_seedboxes)
+
+
+def _group_by_seedbox(watching_torrents: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    groups: Dict[str, Dict[str, Dict[str, Any]]] = {seedbox.name: {} for seedbox in get_seedboxes()}
+    for infohash, data in watching_torrents.items():
+        name = config.get_seedbox_name(data.get("seedbox", ""))
+        if name in groups:
+            groups[name][infohash] = data
+        elif infohash not in _unconfigured_warned:
+            _unconfigured_warned.add(infohash)
+            log.warning(f"Torrent {infohash} is on seedbox {name}, which is no longer configured")
+    # Forget torrents which are no longer watched, so they are warned about again if they are added back
+    _unconfigured_warned.intersection_update(watching_torrents)
+    return groups
+
+
+def get_download_objects_for_watching_torrents(
+    watching_torrents: Dict[str, Dict[str, Any]], due: Optional[Collection[str]] = None, etas: Optional[Dict[str, float]] = None
+) -> List[DownloadObject]:
+    """Poll every seedbox (concurrently) for completed watching torrents. A seedbox which fails is logged and skipped until the next poll.
+    If due is given, only those torrents are checked (with a single status query per seedbox). If etas is given, it is filled with the
+    seconds until each checked torrent completes (0 if complete, negative if unknown)
+    """
+    seedboxes = get_seedboxes()
+    if len(seedboxes) == 1:
+        return seedboxes[0].client.get_download_objects_for_watching_torrents(watching_torrents, due, etas)
+    groups = _group_by_seedbox(watching_torrents)
+    download_list: List[DownloadObject] = []
+    # Each seedbox fills its own, so they aren't written from several threads
+    seedbox_etas: Dict[str, Dict[str, float]] = {seedbox.name: {} for seedbox in seedboxes}
+    with ThreadPoolExecutor(max_workers=len(seedboxes), thread_name_prefix="poll") as executor:
+        futures = {
+            seedbox.name: executor.submit(
+                seedbox.client.get_download_objects_for_watching_torrents,
+                groups[seedbox.name],
+                None if due is None else [infohash for infohash in due if infohash in groups[seedbox.name]],
+                seedbox_etas[seedbox.name],
+            )
+            for seedbox in seedboxes
+            if groups[seedbox.name] and (due is None or any(infohash in groups[seedbox.name] for infohash in due))
+        }
+        for name, future in futures.items():
+            try:
+                download_list.extend(future.result())
+            except Exception:
+                log.exception(f"Failed to poll seedbox {name}")
+    if etas is not None:
+        for name_etas in seedbox_etas.values():
+            etas.update(name_etas)
+    download_list.sort(key=lambda x: x.timestamp)
+    return download_list
+
+
+def _on_finished(seedbox: Seedbox, infohash: str) -> None:
+    watching_torrents = state.get_watching_torrents()
+    if infohash not in watching_torrents or _submit is None:
+        # Not one of ours, or not yet recorded as watched (in which case ingestion checks it once it is)
+        return
+    if _submit(seedbox.client.get_download_objects_for_torrents({infohash: watching_torrents[infohash]})):
+        log.info(f"Queued {infohash}, which just completed on seedbox {seedbox.name}")
+
+
+def _on_file_completed(seedbox: Seedbox, infohash: str) -> None:
+    watching_torrents = state.get_watching_torrents()
+    # Files of other torrents are only transferred once their torrent finishes, which has an event of its own
+    if infohash not in watching_torrents or _submit is None or not is_early_transfer(watching_torrents[infohash]):
+        return
+    if _submit(seedbox.client.get_download_objects_for_torrents({infohash: watching_torrents[infohash]})):
+        log.info(f"Queued files of {infohash} which just completed on seedbox {seedbox.name}")
+
+
+def _on_connected(seedbox: Seedbox) -> None:
+    watching_torrents = _group_by_seedbox(state.get_watching_torrents())[seedbox.name]
+    if watching_torrents and _submit is not None:
+        _submit(seedbox.client.get_download_objects_for_watching_torrents(watching_torrents))
+
+
+def _start_events(seedbox: Seedbox) -> None:
+    def on_finished(infohash: str) -> None:
+        try:
+            _on_finished(seedbox, infohash)
+        except Exception:
+            log.exception(f"Failed to queue {infohash} from seedbox {seedbox.name}, leaving it to the next poll")
+
+    def on_connected() -> None:
+        try:
+            _on_connected(seedbox)
+        except Exception:
+            log.exception(f"Failed to check seedbox {seedbox.name} after connecting for events, leaving it to the next poll")
+
+    def on_file_completed(infohash: str) -> None:
+        try:
+            _on_file_completed(seedbox, infohash)
+        except Exception:
+            log.exception(f"Failed to queue completed files of {infohash} from seedbox {seedbox.name}, leaving them to the next poll")
+
+    if seedbox.client.start_events(on_finished, on_connected, on_file_completed):
+        _pushing.add(seedbox.name)
+
+
+def start_completion_events(submit: Callable[[List[DownloadObject]], Any]) -> bool:
+    """Have seedboxes whose torrent clients can push completions (deluge) pass newly completed downloads to submit as soon as they complete.
+    Returns whether every seedbox does, in which case polling is only a safety net
+    """
+    global _submit
+    _submit = submit
+    if config.get_completion_events():
+        for seedbox in get_seedboxes():
+            if hasattr(seedbox.client, "start_events") and seedbox.name not in _pushing:
+                _start_events(seedbox)
+    return len(_pushing) == len(get_seedboxes())
+
+
+def check_added(added: Dict[str, str]) -> None:
+    """Check torrents which just started being watched (infohash to seedbox name) on seedboxes which push completions.
+    Torrents which were already complete when added (or completed before being recorded as watched) never produce a completion event
+    """
+    if not _pushing or _submit is None or not added:
+        return
+    watching_torrents = state.get_watching_torrents()
+    for seedbox in get_seedboxes():
+        torrents = {
+            infohash: watching_torrents[infohash]
+            for infohash, name in added.items()
+            if config.get_seedbox_name(name) == seedbox.name and infohash in watching_torrents
+        }
+        if torrents and seedbox.name in _pushing:
+            try:
+                _submit(seedbox.client.get_download_objects_for_torrents(torrents))
+            except Exception:
+                log.exception(f"Failed to check newly added torrents on seedbox {seedbox.name}, leaving them to the next poll")
+
+
+def _free_space(seedboxes: List[Seedbox]) -> Dict[str, float]:
+    free: Dict[str, float] = {}
+    for seedbox in seedboxes:
+        try:
+            free[seedbox.name] = seedbox.client.get_free_space()
+        except Exception:
+            log.exception(f"Failed to get free space of seedbox {seedbox.name}, not placing new torrents on it")
+            free[seedbox.name] = float("-inf")
+    return free
+
+
+def _place(torrent_file_paths: List[str], watching_torrents: Dict[str, Dict[str, Any]], seedboxes: List[Seedbox]) -> Dict[str, List[str]]:
+    """Choose a seedbox for each torrent file. Torrents which are already watched stay where they are, new torrents go to the least loaded seedbox"""
+    placement = config.get_placement()
+    if placement == "free_space":
+        # Most free space, minus what was already placed on it in this batch
+        load = {name: -free for name, free in _free_space(seedboxes).items()}
+    else:
+        # Fewest watched torrents
+        load = {seedbox.name: 0.0 for seedbox in seedboxes}
+        for data in watching_torrents.values():
+            name = config.get_seedbox_name(data.get("seedbox", ""))
+            if name in load:
+                load[name] += 1
+    placed: Dict[str, List[str]] = {seedbox.name: [] for seedbox in seedboxes}
+    for path in torrent_file_paths:
+        infohash = metainfo.read_infohash(path)
+        if infohash and infohash in watching_torrents:
+            name = config.get_seedbox_name(watching_torrents[infohash].get("seedbox", ""))
+            if name in placed:
+                placed[name].append(path)
+                continue
+        name = min(load, key=lambda seedbox_name: load[seedbox_name])
+        placed[name].append(path)
+        if placement == "free_space":
+            info = metainfo.read_info(path)
+            load[name] += metainfo.PieceLayout(info).total_length if info else 0
+        else:
+            load[name] += 1
+    return placed
+
+
+def add_torrents_by_files(torrent_file_paths: List[str], watching_torrents: Dict[str, Dict[str, Any]]) -> Dict[str, Tuple[str, str]]:
+    """Place torrent files on seedboxes and add them, returning a dict of file path to (infohash, seedbox name) for every file now in a client.
+    Files which fail to be added are logged and left out of the result
+    """
+    seedboxes = get_seedboxes()
+    known_infohashes = set(watching_torrents)
+    if len(seedboxes) == 1:
+        added = seedboxes[0].client.add_torrents_by_files(torrent_file_paths, known_infohashes)
+        return {path: (infohash, seedboxes[0].name) for path, infohash in added.items()}
+    placed = _place(torrent_file_paths, watching_torrents, seedboxes)
+    result: Dict[str, Tuple[str, str]] = {}
+    with ThreadPoolExecutor(max_workers=len(seedboxes), thread_name_prefix="add") as executor:
+        futures = {
+            seedbox.name: executor.submit(seedbox.client.add_torrents_by_files, placed[seedbox.name], known_infohashes)
+            for seedbox in seedboxes
+            if placed[seedbox.name]
+        }
+        for name, future in futures.items():
+            try:
+                for path, infohash in future.result().items():
+                    result[path] = (infohash, name)
+            except Exception:
+                log.exception(f"Failed to add torrents to seedbox {name}")
+    return result
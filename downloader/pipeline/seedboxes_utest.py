@@ -0,0 +1,72 @@
+from typing import Any, Dict, List
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.pipeline import seedboxes
+from downloader.state import config
+from downloader.state import state
+
+
+class GroupBySeedboxTest(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.object(seedboxes, "get_seedboxes", return_value=[seedboxes.Seedbox("a", None)])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(config, "get_seedbox_name", side_effect=lambda name: name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        seedboxes._unconfigured_warned.clear()
+        self.addCleanup(seedboxes._unconfigured_warned.clear)
+
+    def test_unconfigured_seedbox_is_warned_about_once_per_torrent(self) -> None:
+        watching: Dict[str, Dict[str, Any]] = {"1" * 40: {"seedbox": "a"}, "2" * 40: {"seedbox": "gone"}}
+        with self.assertLogs("seedboxes", "WARNING") as logs:
+            self.assertEqual(seedboxes._group_by_seedbox(watching), {"a": {"1" * 40: {"seedbox": "a"}}})
+            seedboxes._group_by_seedbox(watching)
+            watching["3" * 40] = {"seedbox": "gone"}
+            seedboxes._group_by_seedbox(watching)
+        self.assertEqual(len(logs.output), 2)
+
+    def test_torrent_which_is_watched_again_is_warned_about_again(self) -> None:
+        unconfigured = {"2" * 40: {"seedbox": "gone"}}
+        with self.assertLogs("seedboxes", "WARNING") as logs:
+            seedboxes._group_by_seedbox(unconfigured)
+            seedboxes._group_by_seedbox({})
+            seedboxes._group_by_seedbox(unconfigured)
+        self.assertEqual(len(logs.output), 2)
+
+
+class FileCompletedTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        self.watch_dir = config.get_torrent_watch_dirs()[0]
+        state.add_watching_torrent(
+            "1" * 40, self.watch_dir["temp_download_dir"], self.watch_dir["final_download_dir"], "Show", watch_dir=self.watch_dir["directory"]
+        )
+        self.client = mock.Mock()
+        self.client.get_download_objects_for_torrents.return_value = []
+        self.submitted: List[List[Any]] = []
+        patcher = mock.patch.object(seedboxes, "_submit", self.submitted.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_early_transfer_torrent_is_checked(self) -> None:
+        self.watch_dir["early_transfer"] = True
+        seedboxes._on_file_completed(seedboxes.Seedbox("a", self.client), "1" * 40)
+        self.client.get_download_objects_for_torrents.assert_called_once()
+        self.assertEqual(self.submitted, [[]])
+
+    def test_other_torrents_wait_for_their_torrent_to_finish(self) -> None:
+        seedboxes._on_file_completed(seedboxes.Seedbox("a", self.client), "1" * 40)
+        seedboxes._on_file_completed(seedboxes.Seedbox("a", self.client), "2" * 40)
+        self.client.get_download_objects_for_torrents.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+from typing import List, Dict, Tuple, Optional
+import os
+import mmap
+import bisect
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.model.metainfo import PieceLayout
+from downloader.state import config
+from downloader.transfer.engine import TransferEngine
+
+log = logging.getLogger("verifier")
+
+# Number of consecutive pieces hashed by each task, so files are mapped once per task rather than once per piece
+_PIECES_PER_TASK = 64
+_ZEROS = bytes(1 << 20)
+
+# Shared by all downloads, so the total number of hashing threads is bounded (hashlib releases the GIL while hashing)
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class VerificationError(Exception):
+    pass
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = config.get_verify_workers() or os.cpu_count() or 1
+            log.debug(f"Starting verification pool with {workers} workers")
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+        return _executor
+
+
+class _PieceMap(object):
+    """The part of a torrent's layout which was downloaded locally, and the pieces which lie entirely within it"""
+
+    def __init__(self, layout: PieceLayout, local_paths: Dict[str, str]):
+        self.layout = layout
+        self.local_paths = local_paths
+        self._offsets = [offset for _, _, offset, _ in layout.files]
+        self.pieces = [index for index in range(len(layout.hashes)) if self._is_local(index)]
+
+    def ranges(self, start: int, end: int) -> List[Tuple[int, int, int]]:
+        """(file index, offset within the file, length) of every part of every file within [start, end) of the torrent"""
+        ranges: List[Tuple[int, int, int]] = []
+        i = max(0, bisect.bisect_right(self._offsets, start) - 1)
+        while start < end and i < len(self.layout.files):
+            _, length, offset, _ = self.layout.files[i]
+            if offset + length > start:
+                part = min(end, offset + length) - start
+                ranges.append((i, start - offset, part))
+                start += part
+            i += 1
+        return ranges
+
+    def _is_local(self, index: int) -> bool:
+        for file_index, _, _ in self.ranges(*self.layout.piece_span(index)):
+            path, _, _, padding = self.layout.files[file_index]
+            if not padding and path not in self.local_paths:
+                return False
+        return True
+
+
+def _hash_pieces(piece_map: _PieceMap, pieces: List[int]) -> List[int]:
+    """Hash (consecutive) pieces of a torrent from the local files, returning those which don't match"""
+    layout = piece_map.layout
+    maps: Dict[int, Optional[mmap.mmap]] = {}
+    failed: List[int] = []
+    try:
+        for index in pieces:
+            hasher = hashlib.sha1()
+            for file_index, offset, length in piece_map.ranges(*layout.piece_span(index)):
+                path, file_length, _, padding = layout.files[file_index]
+                if padding:
+                    for pos in range(0, length, len(_ZEROS)):
+                        hasher.update(_ZEROS[: min(len(_ZEROS), length - pos)])
+                    continue
+                if file_index not in maps:
+                    with open(piece_map.local_paths[path], "rb") as f:
+                        # The file was resized to its expected length before hashing, so the whole range is mapped
+                        maps[file_index] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_length else None
+                file_map = maps[file_index]
+                if file_map is not None:
+                    hasher.update(memoryview(file_map)[offset : offset + length])
+            if hasher.digest() != layout.hashes[index]:
+                failed.append(index)
+    finally:
+        for file_map in maps.values():
+            if file_map is not None:
+                file_map.close()
+    return failed
+
+
+def _hash_all(piece_map: _PieceMap, pieces: List[int]) -> List[int]:
+    tasks = [pieces[i : i + _PIECES_PER_TASK] for i in range(0, len(pieces), _PIECES_PER_TASK)]
+    futures = [_get_executor().submit(_hash_pieces, piece_map, task) for task in tasks]
+    return [index for future in futures for index in future.result()]
+
+
+def _fix_sizes(piece_map: _PieceMap) -> None:
+    """Resize local files to their length in the torrent, so truncated files fail verification (and are repaired) rather than erroring"""
+    for path, length, _, padding in piece_map.layout.files:
+        local_path = piece_map.local_paths.get(path)
+        if padding or local_path is None:
+            continue
+        size = os.path.getsize(local_path)
+        if size != length:
+            log.warning(f"{local_path} is {size} bytes instead of {length}")
+            os.truncate(local_path, length)
+
+
+def _repair(piece_map: _PieceMap, pieces: List[int], remote_paths: Dict[str, str], engine: TransferEngine) -> None:
+    """Refetch only the byte ranges of the given pieces, merging adjacent ranges of the same file"""
+    file_ranges: Dict[int, List[List[int]]] = {}
+    for index in sorted(pieces):
+        for file_index, offset, length in piece_map.ranges(*piece_map.layout.piece_span(index)):
+            if piece_map.layout.files[file_index][3]:
+                continue
+            ranges = file_ranges.setdefault(file_index, [])
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1][1] += length
+            else:
+                ranges.append([offset, length])
+    for file_index, ranges in file_ranges.items():
+        path = piece_map.layout.files[file_index][0]
+        for offset, length in ranges:
+            log.debug(f"Refetching {length} bytes of {path} at offset {offset}")
+            engine.fetch_range(remote_paths[path], piece_map.local_paths[path], offset, length)
+
+
+def verify_and_repair(layout: PieceLayout, local_paths: Dict[str, str], remote_paths: Dict[str, str], engine: TransferEngine) -> Tuple[int, int]:
+    """Check local files (keyed by their path in the torrent) against the torrent's piece hashes, refetching the ranges of pieces which fail.
+    Only pieces which lie entirely within the given (existing) files can be checked. Returns (pieces checked, pieces repaired).
+    Raises VerificationError if a piece still fails after being refetched
+    """
+    piece_map = _PieceMap(layout, local_paths)
+    if not piece_map.pieces:
+        # i.e. the local files don't match the torrent's paths, or each file is smaller than a piece and shares its pieces with missing files
+        log.warning(f"None of the {len(layout.hashes)} pieces lie entirely within the {len(local_paths)} local files, so nothing could be verified")
+        return 0, 0
+    _fix_sizes(piece_map)
+    failed = _hash_all(piece_map, piece_map.pieces)
+    if failed:
+        log.warning(f"{len(failed)} of {len(piece_map.pieces)} pieces failed verification, refetching them")
+        _repair(piece_map, failed, remote_paths, engine)
+        still_failed = _hash_all(piece_map, failed)
+        if still_failed:
+            raise VerificationError(f"{len(still_failed)} pieces still fail verification after being refetched")
+    return len(piece_map.pieces), len(failed)
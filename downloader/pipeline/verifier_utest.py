@@ -0,0 +1,129 @@
+from typing import Dict, List, Tuple
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from downloader.benchmark import fakes
+from downloader.benchmark.library import bencode
+from downloader.model.metainfo import PieceLayout
+from downloader.pipeline import verifier
+from downloader.state import state
+from downloader.transfer.engine import TransferEngine
+
+_PIECE_LENGTH = 4
+
+
+class _RangeEngine(TransferEngine):
+    """Fetches ranges by copying from a local directory standing in for the seedbox"""
+
+    def __init__(self) -> None:
+        self.fetched: List[Tuple[str, int, int]] = []
+
+    def fetch_range(self, remote_path: str, local_path: str, offset: int, length: int) -> None:
+        self.fetched.append((remote_path, offset, length))
+        with open(remote_path, "rb") as src, open(local_path, "r+b") as dst:
+            src.seek(offset)
+            dst.seek(offset)
+            dst.write(src.read(length))
+
+
+def _layout(name: str, files: Dict[str, bytes], padding: int = 0) -> PieceLayout:
+    """Torrent with a tiny piece length over the given (ordered) files, with a padding file after the first one if padding is set"""
+    entries = []
+    data = b""
+    for i, (path, content) in enumerate(files.items()):
+        entries.append({"length": len(content), "path": path.split("/")})
+        data += content
+        if i == 0 and padding:
+            entries.append({"length": padding, "path": [".pad", str(padding)], "attr": "p"})
+            data += bytes(padding)
+    pieces = b"".join(hashlib.sha1(data[i : i + _PIECE_LENGTH]).digest() for i in range(0, len(data), _PIECE_LENGTH))
+    return PieceLayout(bencode({"name": name, "piece length": _PIECE_LENGTH, "pieces": pieces, "files": entries}))
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        self.files = {"a.mkv": b"0123456789", "sub/b.nfo": b"abcdef"}
+        self.local_paths = self._write("local", self.files)
+        self.remote_paths = self._write("remote", self.files)
+
+    def _write(self, directory: str, files: Dict[str, bytes]) -> Dict[str, str]:
+        paths = {}
+        for path, content in files.items():
+            full_path = os.path.join(self.workdir, directory, "Show", path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "wb") as f:
+                f.write(content)
+            paths["Show/" + path] = full_path
+        return paths
+
+    def _read(self, path: str) -> bytes:
+        with open(self.local_paths[path], "rb") as f:
+            return f.read()
+
+    def test_piece_map_of_partial_download(self) -> None:
+        layout = _layout("Show", self.files)
+        # Pieces are [0, 4), [4, 8), [8, 12) (across both files) and [12, 16)
+        piece_map = verifier._PieceMap(layout, {"Show/a.mkv": self.local_paths["Show/a.mkv"]})
+        self.assertEqual(piece_map.pieces, [0, 1])
+        self.assertEqual(piece_map.ranges(8, 12), [(0, 8, 2), (1, 0, 2)])
+        self.assertEqual(verifier._PieceMap(layout, self.local_paths).pieces, [0, 1, 2, 3])
+
+    def test_padding_files_are_not_needed_locally(self) -> None:
+        layout = _layout("Show", self.files, padding=2)
+        piece_map = verifier._PieceMap(layout, {"Show/a.mkv": self.local_paths["Show/a.mkv"]})
+        # a.mkv and its padding end on a piece boundary
+        self.assertEqual(piece_map.pieces, [0, 1, 2])
+        self.assertEqual(verifier.verify_and_repair(layout, self.local_paths, self.remote_paths, _RangeEngine()), (len(layout.hashes), 0))
+
+    def test_intact_download(self) -> None:
+        engine = _RangeEngine()
+        self.assertEqual(verifier.verify_and_repair(_layout("Show", self.files), self.local_paths, self.remote_paths, engine), (4, 0))
+        self.assertEqual(engine.fetched, [])
+
+    def test_corrupt_piece_is_refetched(self) -> None:
+        with open(self.local_paths["Show/a.mkv"], "r+b") as f:
+            f.seek(5)
+            f.write(b"X")
+        engine = _RangeEngine()
+        self.assertEqual(verifier.verify_and_repair(_layout("Show", self.files), self.local_paths, self.remote_paths, engine), (4, 1))
+        # Only the corrupt piece was refetched
+        self.assertEqual(engine.fetched, [(self.remote_paths["Show/a.mkv"], 4, 4)])
+        self.assertEqual(self._read("Show/a.mkv"), self.files["a.mkv"])
+
+    def test_piece_across_files_is_refetched_from_both(self) -> None:
+        with open(self.local_paths["Show/sub/b.nfo"], "r+b") as f:
+            f.write(b"X")
+        engine = _RangeEngine()
+        self.assertEqual(verifier.verify_and_repair(_layout("Show", self.files), self.local_paths, self.remote_paths, engine), (4, 1))
+        self.assertEqual(engine.fetched, [(self.remote_paths["Show/a.mkv"], 8, 2), (self.remote_paths["Show/sub/b.nfo"], 0, 2)])
+        self.assertEqual(self._read("Show/sub/b.nfo"), self.files["sub/b.nfo"])
+
+    def test_truncated_file_is_repaired(self) -> None:
+        os.truncate(self.local_paths["Show/sub/b.nfo"], 3)
+        engine = _RangeEngine()
+        self.assertEqual(verifier.verify_and_repair(_layout("Show", self.files), self.local_paths, self.remote_paths, engine), (4, 1))
+        self.assertEqual(self._read("Show/sub/b.nfo"), self.files["sub/b.nfo"])
+
+    def test_no_local_pieces_is_logged(self) -> None:
+        local_paths = {"Other/a.mkv": self.local_paths["Show/a.mkv"]}
+        with self.assertLogs("verifier", "WARNING"):
+            self.assertEqual(verifier.verify_and_repair(_layout("Show", self.files), local_paths, self.remote_paths, _RangeEngine()), (0, 0))
+
+    def test_piece_which_still_fails_raises(self) -> None:
+        # The seedbox copy is corrupt too, so refetching can't help
+        for paths in (self.local_paths, self.remote_paths):
+            with open(paths["Show/a.mkv"], "r+b") as f:
+                f.write(b"X")
+        with self.assertRaises(verifier.VerificationError):
+            verifier.verify_and_repair(_layout("Show", self.files), self.local_paths, self.remote_paths, _RangeEngine())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+from typing import List, Dict, Optional
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+
+log = logging.getLogger("watcher")
+
+# Constants from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_event_header = struct.Struct("iIII")
+
+_libc = None
+if hasattr(os, "uname") and os.uname().sysname == "Linux":
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(_libc, "inotify_init1"):
+            _libc = None
+    except OSError:
+        _libc = None
+
+
+def is_available() -> bool:
+    """Whether or not inotify can be used on this system"""
+    return _libc is not None
+
+
+class WatchDirOverflow(Exception):
+    """Raised when the kernel dropped events, meaning the watch directories must be fully rescanned"""
+
+
+class WatchDirLost(Exception):
+    """Raised when a watch directory was deleted or moved away, meaning it must be watched again (once it exists) and rescanned"""
+
+
+class InotifyWatcher(object):
+    """Watches directories for files which have finished being written, or were moved in"""
+
+    def __init__(self, directories: List[str]):
+        if _libc is None:
+            raise Exception("inotify is not available on this system")
+        self._fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._directories: Dict[int, str] = {}
+        for directory in directories:
+            wd = _libc.inotify_add_watch(self._fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVE_SELF)
+            if wd < 0:
+                # i.e. the directory doesn't exist, or the limit of watches per user was reached
+                err = ctypes.get_errno()
+                self.close()
+                raise OSError(err, os.strerror(err), directory)
+            self._directories[wd] = directory
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def _read_events(self, new_files: Dict[str, List[str]]) -> None:
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = os.fsdecode(data[offset : offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            if mask & _IN_Q_OVERFLOW:
+                raise WatchDirOverflow()
+            if mask & (_IN_IGNORED | _IN_MOVE_SELF) and wd in self._directories:
+                # The kernel removed the watch (the directory was deleted or unmounted), or it now follows the directory somewhere else
+                raise WatchDirLost(self._directories[wd])
+            if mask & (_IN_IGNORED | _IN_ISDIR) or wd not in self._directories:
+                continue
+            files = new_files.setdefault(self._directories[wd], [])
+            if name not in files:
+                files.append(name)
+
+    def wait_for_batch(self, timeout: float, settle_time: float = 0.5, max_batch_time: float = 5) -> Optional[Dict[str, List[str]]]:
+        """Wait up to timeout seconds for new files. Once a file arrives, keep collecting until no new files arrive for settle_time seconds
+        (or max_batch_time has passed) so that bursts of files are returned as one batch.
+        Returns a dict of watch directory to new file names, or None if nothing arrived before the timeout
+        """
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return None
+        new_files: Dict[str, List[str]] = {}
+        batch_deadline = time.monotonic() + max_batch_time
+        self._read_events(new_files)
+        while True:
+            remaining = batch_deadline - time.monotonic()
+            if remaining <= 0 or not poller.poll(min(settle_time, remaining) * 1000):
+                break
+            self._read_events(new_files)
+        return new_files or None
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from downloader.pipeline import watcher
+
+
+@unittest.skipUnless(watcher.is_available(), "inotify is not available")
+class InotifyWatcherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.watch_dir = os.path.join(self.workdir, "watch")
+        os.makedirs(self.watch_dir)
+
+    def _watch(self) -> watcher.InotifyWatcher:
+        inotify_watcher = watcher.InotifyWatcher([self.watch_dir])
+        self.addCleanup(inotify_watcher.close)
+        return inotify_watcher
+
+    def test_new_files(self) -> None:
+        inotify_watcher = self._watch()
+        self.assertIsNone(inotify_watcher.wait_for_batch(0.01))
+        for name in ("a.torrent", "b.torrent"):
+            with open(os.path.join(self.watch_dir, name), "wb") as f:
+                f.write(b"d4:infodee")
+        os.mkdir(os.path.join(self.watch_dir, "subdir"))
+        with open(os.path.join(self.workdir, "c.magnet"), "w") as f:
+            f.write("magnet:?")
+        os.rename(os.path.join(self.workdir, "c.magnet"), os.path.join(self.watch_dir, "c.magnet"))
+        self.assertEqual(inotify_watcher.wait_for_batch(1, settle_time=0.01), {self.watch_dir: ["a.torrent", "b.torrent", "c.magnet"]})
+
+    def test_missing_directory(self) -> None:
+        with self.assertRaises(OSError):
+            watcher.InotifyWatcher([self.watch_dir, os.path.join(self.workdir, "missing")])
+
+    def test_deleted_directory_is_lost(self) -> None:
+        inotify_watcher = self._watch()
+        os.rmdir(self.watch_dir)
+        with self.assertRaises(watcher.WatchDirLost):
+            inotify_watcher.wait_for_batch(1, settle_time=0.01)
+        # Once it is recreated it can be watched again
+        os.makedirs(self.watch_dir)
+        self.assertIsNone(self._watch().wait_for_batch(0.01))
+
+    def test_moved_directory_is_lost(self) -> None:
+        inotify_watcher = self._watch()
+        os.rename(self.watch_dir, os.path.join(self.workdir, "moved"))
+        with self.assertRaises(watcher.WatchDirLost):
+            inotify_watcher.wait_for_batch(1, settle_time=0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,49 @@ import json
 config_cache: Dict[str, Any] = {}
 
 
+def _validate_seedbox(entry: Dict[str, Any], where: str) -> None:
+    """Validate the sftp and torrent client options of a seedbox, which are either top level in config.json or in a seedboxes entry"""
+    if not isinstance(entry.get("sftp_host"), str):
+        raise Exception(f"sftp_host must exist in {where} and be a string")
+    if not isinstance(entry.get("sftp_port"), int):
+        raise Exception(f"sftp_port must exist in {where} and be an integer")
+    if not isinstance(entry.get("sftp_user"), str):
+        raise Exception(f"sftp_user must exist in {where} and be a string")
+    if not isinstance(entry.get("sftp_password"), str):
+        raise Exception(f"sftp_password must exist in {where} and be a string")
+    # Torrent client option checking
+    if entry.get("torrent_client_type") != "deluge" and entry.get("torrent_client_type") != "transmission":
+        raise Exception(f"torrent_client_type must be either 'deluge' or 'transmission' in {where}")
+    torrent_client_opts = entry.get("torrent_client_options")
+    if not isinstance(torrent_client_opts, dict):
+        raise Exception(f"torrent_client_options must exist in {where} and be an object")
+    if entry.get("torrent_client_type") == "deluge":
+        if not isinstance(torrent_client_opts.get("deluge_rpc_addr"), str):
+            raise Exception(f"deluge_rpc_addr must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("deluge_rpc_port"), int):
+            raise Exception(f"deluge_rpc_port must exist in {where} and be an integer")
+        if not isinstance(torrent_client_opts.get("deluge_rpc_user"), str):
+            raise Exception(f"deluge_rpc_user must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("deluge_rpc_password"), str):
+            raise Exception(f"deluge_rpc_password must exist in {where} and be a string")
+    elif entry.get("torrent_client_type") == "transmission":
+        if not isinstance(torrent_client_opts.get("transmission_rpc_addr"), str):
+            raise Exception(f"transmission_rpc_addr must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("transmission_rpc_port"), int):
+            raise Exception(f"transmission_rpc_port must exist in {where} and be an integer")
+        if not isinstance(torrent_client_opts.get("transmission_rpc_path"), str):
+            raise Exception(f"transmission_rpc_path must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("transmission_rpc_user"), str):
+            raise Exception(f"transmission_rpc_user must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("transmission_rpc_password"), str):
+            raise Exception(f"transmission_rpc_password must exist in {where} and be a string")
+        if not isinstance(torrent_client_opts.get("transmission_rpc_verified_tls"), bool):
+            raise Exception(f"transmission_rpc_verified_tls must exist in {where} and be a boolean")
+    for key in ("pget_conn", "mirror_parallel", "mirror_conn"):
+        if not isinstance(entry.get(key, 1), int):
+            raise Exception(f"{key} must be an integer if provided in {where}")
+
+
 def _load_config_if_necessary() -> None:
     global config_cache
     if not config_cache:
@@ -12,52 +55,97 @@ def _load_config_if_necessary() -> None:
             # Validate config file
             if not isinstance(config_cache.get("state_json"), str):
                 raise Exception("state_json must exist in config.json and be a string")
-            if not isinstance(config_cache.get("sftp_host"), str):
-                raise Exception("sftp_host must exist in config.json and be a string")
-            if not isinstance(config_cache.get("sftp_port"), int):
-                raise Exception("sftp_port must exist in config.json and be an integer")
-            if not isinstance(config_cache.get("sftp_user"), str):
-                raise Exception("sftp_user must exist in config.json and be a string")
-            if not isinstance(config_cache.get("sftp_password"), str):
-                raise Exception("sftp_password must exist in config.json and be a string")
+            if not isinstance(config_cache.get("state_db", ""), str):
+                raise Exception("state_db must be a string if provided")
+            if "seedboxes" in config_cache:
+                seedboxes = config_cache["seedboxes"]
+                if not isinstance(seedboxes, list) or not seedboxes:
+                    raise Exception("seedboxes must be a non-empty array if provided")
+                names = set()
+                for seedbox in seedboxes:
+                    if not isinstance(seedbox, dict) or not isinstance(seedbox.get("name"), str) or not seedbox["name"]:
+                        raise Exception("every seedboxes entry must be an object with a non-empty name string")
+                    if seedbox["name"] in names:
+                        raise Exception(f"seedbox name {seedbox['name']} is used more than once")
+                    names.add(seedbox["name"])
+                    _validate_seedbox(seedbox, f"seedboxes entry {seedbox['name']}")
+            else:
+                _validate_seedbox(config_cache, "config.json")
+            if config_cache.get("placement", "queue") not in ("queue", "free_space"):
+                raise Exception("placement must be one of 'queue' or 'free_space' if provided")
+            if not isinstance(config_cache.get("max_download_rate", 0), int) or config_cache.get("max_download_rate", 0) < 0:
+                raise Exception("max_download_rate must be a non-negative integer if provided")
             if not isinstance(config_cache.get("pget_conn"), int):
                 raise Exception("pget_conn must exist in config.json and be an integer")
             if not isinstance(config_cache.get("mirror_parallel"), int):
                 raise Exception("mirror_parallel must exist in config.json and be an integer")
             if not isinstance(config_cache.get("mirror_conn"), int):
                 raise Exception("mirror_conn must exist in config.json and be an integer")
-            # Torrent client option checking
-            if config_cache.get("torrent_client_type") != "deluge" and config_cache.get("torrent_client_type") != "transmission":
-                raise Exception("torrent_client_type must be either 'deluge' or 'transmission'")
-            torrent_client_opts = config_cache.get("torrent_client_options")
-            if not isinstance(torrent_client_opts, dict):
-                raise Exception("torrent_client_options must exist in config.json and be an object")
-            if config_cache.get("torrent_client_type") == "deluge":
-                if not isinstance(torrent_client_opts.get("deluge_rpc_addr"), str):
-                    raise Exception("deluge_rpc_addr must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("deluge_rpc_port"), int):
-                    raise Exception("deluge_rpc_port must exist in config.json and be an integer")
-                if not isinstance(torrent_client_opts.get("deluge_rpc_user"), str):
-                    raise Exception("deluge_rpc_user must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("deluge_rpc_password"), str):
-                    raise Exception("deluge_rpc_password must exist in config.json and be a string")
-            elif config_cache.get("torrent_client_type") == "transmission":
-                if not isinstance(torrent_client_opts.get("transmission_rpc_addr"), str):
-                    raise Exception("transmission_rpc_addr must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("transmission_rpc_port"), int):
-                    raise Exception("transmission_rpc_port must exist in config.json and be an integer")
-                if not isinstance(torrent_client_opts.get("transmission_rpc_path"), str):
-                    raise Exception("transmission_rpc_path must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("transmission_rpc_user"), str):
-                    raise Exception("transmission_rpc_user must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("transmission_rpc_password"), str):
-                    raise Exception("transmission_rpc_password must exist in config.json and be a string")
-                if not isinstance(torrent_client_opts.get("transmission_rpc_verified_tls"), bool):
-                    raise Exception("transmission_rpc_verified_tls must exist in config.json and be a boolean")
-
+            if config_cache.get("transfer_engine", "lftp") not in ("lftp", "sftp", "local"):
+                raise Exception("transfer_engine must be one of 'lftp', 'sftp', or 'local' if provided")
+            if not isinstance(config_cache.get("download_workers", 1), int) or config_cache.get("download_workers", 1) < 1:
+                raise Exception("download_workers must be a positive integer if provided")
+            if not isinstance(config_cache.get("post_process_workers", 2), int) or config_cache.get("post_process_workers", 2) < 1:
+                raise Exception("post_process_workers must be a positive integer if provided")
+            if not isinstance(config_cache.get("extract_workers", 0), int) or config_cache.get("extract_workers", 0) < 0:
+                raise Exception("extract_workers must be a non-negative integer if provided")
+            if not isinstance(config_cache.get("verify_workers", 0), int) or config_cache.get("verify_workers", 0) < 0:
+                raise Exception("verify_workers must be a non-negative integer if provided")
+            if not isinstance(config_cache.get("move_workers", 4), int) or config_cache.get("move_workers", 4) < 1:
+                raise Exception("move_workers must be a positive integer if provided")
+            if not isinstance(config_cache.get("max_sftp_connections", 0), int):
+                raise Exception("max_sftp_connections must be an integer if provided")
+            if not isinstance(config_cache.get("min_free_space", 0), int) or config_cache.get("min_free_space", 0) < 0:
+                raise Exception("min_free_space must be a non-negative integer if provided")
+            if not isinstance(config_cache.get("preallocate", False), bool):
+                raise Exception("preallocate must be a boolean if provided")
+            if not isinstance(config_cache.get("completion_events", True), bool):
+                raise Exception("completion_events must be a boolean if provided")
+            if not isinstance(config_cache.get("reconcile_interval", 300), (int, float)) or config_cache.get("reconcile_interval", 300) <= 0:
+                raise Exception("reconcile_interval must be a positive number if provided")
+            if not isinstance(config_cache.get("watch_interval", 2), (int, float)) or config_cache.get("watch_interval", 2) <= 0:
+                raise Exception("watch_interval must be a positive number if provided")
+            if not isinstance(config_cache.get("poll_interval", 15), (int, float)) or config_cache.get("poll_interval", 15) <= 0:
+                raise Exception("poll_interval must be a positive number if provided")
+            if not isinstance(config_cache.get("poll_min_interval", 2), (int, float)) or config_cache.get("poll_min_interval", 2) <= 0:
+                raise Exception("poll_min_interval must be a positive number if provided")
+            if not isinstance(config_cache.get("poll_max_interval", 300), (int, float)) or config_cache.get("poll_max_interval", 300) <= 0:
+                raise Exception("poll_max_interval must be a positive number if provided")
+            if config_cache.get("poll_min_interval", 2) > config_cache.get("poll_max_interval", 300):
+                raise Exception("poll_min_interval must not be greater than poll_max_interval")
+            if config_cache.get("queue_policy", "fifo") not in ("fifo", "sjf"):
+                raise Exception("queue_policy must be one of 'fifo' or 'sjf' if provided")
+            if not isinstance(config_cache.get("add_concurrency", 8), int) or config_cache.get("add_concurrency", 8) < 1:
+                raise Exception("add_concurrency must be a positive integer if provided")
+            if config_cache.get("watch_mode", "auto") not in ("auto", "inotify", "poll"):
+                raise Exception("watch_mode must be one of 'auto', 'inotify', or 'poll' if provided")
+            if not isinstance(config_cache.get("watch_rescan_interval", 60), (int, float)) or config_cache.get("watch_rescan_interval", 60) <= 0:
+                raise Exception("watch_rescan_interval must be a positive number if provided")
+            metrics_config = config_cache.get("metrics", {})
+            if not isinstance(metrics_config, dict):
+                raise Exception("metrics must be an object if provided")
+            if metrics_config and not isinstance(metrics_config.get("port"), int):
+                raise Exception("metrics port must exist and be an integer if metrics is provided")
+            if not isinstance(metrics_config.get("bind", ""), str):
+                raise Exception("metrics bind must be a string if provided")
             if not isinstance(config_cache.get("torrent_watch_dirs"), list):
                 raise Exception("torrent_watch_dirs must exist in config.json and be an array")
             # TODO torrent_watch_dirs content verification
+            for watch_dir in config_cache["torrent_watch_dirs"]:
+                if not isinstance(watch_dir.get("max_concurrent_downloads", 0), int):
+                    raise Exception("max_concurrent_downloads must be an integer if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("direct_to_final", False), bool):
+                    raise Exception("direct_to_final must be a boolean if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("verify_pieces", False), bool):
+                    raise Exception("verify_pieces must be a boolean if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("early_transfer", False), bool):
+                    raise Exception("early_transfer must be a boolean if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("stream_extract", False), bool):
+                    raise Exception("stream_extract must be a boolean if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("priority", 0), int):
+                    raise Exception("priority must be an integer if provided in a torrent_watch_dirs entry")
+                if not isinstance(watch_dir.get("weight", 1), (int, float)) or watch_dir.get("weight", 1) <= 0:
+                    raise Exception("weight must be a positive number if provided in a torrent_watch_dirs entry")
 
 
 def get_state_json_path() -> str:
@@ -65,22 +153,60 @@ def get_state_json_path() -> str:
     return config_cache["state_json"]
 
 
-def get_torrent_client_type() -> str:
+def get_state_db_path() -> str:
+    """Returns the path of the sqlite state database. Defaults to the state_json path with a .db extension"""
     _load_config_if_necessary()
-    return config_cache["torrent_client_type"]
+    if config_cache.get("state_db"):
+        return config_cache["state_db"]
+    json_path = config_cache["state_json"]
+    return (json_path[:-5] if json_path.endswith(".json") else json_path) + ".db"
 
 
-def get_torrent_client_config() -> Dict[str, Any]:
+def get_seedbox_names() -> List[str]:
+    """Returns the names of the configured seedboxes, in config order. Without a seedboxes list, the top level options are seedbox 'default'"""
     _load_config_if_necessary()
-    options = config_cache["torrent_client_options"]
-    if config_cache["torrent_client_type"] == "deluge":
+    if "seedboxes" in config_cache:
+        return [seedbox["name"] for seedbox in config_cache["seedboxes"]]
+    return ["default"]
+
+
+def get_seedbox_name(name: str) -> str:
+    """Returns the name of the seedbox that name refers to. State from before there were several seedboxes refers to
+    the top level options (with an empty name, or 'default'), which are taken to be the first seedbox
+    """
+    names = get_seedbox_names()
+    if not name or (name == "default" and name not in names):
+        return names[0]
+    return name
+
+
+def _get_seedbox(name: str) -> Dict[str, Any]:
+    resolved = get_seedbox_name(name)
+    if "seedboxes" not in config_cache:
+        if resolved != "default":
+            raise Exception(f"seedbox {name} is not configured")
+        return config_cache
+    for seedbox in config_cache["seedboxes"]:
+        if seedbox["name"] == resolved:
+            return seedbox
+    raise Exception(f"seedbox {name} is not configured")
+
+
+def get_torrent_client_type(seedbox: str = "") -> str:
+    return _get_seedbox(seedbox)["torrent_client_type"]
+
+
+def get_torrent_client_config(seedbox: str = "") -> Dict[str, Any]:
+    entry = _get_seedbox(seedbox)
+    options = entry["torrent_client_options"]
+    if entry["torrent_client_type"] == "deluge":
         return {
             "host": options["deluge_rpc_addr"],
             "port": options["deluge_rpc_port"],
             "username": options["deluge_rpc_user"],
             "password": options["deluge_rpc_password"],
         }
-    elif config_cache["torrent_client_type"] == "transmission":
+    elif entry["torrent_client_type"] == "transmission":
         return {
             "protocol": "https" if options["transmission_rpc_verified_tls"] else "http",
             "username": options["transmission_rpc_user"],
@@ -90,27 +216,168 @@ def get_torrent_client_config() -> Dict[str, Any]:
             "path": options["transmission_rpc_path"],
         }
     else:
-        raise NotImplementedError(f"torrent client type {config_cache['torrent_client_type']} not implemented")
+        raise NotImplementedError(f"torrent client type {entry['torrent_client_type']} not implemented")
 
 
-def get_sftp_options() -> Dict[str, str]:
-    _load_config_if_necessary()
+def get_sftp_options(seedbox: str = "") -> Dict[str, Any]:
+    """Returns the sftp options of a seedbox. Connection counts can be set per seedbox, otherwise the top level ones are used"""
+    entry = _get_seedbox(seedbox)
     return {
-        "host": config_cache["sftp_host"],
-        "port": config_cache["sftp_port"],
-        "username": config_cache["sftp_user"],
-        "password": config_cache["sftp_password"],
-        "pget_conn": config_cache["pget_conn"],
-        "mirror_parallel": config_cache["mirror_parallel"],
-        "mirror_conn": config_cache["mirror_conn"],
+        "host": entry["sftp_host"],
+        "port": entry["sftp_port"],
+        "username": entry["sftp_user"],
+        "password": entry["sftp_password"],
+        "pget_conn": entry.get("pget_conn", config_cache["pget_conn"]),
+        "mirror_parallel": entry.get("mirror_parallel", config_cache["mirror_parallel"]),
+        "mirror_conn": entry.get("mirror_conn", config_cache["mirror_conn"]),
     }
 
 
+def get_placement() -> str:
+    """Returns how new torrents are placed on seedboxes: 'queue' (fewest watched torrents) or 'free_space' (most free space)"""
+    _load_config_if_necessary()
+    return config_cache.get("placement", "queue")
+
+
+def get_max_download_rate() -> int:
+    """Returns the combined transfer rate limit across all seedboxes and transfers in bytes per second (0 for unlimited)"""
+    _load_config_if_necessary()
+    return config_cache.get("max_download_rate", 0)
+
+
 def get_torrent_watch_dirs() -> List[Dict[str, Any]]:
     _load_config_if_necessary()
     return config_cache["torrent_watch_dirs"]
 
 
+def get_torrent_watch_dir(directory: str) -> Dict[str, Any]:
+    """Returns the torrent_watch_dirs entry for a watch directory, or an empty dict if it is no longer configured"""
+    _load_config_if_necessary()
+    for watch_dir in config_cache["torrent_watch_dirs"]:
+        if watch_dir["directory"] == directory:
+            return watch_dir
+    return {}
+
+
 def get_chmod_config() -> Dict[str, int]:
     _load_config_if_necessary()
     return config_cache.get("chmod_download", False)
+
+
+def get_transfer_engine() -> str:
+    """Returns which transfer engine to use: 'lftp', 'sftp' (native, in-process), or 'local' (remote paths are read from the local filesystem)"""
+    _load_config_if_necessary()
+    return config_cache.get("transfer_engine", "lftp")
+
+
+def get_download_workers() -> int:
+    _load_config_if_necessary()
+    return config_cache.get("download_workers", 1)
+
+
+def get_post_process_workers() -> int:
+    """Returns how many transferred downloads can be post-processed (extracted, chmod-ed, moved) at the same time"""
+    _load_config_if_necessary()
+    return config_cache.get("post_process_workers", 2)
+
+
+def get_extract_workers() -> int:
+    """Returns how many extract commands can run at the same time (0 to use the number of cpus)"""
+    _load_config_if_necessary()
+    return config_cache.get("extract_workers", 0)
+
+
+def get_verify_workers() -> int:
+    """Returns how many threads hash downloaded data for piece verification across all downloads (0 to use the number of cpus)"""
+    _load_config_if_necessary()
+    return config_cache.get("verify_workers", 0)
+
+
+def get_move_workers() -> int:
+    """Returns how many files are copied at the same time when moving a download across filesystems"""
+    _load_config_if_necessary()
+    return config_cache.get("move_workers", 4)
+
+
+def get_max_sftp_connections() -> int:
+    """Returns the maximum number of simultaneous sftp connections across all downloads (0 for unlimited)"""
+    _load_config_if_necessary()
+    return config_cache.get("max_sftp_connections", 0)
+
+
+def get_min_free_space() -> int:
+    """Returns the number of bytes which downloads must leave free on each filesystem they are downloaded to"""
+    _load_config_if_necessary()
+    return config_cache.get("min_free_space", 0)
+
+
+def get_queue_policy() -> str:
+    """Returns the order downloads of the same watch dir and priority are started in: 'fifo' (as queued) or 'sjf' (smallest first)"""
+    _load_config_if_necessary()
+    return config_cache.get("queue_policy", "fifo")
+
+
+def get_preallocate() -> bool:
+    """Returns whether transferred files are allocated at their full size before any data is written, to avoid fragmentation"""
+    _load_config_if_necessary()
+    return config_cache.get("preallocate", False)
+
+
+def get_watch_interval() -> float:
+    """Returns the number of seconds between checks of the watch directories"""
+    _load_config_if_necessary()
+    return config_cache.get("watch_interval", 2)
+
+
+def get_watch_mode() -> str:
+    """Returns how watch directories are monitored: 'inotify', 'poll', or 'auto' (inotify when available)"""
+    _load_config_if_necessary()
+    return config_cache.get("watch_mode", "auto")
+
+
+def get_watch_rescan_interval() -> float:
+    """Returns the maximum number of seconds between full rescans of the watch directories when using inotify"""
+    _load_config_if_necessary()
+    return config_cache.get("watch_rescan_interval", 60)
+
+
+def get_add_concurrency() -> int:
+    """Returns the maximum number of torrents which are submitted to the torrent client at the same time"""
+    _load_config_if_necessary()
+    return config_cache.get("add_concurrency", 8)
+
+
+def get_poll_interval() -> float:
+    """Returns the number of seconds until a torrent whose completion can't be estimated is checked again, before backing off"""
+    _load_config_if_necessary()
+    return config_cache.get("poll_interval", 15)
+
+
+def get_poll_min_interval() -> float:
+    """Returns the minimum number of seconds between checks of a torrent, however close to completing it is"""
+    _load_config_if_necessary()
+    return config_cache.get("poll_min_interval", 2)
+
+
+def get_poll_max_interval() -> float:
+    """Returns the maximum number of seconds between checks of a torrent, however far from completing (or idle) it is"""
+    _load_config_if_necessary()
+    return config_cache.get("poll_max_interval", 300)
+
+
+def get_completion_events() -> bool:
+    """Returns whether torrent clients which can push completions (deluge) are listened to, rather than only polled"""
+    _load_config_if_necessary()
+    return config_cache.get("completion_events", True)
+
+
+def get_reconcile_interval() -> float:
+    """Returns the number of seconds between polls of the torrent clients when every one of them pushes completions"""
+    _load_config_if_necessary()
+    return config_cache.get("reconcile_interval", 300)
+
+
+def get_metrics_config() -> Dict[str, Any]:
+    """Returns the options for the metrics http endpoint ({"port": int, "bind": str}), or an empty dict if it is disabled"""
+    _load_config_if_necessary()
+    return config_cache.get("metrics", {})
@@ -1,26 +1,114 @@
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, Optional
+import os
 import json
+import sqlite3
 import logging
+import threading
+import contextlib
 
 from downloader.state import config
 
 log = logging.getLogger("state")
 
-current_state = {}
+# State is persisted in sqlite, with an in-memory index of watching torrents so reads never touch the disk
+_db: Optional[sqlite3.Connection] = None
+_watching: Dict[str, Dict[str, Any]] = {}
+# Depth of nested batch() contexts; commits are deferred until the outermost batch exits
+_batch_depth = 0
+# State can be modified by the main loop and by download workers concurrently
+_lock = threading.RLock()
 
+_SCHEMA_VERSION = 3
 
-def _load_state() -> None:
-    global current_state
+
+def _import_json_state(db: sqlite3.Connection) -> bool:
+    """Import the legacy state json file (if it exists) into the sqlite database. Returns whether anything was imported"""
+    json_path = config.get_state_json_path()
     try:
-        with open(config.get_state_json_path()) as f:
-            current_state = json.load(f)
+        with open(json_path) as f:
+            legacy_state = json.load(f)
     except FileNotFoundError:
-        log.warning("state file not found")
+        return False
+    watching = legacy_state.get("watching_torrents", {})
+    log.info(f"Migrating {len(watching)} watching torrents from {json_path} to {config.get_state_db_path()}")
+    db.executemany(
+        "INSERT OR REPLACE INTO watching_torrents (infohash, data) VALUES (?, ?)",
+        [(infohash, json.dumps(data, ensure_ascii=False)) for infohash, data in watching.items()],
+    )
+    return True
+
+
+def _reload_index(db: sqlite3.Connection) -> None:
+    _watching.clear()
+    for infohash, data in db.execute("SELECT infohash, data FROM watching_torrents"):
+        _watching[infohash] = json.loads(data)
+
+
+def _open_db_if_necessary() -> sqlite3.Connection:
+    global _db
+    if _db is None:
+        # isolation_level=None so that transactions are only ever opened explicitly (single statements are atomic on their own)
+        db = sqlite3.connect(config.get_state_db_path(), isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version < _SCHEMA_VERSION:
+            db.execute("BEGIN")
+            db.execute("CREATE TABLE IF NOT EXISTS watching_torrents (infohash TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            # Raw info dicts (with piece hashes) of watched torrents, which aren't kept in memory since they can be large
+            db.execute("CREATE TABLE IF NOT EXISTS metainfo (infohash TEXT PRIMARY KEY, info BLOB NOT NULL)")
+            # The last pipeline stage each download object of a watched torrent finished, so a restart resumes from there
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (infohash TEXT NOT NULL, remote_path TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (infohash, remote_path))"
+            )
+            migrated = _import_json_state(db) if version < 1 else False
+            db.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+            db.execute("COMMIT")
+            if migrated:
+                # Keep the old file around in case it's needed, but renamed so it's obvious that it is no longer used
+                json_path = config.get_state_json_path()
+                os.replace(json_path, json_path + ".migrated")
+        _reload_index(db)
+        _db = db
+    return _db
+
 
+def close() -> None:
+    """Close the state database. It is reopened (from the configured state_db) on next use"""
+    global _db
+    with _lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+        _watching.clear()
 
-def _save_state() -> None:
-    with open(config.get_state_json_path(), "w") as f:
-        json.dump(current_state, f, ensure_ascii=False, indent=2)
+
+def _write(sql: str, params: Any) -> None:
+    """Execute a modifying statement. This is committed immediately unless it is part of a batch"""
+    _open_db_if_necessary().execute(sql, params)
+
+
+@contextlib.contextmanager
+def batch() -> Iterator[None]:
+    """Group all state modifications made inside this context into a single atomic commit"""
+    global _batch_depth
+    with _lock:
+        db = _open_db_if_necessary()
+        if _batch_depth == 0:
+            db.execute("BEGIN")
+        _batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            _batch_depth -= 1
+            if _batch_depth == 0:
+                db.execute("ROLLBACK")
+                _reload_index(db)
+            raise
+        _batch_depth -= 1
+        if _batch_depth == 0:
+            db.execute("COMMIT")
 
 
 def get_watching_torrents() -> Dict[str, Dict[str, Any]]:
@@ -29,31 +117,91 @@ def get_watching_torrents() -> Dict[str, Dict[str, Any]]:
     final_dir: final local download directory (to move too upon download completion)
     auto_extract: bool of whether or not to attempt auto extraction to the download (if necesssary)
     auto_delete_extracted: bool of whether or not to automatically delete archive files after auto extracting (if necessary)
+    watch_dir: the watch directory that this torrent was added from (may be missing for older state)
+    seedbox: name of the seedbox the torrent was added to (may be missing for older state, meaning the first configured seedbox)
+    priority: priority of the torrent's downloads, overriding that of its watch dir (None or missing if it doesn't have its own)
     """
-    _load_state()
-    return current_state.get("watching_torrents", {})
+    with _lock:
+        _open_db_if_necessary()
+        return dict(_watching)
 
 
 def remove_watching_torrent(torrent_id: str) -> None:
-    _load_state()
-    try:
-        del current_state["watching_torrents"][torrent_id]
-        _save_state()
-    except KeyError:
-        log.warning(f"tried to delete torrent {torrent_id} which was not being watched")
+    with _lock:
+        _open_db_if_necessary()
+        if torrent_id not in _watching:
+            log.warning(f"tried to delete torrent {torrent_id} which was not being watched")
+            return
+        # Together, so that no metainfo or checkpoints are left behind to be picked up if the torrent is added again
+        with batch():
+            _write("DELETE FROM watching_torrents WHERE infohash = ?", (torrent_id,))
+            _write("DELETE FROM metainfo WHERE infohash = ?", (torrent_id,))
+            _write("DELETE FROM checkpoints WHERE infohash = ?", (torrent_id,))
+        del _watching[torrent_id]
 
 
 def add_watching_torrent(
-    torrent_id: str, temp_dir: str, final_dir: str, name: str = "", auto_extract: bool = False, auto_delete_extracted: bool = False
+    torrent_id: str,
+    temp_dir: str,
+    final_dir: str,
+    name: str = "",
+    auto_extract: bool = False,
+    auto_delete_extracted: bool = False,
+    watch_dir: str = "",
+    seedbox: str = "",
+    priority: Optional[int] = None,
 ) -> None:
-    _load_state()
-    new_watching = current_state.get("watching_torrents", {})
-    new_watching[torrent_id] = {
+    data = {
         "temp_dir": temp_dir,
         "final_dir": final_dir,
         "name": name,
         "auto_extract": auto_extract,
         "auto_delete_extracted": auto_delete_extracted,
+        "watch_dir": watch_dir,
+        "seedbox": seedbox,
+        "priority": priority,
     }
-    current_state["watching_torrents"] = new_watching
-    _save_state()
+    with _lock:
+        _write("INSERT OR REPLACE INTO watching_torrents (infohash, data) VALUES (?, ?)", (torrent_id, json.dumps(data, ensure_ascii=False)))
+        _watching[torrent_id] = data
+
+
+def save_metainfo(torrent_id: str, info: bytes) -> None:
+    """Keep the raw info dict of a watched torrent (removed along with the torrent), so its data can be verified against its piece hashes"""
+    with _lock:
+        _write("INSERT OR REPLACE INTO metainfo (infohash, info) VALUES (?, ?)", (torrent_id, info))
+
+
+def get_metainfo(torrent_id: str) -> Optional[bytes]:
+    with _lock:
+        row = _open_db_if_necessary().execute("SELECT info FROM metainfo WHERE infohash = ?", (torrent_id,)).fetchone()
+        return row[0] if row else None
+
+
+def save_checkpoint(torrent_id: str, remote_path: str, data: Dict[str, Any]) -> None:
+    """Record the progress of a download object of a watched torrent (removed along with the torrent).
+    data must be json serializable, and has at least a "stage" key
+    """
+    with _lock:
+        _write(
+            "INSERT OR REPLACE INTO checkpoints (infohash, remote_path, data) VALUES (?, ?, ?)",
+            (torrent_id, remote_path, json.dumps(data, ensure_ascii=False)),
+        )
+
+
+def get_checkpoint(torrent_id: str, remote_path: str) -> Dict[str, Any]:
+    """Returns the last recorded progress of a download object, or an empty dict if nothing was recorded"""
+    with _lock:
+        row = (
+            _open_db_if_necessary()
+            .execute("SELECT data FROM checkpoints WHERE infohash = ? AND remote_path = ?", (torrent_id, remote_path))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else {}
+
+
+def get_checkpoints(torrent_id: str) -> Dict[str, Dict[str, Any]]:
+    """Returns the last recorded progress of every download object of a torrent, keyed by remote path"""
+    with _lock:
+        rows = _open_db_if_necessary().execute("SELECT remote_path, data FROM checkpoints WHERE infohash = ?", (torrent_id,)).fetchall()
+        return {remote_path: json.loads(data) for remote_path, data in rows}
@@ -0,0 +1,48 @@
+from typing import Any
+import sqlite3
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.state import state
+
+_INFOHASH = "a" * 40
+
+
+class RemoveWatchingTorrentTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        state.add_watching_torrent(_INFOHASH, "/temp", "/final", "Show")
+        state.save_metainfo(_INFOHASH, b"d4:infoe")
+        state.save_checkpoint(_INFOHASH, "/remote/Show", {"stage": "transferred"})
+
+    def test_everything_of_the_torrent_is_removed(self) -> None:
+        state.remove_watching_torrent(_INFOHASH)
+        state.close()
+        self.assertNotIn(_INFOHASH, state.get_watching_torrents())
+        self.assertIsNone(state.get_metainfo(_INFOHASH))
+        self.assertEqual(state.get_checkpoints(_INFOHASH), {})
+
+    def test_interrupted_removal_leaves_the_torrent_as_it_was(self) -> None:
+        write = state._write
+
+        def fail_on_checkpoints(sql: str, params: Any) -> None:
+            if "checkpoints" in sql:
+                raise sqlite3.OperationalError("disk I/O error")
+            write(sql, params)
+
+        with mock.patch.object(state, "_write", fail_on_checkpoints), self.assertRaises(sqlite3.OperationalError):
+            state.remove_watching_torrent(_INFOHASH)
+        state.close()
+        self.assertIn(_INFOHASH, state.get_watching_torrents())
+        self.assertIsNotNone(state.get_metainfo(_INFOHASH))
+        self.assertEqual(state.get_checkpoints(_INFOHASH), {"/remote/Show": {"stage": "transferred"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,7 @@
-# modules in this directory must implement the following two methods:
+# modules in this directory must implement a client class, created with config.get_torrent_client_config() of a seedbox,
+# with the following methods:
 
-# def add_torrent_by_file(torrent_file_path: str) -> str
-# def get_download_objects_for_watching_torrents(watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]
+# def add_torrent_by_file(self, torrent_file_path: str) -> str
+# def add_torrents_by_files(self, torrent_file_paths: List[str], known_infohashes: Set[str]) -> Dict[str, str]
+# def get_download_objects_for_watching_torrents(self, watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]
+# def get_free_space(self) -> int
@@ -1,28 +1,31 @@
-from typing import List, Dict, Any, cast
+from typing import List, Dict, Set, Tuple, Any, Callable, Optional, Collection, cast
 import re
+import time
+import zlib
+import queue
+import socket
+import struct
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from base64 import b64encode
 from pathlib import PurePosixPath, Path
 
 import deluge_client.client
+from deluge_client import rencode
 
-from downloader.model.download_obj import DownloadObject
+from downloader.model.download_obj import DownloadObject, is_early_transfer, partial_download_objects
+from downloader.model import metainfo
 from downloader.state import config
+from downloader.metrics import metrics
 
 log = logging.getLogger("deluge")
 
 _torrent_exists_regex = re.compile(r"Torrent already in session \((.*)\)", re.IGNORECASE)
 
-# Will get created when a method using the client is called
-client = cast(deluge_client.client.DelugeRPCClient, None)
-
-
-def _connect_if_necessary() -> None:
-    global client
-    if not client or not client.connected:
-        log.debug("Connecting to remote deluge daemon")
-        client = deluge_client.client.DelugeRPCClient(**config.get_torrent_client_config(), decode_utf8=True, automatic_reconnect=True)
-        client.connect()
+# Seconds without any message from the daemon before the event connection is checked, and then given up on if there's still no answer
+_EVENT_HEARTBEAT_INTERVAL = 60.0
+_EVENT_MAX_RECONNECT_DELAY = 60.0
 
 
 def _filter_torrents_status_results(torrent_status_results: Any, watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]:
@@ -34,12 +37,14 @@ def _filter_torrents_status_results(torrent_status_results: Any, watching_torren
             final_dir = watching_torrents[infohash]["final_dir"]
             auto_extract = watching_torrents[infohash].get("auto_extract", False)
             auto_delete_extracted = watching_torrents[infohash].get("auto_delete_extracted", False)
+            watch_dir = watching_torrents[infohash].get("watch_dir", "")
+            seedbox = watching_torrents[infohash].get("seedbox", "")
             base_dir = torrent_data["download_location"]
-            base_folders = set()
+            base_folders: Dict[str, List[Tuple[str, int]]] = {}
             for file_data in torrent_data["files"]:
                 path = PurePosixPath(file_data["path"])
                 if len(path.parts) > 1:  # If this file is in a dir in the torrent
-                    base_folders.add(path.parts[0])
+                    base_folders.setdefault(path.parts[0], []).append((str(PurePosixPath(*path.parts[1:])), file_data["size"]))
                 elif len(path.parts) == 1:  # This file is at the root of the torrent
                     download_list.append(
                         DownloadObject(
@@ -51,12 +56,25 @@ def _filter_torrents_status_results(torrent_status_results: Any, watching_torren
                             final_dir,
                             auto_extract,
                             auto_delete_extracted,
+                            watch_dir,
+                            [(path.parts[0], file_data["size"])],
+                            seedbox,
                         )
                     )
-            for folder in base_folders:
+            for folder, folder_files in base_folders.items():
                 download_list.append(
                     DownloadObject(
-                        infohash, str(PurePosixPath(base_dir, folder)), completed_time, True, temp_dir, final_dir, auto_extract, auto_delete_extracted
+                        infohash,
+                        str(PurePosixPath(base_dir, folder)),
+                        completed_time,
+                        True,
+                        temp_dir,
+                        final_dir,
+                        auto_extract,
+                        auto_delete_extracted,
+                        watch_dir,
+                        folder_files,
+                        seedbox,
                     )
                 )
     # Sort by timestamp before returning
@@ -64,12 +82,6 @@ def _filter_torrents_status_results(torrent_status_results: Any, watching_torren
     return download_list
 
 
-def get_download_objects_for_watching_torrents(watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]:
-    _connect_if_necessary()
-    torrents = client.call("core.get_torrents_status", {"id": list(watching_torrents.keys())}, ["completed_time", "download_location", "files"])
-    return _filter_torrents_status_results(torrents, watching_torrents)
-
-
 def _check_torrent_exists_err(error: deluge_client.client.RemoteException) -> str:
     # Check if the error is that the torrent already exists. If it does, return existing infohash
     match = _torrent_exists_regex.match(str(error))
@@ -81,28 +93,293 @@ def _check_torrent_exists_err(error: deluge_client.client.RemoteException) -> st
     raise error
 
 
-def add_torrent_by_file(torrent_file_path: str) -> str:
-    """Add a torrent from a local file and return its infohash"""
-    _connect_if_necessary()
+def _add_torrent_file(torrent_file_path: str, call: Callable[..., Any]) -> str:
     try:
         path = Path(torrent_file_path)
         if path.suffix == ".magnet":  # Check if file is a magnet link instead of a torrent file (by extension)
             with open(torrent_file_path, "r") as ft:
-                return add_torrent_by_uri(ft.read())
+                return _add_torrent_uri(ft.read(), call)
         else:
             with open(torrent_file_path, "rb") as fb:
-                return client.call("core.add_torrent_file", path.name, b64encode(fb.read()).decode("ascii"), {})
+                return call("core.add_torrent_file", path.name, b64encode(fb.read()).decode("ascii"), {})
     except deluge_client.client.RemoteException as e:
         return _check_torrent_exists_err(e)
 
 
-def add_torrent_by_uri(torrent_uri: str) -> str:
-    """Add a torrent from a uri and return its infohash"""
-    _connect_if_necessary()
+def _add_torrent_uri(torrent_uri: str, call: Callable[..., Any]) -> str:
     try:
         if torrent_uri.startswith("magnet"):
-            return client.call("core.add_torrent_magnet", torrent_uri, {})
+            return call("core.add_torrent_magnet", torrent_uri, {})
         else:
-            return client.call("core.add_torrent_url", torrent_uri, {})
+            return call("core.add_torrent_url", torrent_uri, {})
     except deluge_client.client.RemoteException as e:
         return _check_torrent_exists_err(e)
+
+
+def _supports_events() -> bool:
+    """Whether deluge_client still has the internals _EventListener relies on (see requirements.txt for the version they were checked against)"""
+    return callable(getattr(deluge_client.client.DelugeRPCClient, "_send_call", None)) and callable(
+        getattr(deluge_client.client.DelugeRPCClient, "_create_socket", None)
+    )
+
+
+class _EventListener(object):
+    """Receives events from the deluge daemon on a connection of its own, reconnecting whenever it is lost.
+    deluge_client only reads the responses to its own calls (an event arriving on a connection which is used for calls is taken as
+    the response to the call), so the messages on this connection are read here instead.
+    That takes the client's private socket and message sending, which are only used through _socket and _send_heartbeat
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], deluge_client.client.DelugeRPCClient],
+        on_finished: Callable[[str], None],
+        on_connected: Callable[[], None],
+        on_file_completed: Callable[[str], None],
+    ):
+        self._connect = connect
+        self._on_finished = on_finished
+        self._on_connected = on_connected
+        self._on_file_completed = on_file_completed
+        self._client: Optional[deluge_client.client.DelugeRPCClient] = None
+        self._buffer = b""
+        self._thread = threading.Thread(target=self._run_forever, name="deluge-events", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _socket(self) -> socket.socket:
+        assert self._client is not None
+        return cast(socket.socket, self._client._socket)
+
+    def _send_heartbeat(self) -> None:
+        """Send a call without waiting for its response, which arrives among the events"""
+        assert self._client is not None
+        self._client._send_call(self._client.deluge_version, self._client.deluge_protocol_version, "daemon.info")
+
+    def _recv(self) -> bytes:
+        awaiting_heartbeat = False
+        while True:
+            try:
+                data = self._socket().recv(1 << 16)
+            except socket.timeout:
+                if awaiting_heartbeat:
+                    raise deluge_client.client.ConnectionLostException("No answer to heartbeat")
+                # Quiet periods are normal, so check the daemon is still there rather than assuming the connection is dead
+                self._send_heartbeat()
+                awaiting_heartbeat = True
+                continue
+            if not data:
+                raise deluge_client.client.ConnectionLostException("Connection closed by daemon")
+            return data
+
+    def _read_exact(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            self._buffer += self._recv()
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+    def _read_message(self) -> List[Any]:
+        assert self._client is not None
+        if self._client.deluge_version == 2:
+            header = self._read_exact(deluge_client.client.MESSAGE_HEADER_SIZE)
+            length = struct.unpack("!i" if self._client.deluge_protocol_version is None else "!I", header[1:])[0]
+            payload = zlib.decompress(self._read_exact(length))
+        else:
+            # Deluge 1 messages have no header, so a message ends where its zlib stream does
+            decompressor = zlib.decompressobj()
+            payload = b""
+            while not decompressor.eof:
+                if not self._buffer:
+                    self._buffer = self._recv()
+                payload += decompressor.decompress(self._buffer)
+                self._buffer = decompressor.unused_data
+        return list(rencode.loads(payload, decode_utf8=True))
+
+    def _listen(self) -> None:
+        self._client = self._connect()
+        self._buffer = b""
+        self._client.call("daemon.set_event_interest", ["TorrentFinishedEvent", "TorrentFileCompletedEvent"])
+        self._socket().settimeout(_EVENT_HEARTBEAT_INTERVAL)
+        log.info(f"Listening for torrent events from deluge daemon at {self._client.host}")
+        # Anything which finished while there was no connection was missed, so have everything checked
+        self._on_connected()
+        while True:
+            self._handle_message(self._read_message())
+
+    def _handle_message(self, message: List[Any]) -> None:
+        # Responses (to heartbeats) only matter in that they arrived
+        if message[0] != deluge_client.client.RPC_EVENT:
+            return
+        if message[1] == "TorrentFinishedEvent":
+            infohash = message[2][0]
+            log.debug(f"Deluge reports {infohash} finished")
+            self._on_finished(infohash)
+        elif message[1] == "TorrentFileCompletedEvent":
+            # (torrent id, file index)
+            self._on_file_completed(message[2][0])
+
+    def _run_forever(self) -> None:
+        delay = 0.0
+        while True:
+            started = time.monotonic()
+            try:
+                self._listen()
+            except Exception as e:
+                # Only back off if the connection didn't last, so a daemon restart after a long uptime reconnects quickly
+                lasted = time.monotonic() - started
+                delay = 1.0 if not delay or lasted > _EVENT_MAX_RECONNECT_DELAY else min(delay * 2, _EVENT_MAX_RECONNECT_DELAY)
+                log.warning(f"Lost deluge event connection ({e!r}), reconnecting in {delay:.0f}s")
+            finally:
+                if self._client is not None:
+                    self._client.disconnect()
+                    self._client = None
+            time.sleep(delay)
+
+
+class DelugeClient(object):
+    """Connection to the deluge daemon of a single seedbox, along with what is cached about its torrents between polls"""
+
+    def __init__(self, client_options: Dict[str, Any]):
+        self.client_options = client_options
+        # Will get created when a method using the client is called
+        self.client = cast(deluge_client.client.DelugeRPCClient, None)
+        # Memoized file lists of completed watched torrents, since they don't change once a torrent is complete
+        self._file_layouts: Dict[str, List[Dict[str, Any]]] = {}
+        # The deluge rpc client uses a single socket, so calls from the ingest and poll stages must not interleave
+        self._client_lock = threading.RLock()
+        # Additional connections used to submit many torrents concurrently
+        self._add_clients: "queue.Queue[deluge_client.client.DelugeRPCClient]" = queue.Queue()
+        self._event_listener: Optional[_EventListener] = None
+
+    def _new_client(self, automatic_reconnect: bool = True) -> deluge_client.client.DelugeRPCClient:
+        log.debug(f"Connecting to remote deluge daemon at {self.client_options['host']}")
+        new_client = deluge_client.client.DelugeRPCClient(**self.client_options, decode_utf8=True, automatic_reconnect=automatic_reconnect)
+        new_client.connect()
+        return new_client
+
+    def _connect_if_necessary(self) -> None:
+        if not self.client or not self.client.connected:
+            self.client = self._new_client()
+
+    def _call(self, method: str, *args: Any) -> Any:
+        with self._client_lock:
+            self._connect_if_necessary()
+            with metrics.time_rpc("deluge", method):
+                return self.client.call(method, *args)
+
+    def _pooled_call(self, method: str, *args: Any) -> Any:
+        """Make a call on a connection of its own, so that it can run concurrently with other calls"""
+        try:
+            pooled_client = self._add_clients.get_nowait()
+        except queue.Empty:
+            pooled_client = self._new_client()
+        try:
+            with metrics.time_rpc("deluge", method):
+                return pooled_client.call(method, *args)
+        finally:
+            self._add_clients.put(pooled_client)
+
+    def start_events(self, on_finished: Callable[[str], None], on_connected: Callable[[], None], on_file_completed: Callable[[str], None]) -> bool:
+        """Start listening for torrents finishing, calling on_finished with the infohash of each (from a thread of its own).
+        on_connected is called whenever the event connection is (re)established, since events may have been missed before then.
+        on_file_completed is called with the infohash of a torrent whenever one of its files completes (for early transfers).
+        Returns False if events can't be received with the installed deluge_client, in which case torrents are only polled
+        """
+        if not _supports_events():
+            log.warning("The installed deluge-client can't be used to receive events, so completions are only found by polling")
+            return False
+        if self._event_listener is None:
+            self._event_listener = _EventListener(lambda: self._new_client(automatic_reconnect=False), on_finished, on_connected, on_file_completed)
+            self._event_listener.start()
+        return True
+
+    def get_download_objects_for_watching_torrents(
+        self, watching_torrents: Dict[str, Dict[str, Any]], due: Optional[Collection[str]] = None, etas: Optional[Dict[str, float]] = None
+    ) -> List[DownloadObject]:
+        # Drop file layouts for torrents we are no longer watching
+        for infohash in [infohash for infohash in list(self._file_layouts) if infohash not in watching_torrents]:
+            self._file_layouts.pop(infohash, None)
+        if due is not None:
+            watching_torrents = {infohash: watching_torrents[infohash] for infohash in due if infohash in watching_torrents}
+        return self.get_download_objects_for_torrents(watching_torrents, etas)
+
+    def get_download_objects_for_torrents(
+        self, watching_torrents: Dict[str, Dict[str, Any]], etas: Optional[Dict[str, float]] = None
+    ) -> List[DownloadObject]:
+        """Like get_download_objects_for_watching_torrents, but for only some of the watched torrents (i.e. ones which just finished)"""
+        if not watching_torrents:
+            return []
+        # First only get completion status (which is cheap), then only get the (potentially huge) file lists of newly completed torrents
+        torrents = self._call("core.get_torrents_status", {"id": list(watching_torrents.keys())}, ["completed_time", "download_location", "eta"])
+        if etas is not None:
+            for infohash, torrent_data in torrents.items():
+                # deluge reports an eta of 0 when it can't estimate one
+                etas[infohash] = 0.0 if torrent_data.get("completed_time", 0) > 0 else float(torrent_data.get("eta", 0) or -1)
+        # Incomplete torrents whose files are transferred as soon as each is complete
+        early = [
+            infohash
+            for infohash, torrent_data in torrents.items()
+            if torrent_data.get("completed_time", 0) == 0 and is_early_transfer(watching_torrents[infohash])
+        ]
+        needs_files = [
+            infohash
+            for infohash, torrent_data in torrents.items()
+            if (torrent_data.get("completed_time", 0) > 0 or infohash in early) and infohash not in self._file_layouts
+        ]
+        if needs_files:
+            for infohash, torrent_data in self._call("core.get_torrents_status", {"id": needs_files}, ["files"]).items():
+                # Torrents added by magnet have no files until their metadata arrives
+                if torrent_data["files"]:
+                    self._file_layouts[infohash] = torrent_data["files"]
+        completed = {}
+        for infohash, torrent_data in torrents.items():
+            if infohash in self._file_layouts and infohash not in early:
+                completed[infohash] = {**torrent_data, "files": self._file_layouts[infohash]}
+        download_list = _filter_torrents_status_results(completed, watching_torrents)
+        if early:
+            for infohash, torrent_data in self._call("core.get_torrents_status", {"id": early}, ["file_progress"]).items():
+                files = [
+                    (file_data["path"], file_data["size"], progress >= 1.0)
+                    for file_data, progress in zip(self._file_layouts.get(infohash, []), torrent_data["file_progress"])
+                ]
+                download_list.extend(partial_download_objects(infohash, watching_torrents[infohash], torrents[infohash]["download_location"], files))
+        return download_list
+
+    def add_torrent_by_file(self, torrent_file_path: str) -> str:
+        """Add a torrent from a local file and return its infohash"""
+        return _add_torrent_file(torrent_file_path, self._call)
+
+    def add_torrent_by_uri(self, torrent_uri: str) -> str:
+        """Add a torrent from a uri and return its infohash"""
+        return _add_torrent_uri(torrent_uri, self._call)
+
+    def add_torrents_by_files(self, torrent_file_paths: List[str], known_infohashes: Set[str]) -> Dict[str, str]:
+        """Add many torrents from local files concurrently, and return a dict of file path to infohash for every file now in the client.
+        Torrents whose infohash can be computed locally are not submitted if they are in known_infohashes or already in the client.
+        Files which fail to be added are logged and left out of the result
+        """
+        added: Dict[str, str] = {}
+        local_infohashes = {path: metainfo.read_infohash(path) for path in torrent_file_paths}
+        unknown = list({infohash for infohash in local_infohashes.values() if infohash and infohash not in known_infohashes})
+        in_client = set(self._call("core.get_torrents_status", {"id": unknown}, ["name"]).keys()) if unknown else set()
+        to_submit: List[str] = []
+        for path, infohash in local_infohashes.items():
+            if infohash and (infohash in known_infohashes or infohash in in_client):
+                log.debug(f"Torrent {infohash} from {path} is already added")
+                added[path] = infohash
+            else:
+                to_submit.append(path)
+        if to_submit:
+            with ThreadPoolExecutor(max_workers=config.get_add_concurrency()) as executor:
+                futures = {executor.submit(_add_torrent_file, path, self._pooled_call): path for path in to_submit}
+                for future in as_completed(futures):
+                    try:
+                        added[futures[future]] = future.result()
+                    except Exception:
+                        log.exception(f"Failed to add {futures[future]} to torrent client")
+        return added
+
+    def get_free_space(self) -> int:
+        """Free space (in bytes) of the daemon's default download location"""
+        return self._call("core.get_free_space")
@@ -0,0 +1,37 @@
+from typing import List, Tuple
+import unittest
+from unittest import mock
+
+import deluge_client.client
+
+from downloader.torrent_clients import deluge
+
+
+class DelugeEventsTest(unittest.TestCase):
+    def test_installed_client_supports_events(self) -> None:
+        self.assertTrue(deluge._supports_events())
+
+    def test_events_are_not_started_without_client_internals(self) -> None:
+        client = deluge.DelugeClient({"host": "fake"})
+        with mock.patch.object(deluge_client.client.DelugeRPCClient, "_send_call", None):
+            with self.assertLogs("deluge", "WARNING"):
+                self.assertFalse(client.start_events(lambda infohash: None, lambda: None, lambda infohash: None))
+        self.assertIsNone(client._event_listener)
+
+    def test_events_are_dispatched(self) -> None:
+        calls: List[Tuple[str, str]] = []
+        listener = deluge._EventListener(
+            mock.Mock(),
+            lambda infohash: calls.append(("finished", infohash)),
+            lambda: None,
+            lambda infohash: calls.append(("file", infohash)),
+        )
+        listener._handle_message([deluge_client.client.RPC_EVENT, "TorrentFileCompletedEvent", ["a" * 40, 3]])
+        listener._handle_message([deluge_client.client.RPC_EVENT, "TorrentFinishedEvent", ["a" * 40]])
+        # The response to a heartbeat
+        listener._handle_message([deluge_client.client.RPC_RESPONSE, 1, {}])
+        self.assertEqual(calls, [("file", "a" * 40), ("finished", "a" * 40)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
-from typing import List, Dict, Any, cast, TYPE_CHECKING
+from typing import List, Dict, Set, Tuple, Any, Union, Optional, Collection, cast, TYPE_CHECKING
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import PurePosixPath, Path
 
 from transmission_rpc import Client
@@ -8,20 +11,25 @@ if TYPE_CHECKING:
     from transmission_rpc import Torrent
 
 
-from downloader.model.download_obj import DownloadObject
+from downloader.model.download_obj import DownloadObject, is_early_transfer, partial_download_objects
+from downloader.model import metainfo
 from downloader.state import config
+from downloader.metrics import metrics
 
 log = logging.getLogger("transmission")
 
-# Will get created when a method using the client is called
-client = cast(Client, None)
+# Transmission only reports torrents as recently active for 60 seconds, so polls further apart than this must query every torrent
+_RECENTLY_ACTIVE_WINDOW = 45
+# Periodically query checked incomplete torrents directly regardless, as a safety net
+_FULL_POLL_INTERVAL = 600
 
 
-def _connect_if_necessary() -> None:
-    global client
-    if not client:
-        log.info("Connecting to transmission daemon")
-        client = Client(**config.get_torrent_client_config(), timeout=60)
+def _get_files(torrent_data: "Torrent") -> List[Any]:
+    # Temp hack due to upstream issue: https://github.com/trim21/transmission-rpc/issues/455
+    torrent_data.fields["priorities"] = [0] * len(torrent_data.fields["files"])
+    torrent_data.fields["wanted"] = [True] * len(torrent_data.fields["files"])
+    # End temp hack
+    return torrent_data.get_files()
 
 
 def _filter_torrents_status_results(torrent_status_results: List["Torrent"], watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]:
@@ -33,16 +41,14 @@ def _filter_torrents_status_results(torrent_status_results: List["Torrent"], wat
         final_dir = watching_torrents[infohash]["final_dir"]
         auto_extract = watching_torrents[infohash].get("auto_extract", False)
         auto_delete_extracted = watching_torrents[infohash].get("auto_delete_extracted", False)
+        watch_dir = watching_torrents[infohash].get("watch_dir", "")
+        seedbox = watching_torrents[infohash].get("seedbox", "")
         base_dir = torrent_data.download_dir
-        base_folders = set()
-        # Temp hack due to upstream issue: https://github.com/trim21/transmission-rpc/issues/455
-        torrent_data.fields["priorities"] = [0] * len(torrent_data.fields["files"])
-        torrent_data.fields["wanted"] = [True] * len(torrent_data.fields["files"])
-        # End temp hack
-        for file_data in torrent_data.get_files():
+        base_folders: Dict[str, List[Tuple[str, int]]] = {}
+        for file_data in _get_files(torrent_data):
             path = PurePosixPath(file_data.name)
             if len(path.parts) > 1:  # If this file is in a dir in the torrent
-                base_folders.add(path.parts[0])
+                base_folders.setdefault(path.parts[0], []).append((str(PurePosixPath(*path.parts[1:])), file_data.size))
             elif len(path.parts) == 1:  # This file is at the root of the torrent
                 download_list.append(
                     DownloadObject(
@@ -54,12 +60,25 @@ def _filter_torrents_status_results(torrent_status_results: List["Torrent"], wat
                         final_dir,
                         auto_extract,
                         auto_delete_extracted,
+                        watch_dir,
+                        [(path.parts[0], file_data.size)],
+                        seedbox,
                     )
                 )
-        for folder in base_folders:
+        for folder, folder_files in base_folders.items():
             download_list.append(
                 DownloadObject(
-                    infohash, str(PurePosixPath(base_dir, folder)), completed_time, True, temp_dir, final_dir, auto_extract, auto_delete_extracted
+                    infohash,
+                    str(PurePosixPath(base_dir, folder)),
+                    completed_time,
+                    True,
+                    temp_dir,
+                    final_dir,
+                    auto_extract,
+                    auto_delete_extracted,
+                    watch_dir,
+                    folder_files,
+                    seedbox,
                 )
             )
     # Sort by timestamp before returning
@@ -67,34 +86,177 @@ def _filter_torrents_status_results(torrent_status_results: List["Torrent"], wat
     return download_list
 
 
-def get_download_objects_for_watching_torrents(watching_torrents: Dict[str, Dict[str, Any]]) -> List[DownloadObject]:
-    _connect_if_necessary()
-    wanted_ids = []
-    # First make a call to get all torrents, to determine which ids we want
-    all_torrents = client.get_torrents(arguments=["hashString", "percentDone", "id"])
-    for torrent_data in all_torrents:
-        if torrent_data.hash_string in watching_torrents and torrent_data.percent_done == 1:  # Only completed torrents we are watching
-            wanted_ids.append(torrent_data.id)
-    if not wanted_ids:
-        return []
-    # Now get the all the relevant info for our wanted torrent ids
-    torrents = client.get_torrents(wanted_ids, arguments=["hashString", "downloadDir", "doneDate", "files"])
-    return _filter_torrents_status_results(torrents, watching_torrents)
-
-
-def add_torrent_by_file(torrent_file_path: str) -> str:
-    """Add a torrent from a local file and return its infohash"""
-    _connect_if_necessary()
-    path = Path(torrent_file_path)
-    if path.suffix == ".magnet":  # Check if file is a magnet link instead of a torrent file (by extension)
-        with open(torrent_file_path, "r") as ft:
-            return add_torrent_by_uri(ft.read())
-    else:
-        with open(torrent_file_path, "rb") as fb:
-            return client.add_torrent(fb.read()).hash_string
-
-
-def add_torrent_by_uri(torrent_uri: str) -> str:
-    """Add a torrent from a uri and return its infohash"""
-    _connect_if_necessary()
-    return client.add_torrent(torrent_uri).hash_string
+class TransmissionClient(object):
+    """Connection to the transmission daemon of a single seedbox, along with what is cached about its torrents between polls"""
+
+    def __init__(self, client_options: Dict[str, Any]):
+        self.client_options = client_options
+        # Will get created when a method using the client is called
+        self.client = cast(Client, None)
+        # Caches so that polling only asks the daemon about watched torrents which could have changed
+        self._hash_to_id: Dict[str, int] = {}
+        self._completed: Set[str] = set()
+        self._completed_details: Dict[str, "Torrent"] = {}
+        # When each torrent's progress was last seen, the last poll, and the first poll of the current run of polls close enough together
+        # that recent activity shows every change since the one before
+        self._seen_at: Dict[str, float] = {}
+        self._last_progress_poll = float("-inf")
+        self._chain_start = 0.0
+        # Guards client creation, since the ingest and poll stages can both try to connect at the same time
+        self._connect_lock = threading.Lock()
+
+    def _connect_if_necessary(self) -> None:
+        with self._connect_lock:
+            if not self.client:
+                log.info(f"Connecting to transmission daemon at {self.client_options['host']}")
+                self.client = Client(**self.client_options, timeout=60)
+
+    def _update_progress(
+        self, torrents: List["Torrent"], watching_torrents: Dict[str, Dict[str, Any]], etas: Optional[Dict[str, float]], now: float
+    ) -> None:
+        for torrent_data in torrents:
+            if torrent_data.hash_string in watching_torrents:
+                self._hash_to_id[torrent_data.hash_string] = torrent_data.id
+                self._seen_at[torrent_data.hash_string] = now
+                if etas is not None:
+                    eta = torrent_data.eta
+                    etas[torrent_data.hash_string] = 0.0 if torrent_data.percent_done == 1 else (eta.total_seconds() if eta is not None else -1.0)
+                if torrent_data.percent_done == 1:
+                    self._completed.add(torrent_data.hash_string)
+                else:
+                    # Could have become incomplete again (i.e. a recheck found bad data)
+                    self._completed.discard(torrent_data.hash_string)
+                    self._completed_details.pop(torrent_data.hash_string, None)
+
+    def _forget_torrent(self, infohash: str) -> None:
+        self._hash_to_id.pop(infohash, None)
+        self._seen_at.pop(infohash, None)
+        self._completed.discard(infohash)
+        self._completed_details.pop(infohash, None)
+
+    def get_download_objects_for_watching_torrents(
+        self, watching_torrents: Dict[str, Dict[str, Any]], due: Optional[Collection[str]] = None, etas: Optional[Dict[str, float]] = None
+    ) -> List[DownloadObject]:
+        """Completed watching torrents as download objects. If due is given, only those torrents are checked (though any others seen
+        to complete are returned too). Polls close together only ask the daemon for recently active torrents, and query checked torrents
+        directly only if they weren't seen since. If etas is given, it is filled with the seconds until each checked or active torrent
+        completes (0 if complete, negative if unknown)
+        """
+        self._connect_if_necessary()
+        # Drop anything cached for torrents we are no longer watching
+        for infohash in [infohash for infohash in self._hash_to_id if infohash not in watching_torrents]:
+            self._forget_torrent(infohash)
+        checked = set(watching_torrents) if due is None else {infohash for infohash in due if infohash in watching_torrents}
+
+        # Determine which watched torrents are complete, only asking the daemon about what could have changed
+        now = time.monotonic()
+        progress_fields = ["id", "hashString", "percentDone", "eta"]
+        if now - self._last_progress_poll > _RECENTLY_ACTIVE_WINDOW or now - self._chain_start > _FULL_POLL_INTERVAL:
+            # Changes since the last poll can't all be seen as recent activity (or it's time for the safety net), so nothing seen before now
+            # is trusted, and every checked torrent is queried directly
+            self._chain_start = now
+            active: List["Torrent"] = []
+        else:
+            # Only torrents which were active since the last poll could have changed
+            with metrics.time_rpc("transmission", "torrent-get-recently-active"):
+                active, removed_ids = self.client.get_recently_active_torrents(arguments=progress_fields)
+            removed = set(removed_ids)
+            for infohash in [infohash for infohash, torrent_id in self._hash_to_id.items() if torrent_id in removed]:
+                self._forget_torrent(infohash)
+            self._update_progress(active, watching_torrents, etas, now)
+        self._last_progress_poll = now
+        # Query checked torrents which are not yet complete, and were never seen or not seen since activity started being followed
+        # (by id if known, otherwise by hash)
+        direct = [infohash for infohash in checked if infohash not in self._completed and self._seen_at.get(infohash, -1.0) < self._chain_start]
+        if direct:
+            with metrics.time_rpc("transmission", "torrent-get"):
+                torrents = self.client.get_torrents([self._hash_to_id.get(infohash, infohash) for infohash in direct], arguments=progress_fields)
+            found = {torrent_data.hash_string for torrent_data in torrents}
+            for infohash in direct:
+                if infohash in self._hash_to_id and infohash not in found:
+                    # Torrent was removed from the daemon
+                    self._forget_torrent(infohash)
+            self._update_progress(torrents, watching_torrents, etas, now)
+        if etas is not None:
+            # Checked torrents which weren't active haven't changed since they were last seen, and aren't downloading
+            for infohash in checked:
+                if infohash in self._hash_to_id and infohash not in etas:
+                    etas[infohash] = 0.0 if infohash in self._completed else -1.0
+
+        # Now get the all the relevant info for completed torrents which haven't been fetched before
+        wanted_ids: List[Union[int, str]] = [self._hash_to_id[infohash] for infohash in self._completed if infohash not in self._completed_details]
+        if wanted_ids:
+            with metrics.time_rpc("transmission", "torrent-get"):
+                details = self.client.get_torrents(wanted_ids, arguments=["hashString", "downloadDir", "doneDate", "files"])
+            for torrent_data in details:
+                self._completed_details[torrent_data.hash_string] = torrent_data
+        download_list = _filter_torrents_status_results(list(self._completed_details.values()), watching_torrents)
+
+        # Incomplete torrents whose files are transferred as soon as each is complete need their per file progress on every poll
+        early_ids: List[Union[int, str]] = [
+            torrent_id
+            for infohash, torrent_id in self._hash_to_id.items()
+            if infohash not in self._completed and infohash in checked and is_early_transfer(watching_torrents[infohash])
+        ]
+        if early_ids:
+            with metrics.time_rpc("transmission", "torrent-get"):
+                early = self.client.get_torrents(early_ids, arguments=["hashString", "downloadDir", "files"])
+            for torrent_data in early:
+                files = [(file_data.name, file_data.size, file_data.completed >= file_data.size) for file_data in _get_files(torrent_data)]
+                download_list.extend(
+                    partial_download_objects(torrent_data.hash_string, watching_torrents[torrent_data.hash_string], torrent_data.download_dir, files)
+                )
+        return download_list
+
+    def add_torrent_by_file(self, torrent_file_path: str) -> str:
+        """Add a torrent from a local file and return its infohash"""
+        self._connect_if_necessary()
+        path = Path(torrent_file_path)
+        if path.suffix == ".magnet":  # Check if file is a magnet link instead of a torrent file (by extension)
+            with open(torrent_file_path, "r") as ft:
+                return self.add_torrent_by_uri(ft.read())
+        else:
+            with open(torrent_file_path, "rb") as fb, metrics.time_rpc("transmission", "torrent-add"):
+                return self.client.add_torrent(fb.read()).hash_string
+
+    def add_torrent_by_uri(self, torrent_uri: str) -> str:
+        """Add a torrent from a uri and return its infohash"""
+        self._connect_if_necessary()
+        with metrics.time_rpc("transmission", "torrent-add"):
+            return self.client.add_torrent(torrent_uri).hash_string
+
+    def add_torrents_by_files(self, torrent_file_paths: List[str], known_infohashes: Set[str]) -> Dict[str, str]:
+        """Add many torrents from local files concurrently, and return a dict of file path to infohash for every file now in the client.
+        Torrents whose infohash can be computed locally are not submitted if they are in known_infohashes or already in the client.
+        Files which fail to be added are logged and left out of the result
+        """
+        self._connect_if_necessary()
+        added: Dict[str, str] = {}
+        local_infohashes = {path: metainfo.read_infohash(path) for path in torrent_file_paths}
+        unknown: List[Union[int, str]] = list({infohash for infohash in local_infohashes.values() if infohash and infohash not in known_infohashes})
+        in_client: Set[str] = set()
+        if unknown:
+            with metrics.time_rpc("transmission", "torrent-get"):
+                in_client = {torrent_data.hash_string for torrent_data in self.client.get_torrents(unknown, arguments=["hashString"])}
+        to_submit: List[str] = []
+        for path, infohash in local_infohashes.items():
+            if infohash and (infohash in known_infohashes or infohash in in_client):
+                log.debug(f"Torrent {infohash} from {path} is already added")
+                added[path] = infohash
+            else:
+                to_submit.append(path)
+        if to_submit:
+            with ThreadPoolExecutor(max_workers=config.get_add_concurrency()) as executor:
+                futures = {executor.submit(self.add_torrent_by_file, path): path for path in to_submit}
+                for future in as_completed(futures):
+                    try:
+                        added[futures[future]] = future.result()
+                    except Exception:
+                        log.exception(f"Failed to add {futures[future]} to torrent client")
+        return added
+
+    def get_free_space(self) -> int:
+        """Free space (in bytes) of the daemon's default download dir"""
+        self._connect_if_necessary()
+        with metrics.time_rpc("transmission", "session-get"):
+            return self.client.get_session().download_dir_free_space
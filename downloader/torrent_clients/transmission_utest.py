@@ -0,0 +1,105 @@
+from typing import Any, Dict, List, Optional, Union
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from downloader.benchmark import fakes
+from downloader.benchmark.library import SyntheticTorrent
+from downloader.state import config
+from downloader.state import state
+from downloader.torrent_clients import transmission
+
+_A = "a" * 40
+_B = "b" * 40
+_C = "c" * 40
+
+
+class _RecordingTransmissionClient(fakes.FakeTransmissionClient):
+    def __init__(self, torrents: Dict[str, SyntheticTorrent]):
+        super().__init__(torrents)
+        self.queried: List[List[Union[int, str]]] = []
+
+    def get_torrents(self, ids: Optional[List[Union[int, str]]] = None, arguments: Optional[List[str]] = None) -> Any:
+        if arguments and "percentDone" in arguments:
+            self.queried.append(sorted(ids or [], key=str))
+        return super().get_torrents(ids, arguments)
+
+
+class TransmissionPollTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        fakes.configure(self.workdir)
+        self.addCleanup(state.close)
+        watch_dir = config.get_torrent_watch_dirs()[0]
+        self.torrents: Dict[str, SyntheticTorrent] = {}
+        for torrent_id, infohash in enumerate((_A, _B, _C), 1):
+            self.torrents[infohash] = SyntheticTorrent(torrent_id, infohash, infohash, [(f"{infohash}.mkv", 10)], "/remote/downloads", 0)
+            self.torrents[infohash].eta = 600
+            state.add_watching_torrent(infohash, watch_dir["temp_download_dir"], watch_dir["final_download_dir"], infohash)
+        self.fake = _RecordingTransmissionClient(self.torrents)
+        self.client = transmission.TransmissionClient({"host": "fake"})
+        self.client.client = self.fake  # type: ignore
+        self.watching = state.get_watching_torrents()
+
+    def _poll(self, now: float, due: Optional[List[str]] = None, etas: Optional[Dict[str, float]] = None) -> List[str]:
+        with mock.patch("time.monotonic", return_value=now):
+            return sorted({obj.infohash for obj in self.client.get_download_objects_for_watching_torrents(self.watching, due, etas)})
+
+    def test_first_poll_queries_due_torrents(self) -> None:
+        etas: Dict[str, float] = {}
+        self._poll(1000, [_A, _B], etas)
+        self.assertEqual(self.fake.calls, ["torrent-get"])
+        self.assertEqual(self.fake.queried, [[_A, _B]])
+        self.assertEqual(etas, {_A: 600, _B: 600})
+
+    def test_close_polls_only_query_unseen_due_torrents(self) -> None:
+        self._poll(1000, [_A])
+        self.fake.recently_active = [_A]
+        etas: Dict[str, float] = {}
+        self._poll(1020, [_A, _B], etas)
+        self.assertEqual(self.fake.calls, ["torrent-get", "torrent-get-recently-active", "torrent-get"])
+        # _A was seen as active, and _B was never seen
+        self.assertEqual(self.fake.queried, [[_A], [_B]])
+        self.assertEqual(etas, {_A: 600, _B: 600})
+        # Now both are followed through recent activity alone. _B isn't active, so it isn't downloading
+        self.fake.recently_active = []
+        etas = {}
+        self._poll(1040, [_A, _B], etas)
+        self.assertEqual(self.fake.calls[3:], ["torrent-get-recently-active"])
+        self.assertEqual(etas, {_A: -1, _B: -1})
+
+    def test_completion_is_seen_through_recent_activity(self) -> None:
+        self._poll(1000, [_A, _B])
+        self.torrents[_B].completed_time = 1700000000
+        self.fake.recently_active = [_B]
+        etas: Dict[str, float] = {}
+        self.assertEqual(self._poll(1030, [_A], etas), [_B])
+        self.assertEqual(self.fake.queried, [[_A, _B]])
+        self.assertEqual(etas, {_A: -1, _B: 0})
+
+    def test_polls_far_apart_query_directly(self) -> None:
+        self._poll(1000, [_A, _B])
+        self.fake.calls.clear()
+        self._poll(1100, [_A, _B])
+        self.assertEqual(self.fake.calls, ["torrent-get"])
+        self.assertEqual(self.fake.queried[-1], [1, 2])
+
+    def test_torrents_are_queried_directly_as_a_safety_net(self) -> None:
+        now = 1000.0
+        self._poll(now, [_A])
+        while now <= 1000 + transmission._FULL_POLL_INTERVAL:
+            now += 30
+            self._poll(now, [_A])
+        self.assertEqual(self.fake.queried, [[_A], [1]])
+
+    def test_removed_torrent_is_forgotten(self) -> None:
+        self._poll(1000, [_A, _B])
+        del self.fake._by_id[self.torrents.pop(_B).torrent_id]
+        self._poll(1100, [_A, _B])
+        self.assertNotIn(_B, self.client._hash_to_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
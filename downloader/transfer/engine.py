@@ -0,0 +1,121 @@
+from typing import Callable, List, Dict, Tuple, Optional, TYPE_CHECKING
+import threading
+
+from downloader.state import config
+
+if TYPE_CHECKING:
+    from downloader.transfer.tuning import TransferTuner
+
+# Called with (local file path, bytes transferred so far, total bytes of the file)
+ProgressCallback = Callable[[str, int, int], None]
+
+
+class TransferEngine(object):
+    """Fetches files and directories from the seedbox to the local machine.
+    Fetches must resume (not restart) when the local destination already contains partially transferred data
+    """
+
+    def fetch_file(
+        self,
+        remote_path: str,
+        local_path: str,
+        connections: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional["TransferTuner"] = None,
+    ) -> None:
+        """Fetch a single remote file to local_path, using up to connections simultaneous connections.
+        Engines which support it let tuner adjust how many of those connections are active while transferring
+        """
+        raise NotImplementedError
+
+    def fetch_directory(
+        self,
+        remote_path: str,
+        local_path: str,
+        parallel_files: int,
+        connections_per_file: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional["TransferTuner"] = None,
+    ) -> None:
+        """Recursively fetch the contents of a remote directory into local_path.
+        Engines which support it let tuner adjust how many files are fetched at once (up to parallel_files) while transferring
+        """
+        raise NotImplementedError
+
+    def fetch_files(
+        self,
+        files: List[Tuple[str, str]],
+        parallel_files: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional["TransferTuner"] = None,
+    ) -> None:
+        """Fetch many (small) remote files, given as (remote path, local path), as a single job with up to parallel_files at once.
+        Engines which support it let tuner adjust how many files are fetched at once while transferring
+        """
+        for remote_path, local_path in files:
+            self.fetch_file(remote_path, local_path, 1, progress)
+
+    def fetch_range(self, remote_path: str, local_path: str, offset: int, length: int) -> None:
+        """Fetch length bytes of a remote file starting at offset, writing them at the same offset of the existing local file"""
+        raise NotImplementedError
+
+    def idle_connections(self) -> int:
+        """Number of connections held open by sessions which are pooled for reuse, and so aren't used by any transfer"""
+        return 0
+
+    def close_idle(self, connections: int) -> int:
+        """Close pooled sessions until at least the given number of connections were released (or none are left), returning how many were"""
+        return 0
+
+    def close(self) -> None:
+        """Release any connections held by this engine"""
+        pass
+
+
+# Seedbox name -> its engine
+_engines: Dict[str, TransferEngine] = {}
+_engine_lock = threading.Lock()
+
+
+def get_engine(seedbox: str = "") -> TransferEngine:
+    """Get the (shared) transfer engine for a seedbox, as selected by the transfer_engine config"""
+    name = config.get_seedbox_name(seedbox)
+    with _engine_lock:
+        engine = _engines.get(name)
+        if engine is None:
+            engine_type = config.get_transfer_engine()
+            # Conditionally import engines, so dependencies of unused engines aren't required
+            if engine_type == "lftp":
+                from downloader.transfer.lftp import LftpEngine
+
+                engine = LftpEngine(config.get_sftp_options(name))
+            elif engine_type == "sftp":
+                from downloader.transfer.sftp import SftpEngine
+
+                engine = SftpEngine(config.get_sftp_options(name))
+            elif engine_type == "local":
+                from downloader.transfer.local import LocalEngine
+
+                engine = LocalEngine()
+            else:
+                raise NotImplementedError(f"Transfer engine {engine_type} not implemented")
+            _engines[name] = engine
+        return engine
+
+
+def _all_engines() -> List[TransferEngine]:
+    with _engine_lock:
+        return list(_engines.values())
+
+
+def idle_connections() -> int:
+    """Number of connections held open by the pooled sessions of every seedbox's engine"""
+    return sum(engine.idle_connections() for engine in _all_engines())
+
+
+def close_idle_connections(connections: int) -> None:
+    """Close pooled sessions of any seedbox's engine until at least the given number of connections were released"""
+    for engine in _all_engines():
+        if connections <= 0:
+            return
+        connections -= engine.close_idle(connections)
@@ -0,0 +1,216 @@
+from typing import List, Dict, Tuple, Any, Iterator, Optional
+import os
+import sys
+import queue
+import itertools
+import subprocess
+import logging
+import threading
+import contextlib
+
+from downloader.transfer.engine import TransferEngine, ProgressCallback
+from downloader.transfer.tuning import TransferTuner
+from downloader.transfer import ratelimit
+from downloader.state import config
+
+log = logging.getLogger("lftp")
+
+# How long lftp keeps idle connections (and so their authentication) open between commands
+_IDLE_TIMEOUT = "10m"
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace('"', '\\"') + '"'
+
+
+class _CommandFailed(subprocess.CalledProcessError):
+    """A command which lftp ran to the end and reported as failed (i.e. a missing remote file), leaving its session ready for the next one"""
+
+
+class _LftpSession(object):
+    """A long-running lftp(1) process which is sent commands over stdin. lftp keeps its connections open between commands,
+    so consecutive transfers through the same session skip the ssh handshake and authentication
+    """
+
+    def __init__(self, sftp_opts: Dict[str, Any]):
+        # The password is passed in the environment rather than on the command line, so it isn't visible in the process list
+        password_opt = "--env-password " if sftp_opts["password"] else ""
+        env = {**os.environ, "LFTP_PASSWORD": sftp_opts["password"]}
+        self._process = subprocess.Popen(["lftp"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr, env=env, text=True, bufsize=1)
+        self._markers = itertools.count()
+        # lftp keeps every connection a command opened until it has been idle for the idle timeout, so this holds the most any command used
+        self.connections = 0
+        # The connection itself is only made by the first command which needs it
+        self._send(f"set net:idle {_IDLE_TIMEOUT}")
+        self._send(f"set file:use-fallocate {'yes' if config.get_preallocate() else 'no'}")
+        limiter = ratelimit.get_limiter()
+        if limiter:
+            # lftp processes can't share a limit, so each gets an even share of it (assuming one session per download worker)
+            self._send(f"set net:limit-total-rate {max(1, limiter.rate // config.get_download_workers())}")
+        self._send(f"open {password_opt}-u {_quote(sftp_opts['username'])} -p {sftp_opts['port']} sftp://{sftp_opts['host']}")
+
+    def _send(self, line: str) -> None:
+        assert self._process.stdin is not None
+        self._process.stdin.write(line + "\n")
+        self._process.stdin.flush()
+
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def run(self, command: str, connections: int) -> None:
+        """Run a command which opens up to connections connections, waiting for it to finish. Raises CalledProcessError if it fails"""
+        assert self._process.stdout is not None
+        self.connections = max(self.connections, connections)
+        marker = f"rtd-command-{next(self._markers)}"
+        # lftp reports the result of each command through its exit status, which is echoed back so it can be read from stdout
+        self._send(f"{command} && echo {marker}-ok || echo {marker}-failed")
+        for line in self._process.stdout:
+            if line == f"{marker}-ok\n":
+                return
+            if line == f"{marker}-failed\n":
+                raise _CommandFailed(1, command)
+            # Pass any other output through to the host's stdout
+            sys.stdout.write(line)
+        raise subprocess.CalledProcessError(self._process.wait(), command)
+
+    def close(self) -> None:
+        if self._process.stdin is not None:
+            with contextlib.suppress(OSError):
+                self._send("exit")
+                self._process.stdin.close()
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+class LftpEngine(TransferEngine):
+    """Transfers with lftp(1), reusing long-running lftp processes (and their connections) between transfers"""
+
+    def __init__(self, sftp_opts: Dict[str, Any], max_idle_sessions: int = 8):
+        self.sftp_opts = sftp_opts
+        self._idle_sessions: "queue.LifoQueue[_LftpSession]" = queue.LifoQueue(maxsize=max_idle_sessions)
+        # Connections held by the idle sessions
+        self._idle_connections = 0
+        self._idle_lock = threading.Lock()
+
+    def _take_idle(self) -> Optional[_LftpSession]:
+        try:
+            session = self._idle_sessions.get_nowait()
+        except queue.Empty:
+            return None
+        with self._idle_lock:
+            self._idle_connections -= session.connections
+        return session
+
+    @contextlib.contextmanager
+    def _session(self) -> Iterator[_LftpSession]:
+        session: Optional[_LftpSession] = None
+        while session is None:
+            session = self._take_idle()
+            if session is None:
+                log.debug(f"Starting lftp session to {self.sftp_opts['host']}")
+                session = _LftpSession(self.sftp_opts)
+            if not session.is_alive():
+                session = None
+        try:
+            yield session
+        except _CommandFailed:
+            # lftp finished the command, so the connection is as good as after one which succeeded
+            self._release(session)
+            raise
+        except BaseException:
+            # The session could be in the middle of a command, so don't reuse it
+            session.close()
+            raise
+        self._release(session)
+
+    def _release(self, session: _LftpSession) -> None:
+        """Return a session to the pool, or close it if the pool is full"""
+        with self._idle_lock:
+            # Counted before it can be taken again, so the count never goes negative
+            self._idle_connections += session.connections
+        try:
+            self._idle_sessions.put_nowait(session)
+        except queue.Full:
+            with self._idle_lock:
+                self._idle_connections -= session.connections
+            session.close()
+
+    def _run(self, fetch_cmd: str, connections: int) -> None:
+        with self._session() as session:
+            session.run(fetch_cmd, connections)
+
+    def idle_connections(self) -> int:
+        with self._idle_lock:
+            return self._idle_connections
+
+    def close_idle(self, connections: int) -> int:
+        closed = 0
+        while closed < connections:
+            session = self._take_idle()
+            if session is None:
+                break
+            session.close()
+            closed += session.connections
+        return closed
+
+    def close(self) -> None:
+        while True:
+            session = self._take_idle()
+            if session is None:
+                return
+            session.close()
+
+    # lftp can't change its connection counts once started, so transfers only use the initially chosen counts
+    def fetch_file(
+        self, remote_path: str, local_path: str, connections: int, progress: Optional[ProgressCallback] = None, tuner: Optional[TransferTuner] = None
+    ) -> None:
+        self._run(f"pget -c -n {connections} {_quote(remote_path)} -o {_quote(local_path)}", connections)
+
+    def fetch_directory(
+        self,
+        remote_path: str,
+        local_path: str,
+        parallel_files: int,
+        connections_per_file: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional[TransferTuner] = None,
+    ) -> None:
+        self._run(
+            f"mirror -c --parallel={parallel_files} --use-pget-n={connections_per_file} {_quote(remote_path)} {_quote(local_path)}",
+            parallel_files * connections_per_file,
+        )
+
+    def fetch_range(self, remote_path: str, local_path: str, offset: int, length: int) -> None:
+        # get1 can fetch part of a file, which is fetched to the side and then written into place
+        range_path = local_path + ".rtd-range"
+        self._run(f"get1 --source-region={offset}-{offset + length} -o {_quote(range_path)} {_quote(remote_path)}", 1)
+        try:
+            with open(range_path, "rb") as f:
+                data = f.read(length)
+            if len(data) != length:
+                raise EOFError(f"Short read of {remote_path} at offset {offset}")
+            fd = os.open(local_path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data, offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            os.remove(range_path)
+
+    def fetch_files(
+        self,
+        files: List[Tuple[str, str]],
+        parallel_files: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional[TransferTuner] = None,
+    ) -> None:
+        if not files:
+            # lftp rejects a get without any files
+            return
+        # A single get of every file, so they share the session's connections
+        file_args = " ".join(f"{_quote(remote_path)} -o {_quote(local_path)}" for remote_path, local_path in files)
+        self._run(f"get -c -P {parallel_files} {file_args}", parallel_files)
@@ -0,0 +1,88 @@
+from typing import Any, Dict, List
+import unittest
+import subprocess
+from unittest import mock
+
+from downloader.transfer import lftp
+
+
+class _FakeSession(object):
+    """Stand-in for an lftp process, recording the commands it is sent"""
+
+    def __init__(self, sftp_opts: Dict[str, Any]):
+        self.connections = 0
+        self.commands: List[str] = []
+        self.closed = False
+
+    def is_alive(self) -> bool:
+        return not self.closed
+
+    def run(self, command: str, connections: int) -> None:
+        self.connections = max(self.connections, connections)
+        self.commands.append(command)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def _closed(session: Any) -> bool:
+    return bool(session.closed)
+
+
+class LftpEngineTest(unittest.TestCase):
+    def setUp(self) -> None:
+        patcher = mock.patch.object(lftp, "_LftpSession", _FakeSession)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.engine = lftp.LftpEngine({"host": "seedbox"}, max_idle_sessions=2)
+
+    def test_sessions_are_reused(self) -> None:
+        self.engine.fetch_file("/remote/a", "/local/a", 4)
+        self.engine.fetch_directory("/remote/b", "/local/b", 2, 3)
+        self.assertEqual(self.engine._idle_sessions.qsize(), 1)
+        # A session holds on to the most connections any of its commands opened
+        self.assertEqual(self.engine.idle_connections(), 6)
+
+    def test_close_idle(self) -> None:
+        with self.engine._session() as first, self.engine._session() as second:
+            first.run("pget", 4)
+            second.run("pget", 1)
+        self.assertEqual(self.engine.idle_connections(), 5)
+        self.assertEqual(self.engine.close_idle(1), 4)
+        self.assertTrue(_closed(first))
+        self.assertFalse(_closed(second))
+        self.assertEqual(self.engine.idle_connections(), 1)
+        self.assertEqual(self.engine.close_idle(10), 1)
+        self.assertEqual(self.engine.idle_connections(), 0)
+
+    def test_sessions_beyond_the_pool_are_closed(self) -> None:
+        with self.engine._session() as first, self.engine._session() as second, self.engine._session() as third:
+            for session in (first, second, third):
+                session.run("pget", 2)
+        self.assertEqual(self.engine.idle_connections(), 4)
+        self.assertEqual(sum(_closed(session) for session in (first, second, third)), 1)
+
+    def test_no_files_runs_nothing(self) -> None:
+        self.engine.fetch_files([], 4)
+        self.assertEqual(self.engine._idle_sessions.qsize(), 0)
+
+    def test_session_is_reused_after_a_failed_command(self) -> None:
+        with self.assertRaises(subprocess.CalledProcessError), self.engine._session() as session:
+            session.run("pget", 3)
+            raise lftp._CommandFailed(1, "pget")
+        self.assertFalse(_closed(session))
+        self.assertEqual(self.engine.idle_connections(), 3)
+
+    def test_failed_session_is_not_reused(self) -> None:
+        # i.e. interrupted, or lftp exited without reporting how the command went
+        for error in (RuntimeError(), KeyboardInterrupt(), subprocess.CalledProcessError(-9, "pget")):
+            with self.subTest(error=error):
+                with self.assertRaises(type(error)), self.engine._session() as session:
+                    session.run("pget", 3)
+                    raise error
+                self.assertTrue(_closed(session))
+                self.assertEqual(self.engine.idle_connections(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
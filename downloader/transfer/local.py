@@ -0,0 +1,47 @@
+from typing import List, Tuple, Iterator, Any
+import os
+
+from downloader.transfer.segmented import SegmentedEngine
+
+
+class _LocalAttributes(object):
+    def __init__(self, filename: str, st_mode: int, st_size: int):
+        self.filename = filename
+        self.st_mode = st_mode
+        self.st_size = st_size
+
+
+class _LocalFile(object):
+    def __init__(self, path: str):
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def readv(self, chunks: List[Tuple[int, int]]) -> Iterator[bytes]:
+        for offset, length in chunks:
+            yield os.pread(self._fd, length, offset)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class LocalSession(object):
+    """Stand-in for an sftp session which reads from the local filesystem"""
+
+    def stat(self, path: str) -> Any:
+        return os.stat(path)
+
+    def listdir_attr(self, path: str = ".") -> List[Any]:
+        with os.scandir(path) as entries:
+            return [_LocalAttributes(entry.name, attrs.st_mode, attrs.st_size) for entry in entries for attrs in [entry.stat(follow_symlinks=False)]]
+
+    def open(self, filename: str, mode: str = "r", bufsize: int = -1) -> Any:
+        return _LocalFile(filename)
+
+    def close(self) -> None:
+        pass
+
+
+class LocalEngine(SegmentedEngine):
+    """Transfers from a locally accessible path (i.e. a mounted seedbox, or for offline testing and benchmarking)"""
+
+    def _open_session(self) -> LocalSession:
+        return LocalSession()
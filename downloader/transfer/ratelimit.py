@@ -0,0 +1,41 @@
+from typing import Optional
+import time
+import threading
+
+from downloader.state import config
+
+
+class RateLimiter(object):
+    """Token bucket shared by every transfer, so that together they stay under a rate (in bytes per second)"""
+
+    def __init__(self, rate: int, burst_seconds: float = 1.0):
+        self.rate = rate
+        self._capacity = rate * burst_seconds
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes: int) -> None:
+        """Wait until num_bytes can be transferred without going over the rate"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens can go negative, which makes the next callers wait for this transfer too
+            self._tokens -= num_bytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> Optional[RateLimiter]:
+    """Get the limiter shared across all seedboxes, or None if max_download_rate is unlimited"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None and config.get_max_download_rate() > 0:
+            _limiter = RateLimiter(config.get_max_download_rate())
+        return _limiter
@@ -0,0 +1,57 @@
+from typing import List
+import unittest
+from unittest import mock
+
+from downloader.transfer.ratelimit import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 100.0
+        self.sleeps: List[float] = []
+        monotonic = mock.patch("time.monotonic", lambda: self.now)
+        monotonic.start()
+        self.addCleanup(monotonic.stop)
+        sleep = mock.patch("time.sleep", self._sleep)
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def _sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_burst_is_not_delayed(self) -> None:
+        limiter = RateLimiter(1000, burst_seconds=2)
+        limiter.consume(1500)
+        limiter.consume(500)
+        self.assertEqual(self.sleeps, [])
+
+    def test_waits_for_tokens(self) -> None:
+        limiter = RateLimiter(1000)
+        limiter.consume(1000)
+        limiter.consume(500)
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_tokens_refill_over_time(self) -> None:
+        limiter = RateLimiter(1000)
+        limiter.consume(1000)
+        self.now += 0.25
+        limiter.consume(500)
+        self.assertEqual(self.sleeps, [0.25])
+
+    def test_refill_is_capped_at_the_burst(self) -> None:
+        limiter = RateLimiter(1000)
+        self.now += 60
+        limiter.consume(3000)
+        self.assertEqual(self.sleeps, [2.0])
+
+    def test_debt_delays_later_callers(self) -> None:
+        limiter = RateLimiter(1000)
+        # A single large read goes over the bucket, and whoever comes next pays for it too
+        limiter.consume(4000)
+        limiter.consume(1000)
+        self.assertEqual(self.sleeps, [3.0, 1.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,347 @@
+from typing import List, Tuple, Iterator, Iterable, Optional, Any, Protocol
+import os
+import json
+import errno
+import math
+import queue
+import stat
+import logging
+import posixpath
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader.transfer.engine import TransferEngine, ProgressCallback
+from downloader.transfer.tuning import TransferTuner
+from downloader.transfer import ratelimit
+from downloader.state import config
+
+log = logging.getLogger("segmented")
+
+_CHUNK_SIZE = 1 << 20  # 1 MiB
+# Files are split into at most one segment per connection, but segments are never smaller than this
+_MIN_SEGMENT_SIZE = 8 << 20
+# Number of chunks requested at once (pipelined) per segment
+_READ_WINDOW = 32
+# How many bytes (per file) are written between saves of the resume checkpoint
+_CHECKPOINT_INTERVAL = 64 << 20
+_CHECKPOINT_SUFFIX = ".rtd-segments"
+
+
+class RemoteFile(Protocol):
+    def readv(self, chunks: List[Tuple[int, int]]) -> Iterable[bytes]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class RemoteSession(Protocol):
+    """The subset of paramiko's SFTPClient used for transfers, so that stand-ins can be used for local transfers and benchmarking"""
+
+    def stat(self, path: str) -> Any:
+        raise NotImplementedError
+
+    def listdir_attr(self, path: str = ".") -> List[Any]:
+        raise NotImplementedError
+
+    def open(self, filename: str, mode: str = "r", bufsize: int = -1) -> RemoteFile:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class _SegmentPlan(object):
+    """Tracks which byte ranges of a file still need to be fetched, persisted next to the file so transfers can be resumed"""
+
+    def __init__(self, local_path: str, size: int, segments: List[List[int]]):
+        self.local_path = local_path
+        self.size = size
+        # Each segment is [next byte to fetch, end (exclusive)]
+        self.segments = segments
+        self._lock = threading.Lock()
+        self._unsaved_bytes = 0
+
+    @classmethod
+    def load_or_create(cls, local_path: str, size: int, segment_count: int) -> "_SegmentPlan":
+        try:
+            with open(local_path + _CHECKPOINT_SUFFIX) as f:
+                saved = json.load(f)
+            if saved["size"] == size:
+                return cls(local_path, size, saved["segments"])
+            log.warning(f"Remote size of {local_path} changed, restarting transfer")
+        except FileNotFoundError:
+            pass
+        try:
+            # Like lftp -c, existing data without a checkpoint is assumed to be a valid prefix of the file
+            existing = os.path.getsize(local_path)
+        except FileNotFoundError:
+            existing = 0
+        if existing > size:
+            existing = 0
+        remaining = size - existing
+        segment_count = max(1, min(segment_count, math.ceil(remaining / _MIN_SEGMENT_SIZE)))
+        segment_size = math.ceil(remaining / segment_count) if remaining else 0
+        segments = []
+        for i in range(segment_count):
+            start = existing + i * segment_size
+            segments.append([min(start, size), min(start + segment_size, size)])
+        return cls(local_path, size, segments)
+
+    def pending(self) -> List[int]:
+        return [i for i, (pos, end) in enumerate(self.segments) if pos < end]
+
+    def transferred(self) -> int:
+        return self.size - sum(end - pos for pos, end in self.segments)
+
+    def advance(self, index: int, length: int, fd: int) -> None:
+        with self._lock:
+            self.segments[index][0] += length
+            self._unsaved_bytes += length
+            if self._unsaved_bytes >= _CHECKPOINT_INTERVAL:
+                os.fdatasync(fd)
+                self.save()
+
+    def save(self) -> None:
+        self._unsaved_bytes = 0
+        tmp_path = self.local_path + _CHECKPOINT_SUFFIX + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self.size, "segments": self.segments}, f)
+        os.replace(tmp_path, self.local_path + _CHECKPOINT_SUFFIX)
+
+    def finish(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.local_path + _CHECKPOINT_SUFFIX)
+
+
+def _preallocate(fd: int, local_path: str, size: int) -> None:
+    """Allocate the whole file up front, so segments written out of order don't leave it fragmented (allocating what already is is a no-op)"""
+    if not size or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+        log.debug(f"Can't preallocate {local_path}, its filesystem doesn't support it")
+
+
+class SegmentedEngine(TransferEngine):
+    """Transfers over reusable sessions, splitting large files into ranges which are fetched in parallel.
+    Subclasses provide the session (i.e. sftp, or a local stand-in)
+    """
+
+    def __init__(self, max_idle_sessions: int = 32):
+        self._idle_sessions: "queue.LifoQueue[RemoteSession]" = queue.LifoQueue(maxsize=max_idle_sessions)
+
+    def _open_session(self) -> RemoteSession:
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def _session(self) -> Iterator[RemoteSession]:
+        try:
+            session = self._idle_sessions.get_nowait()
+        except queue.Empty:
+            session = self._open_session()
+        try:
+            yield session
+        except BaseException:
+            # The session could be broken, so don't reuse it
+            session.close()
+            raise
+        try:
+            self._idle_sessions.put_nowait(session)
+        except queue.Full:
+            session.close()
+
+    def idle_connections(self) -> int:
+        # Each session is a connection of its own
+        return self._idle_sessions.qsize()
+
+    def close_idle(self, connections: int) -> int:
+        closed = 0
+        while closed < connections:
+            try:
+                session = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
+            closed += 1
+        return closed
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle_sessions.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _fetch_segment(
+        self, remote_path: str, plan: _SegmentPlan, index: int, fd: int, progress: Optional[ProgressCallback], tuner: Optional[TransferTuner]
+    ) -> None:
+        limiter = ratelimit.get_limiter()
+        with tuner.segment_gate.slot() if tuner else contextlib.nullcontext(), self._session() as session:
+            remote_file = session.open(remote_path, "rb")
+            try:
+                pos, end = plan.segments[index]
+                while pos < end:
+                    chunks: List[Tuple[int, int]] = []
+                    window_pos = pos
+                    while window_pos < end and len(chunks) < _READ_WINDOW:
+                        length = min(_CHUNK_SIZE, end - window_pos)
+                        chunks.append((window_pos, length))
+                        window_pos += length
+                    for (offset, length), data in zip(chunks, remote_file.readv(chunks)):
+                        if len(data) != length:
+                            raise EOFError(f"Short read of {remote_path} at offset {offset}")
+                        if limiter:
+                            limiter.consume(length)
+                        os.pwrite(fd, data, offset)
+                        plan.advance(index, length, fd)
+                        if progress:
+                            progress(plan.local_path, plan.transferred(), plan.size)
+                    pos = window_pos
+            finally:
+                remote_file.close()
+
+    def _fetch_file_with_size(
+        self,
+        remote_path: str,
+        local_path: str,
+        size: int,
+        connections: int,
+        progress: Optional[ProgressCallback],
+        tuner: Optional[TransferTuner] = None,
+    ) -> None:
+        """Fetch a file of known size in up to connections segments. If tuner is given, it limits how many segments are fetched at once"""
+        plan = _SegmentPlan.load_or_create(local_path, size, connections)
+        pending = plan.pending()
+        if not pending and os.path.exists(local_path):
+            log.debug(f"{local_path} is already fully transferred")
+            plan.finish()
+            return
+        fd = os.open(local_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            if config.get_preallocate():
+                _preallocate(fd, local_path, size)
+            plan.save()
+            if pending:
+                with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                    futures = [executor.submit(self._fetch_segment, remote_path, plan, i, fd, progress, tuner) for i in pending]
+                    try:
+                        for future in futures:
+                            future.result()
+                    finally:
+                        # Even on failure, record what was fetched so a retry can resume
+                        for future in futures:
+                            future.exception()
+                        plan.save()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        plan.finish()
+
+    def fetch_file(
+        self, remote_path: str, local_path: str, connections: int, progress: Optional[ProgressCallback] = None, tuner: Optional[TransferTuner] = None
+    ) -> None:
+        with self._session() as session:
+            size = session.stat(remote_path).st_size
+        self._fetch_file_with_size(remote_path, local_path, size, connections, tuner or progress, tuner)
+
+    def fetch_range(self, remote_path: str, local_path: str, offset: int, length: int) -> None:
+        fd = os.open(local_path, os.O_WRONLY)
+        try:
+            with self._session() as session:
+                remote_file = session.open(remote_path, "rb")
+                try:
+                    end = offset + length
+                    chunks = [(pos, min(_CHUNK_SIZE, end - pos)) for pos in range(offset, end, _CHUNK_SIZE)]
+                    for i in range(0, len(chunks), _READ_WINDOW):
+                        window = chunks[i : i + _READ_WINDOW]
+                        for (chunk_offset, chunk_length), data in zip(window, remote_file.readv(window)):
+                            if len(data) != chunk_length:
+                                raise EOFError(f"Short read of {remote_path} at offset {chunk_offset}")
+                            os.pwrite(fd, data, chunk_offset)
+                finally:
+                    remote_file.close()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def list_files(self, remote_path: str) -> List[Tuple[str, int]]:
+        """Recursively list the regular files within a remote directory as (path relative to remote_path, size)"""
+        files: List[Tuple[str, int]] = []
+        stack = [""]
+        with self._session() as session:
+            while stack:
+                relative_dir = stack.pop()
+                for attr in session.listdir_attr(posixpath.join(remote_path, relative_dir)):
+                    relative_path = posixpath.join(relative_dir, attr.filename)
+                    if stat.S_ISDIR(attr.st_mode):
+                        stack.append(relative_path)
+                    elif stat.S_ISREG(attr.st_mode):
+                        files.append((relative_path, attr.st_size))
+                    else:
+                        log.debug(f"Skipping {relative_path} in {remote_path} which is not a regular file or directory")
+        return files
+
+    def _fetch_directory_file(
+        self, remote_path: str, local_path: str, size: int, connections: int, progress: Optional[ProgressCallback], tuner: Optional[TransferTuner]
+    ) -> None:
+        with tuner.file_gate.slot() if tuner else contextlib.nullcontext():
+            self._fetch_file_with_size(remote_path, local_path, size, connections, progress)
+
+    def _fetch_many(
+        self,
+        files: List[Tuple[str, str, int]],
+        parallel_files: int,
+        connections_per_file: int,
+        progress: Optional[ProgressCallback],
+        tuner: Optional[TransferTuner],
+    ) -> None:
+        """Fetch (remote path, local path, size) files, up to parallel_files at once"""
+        with ThreadPoolExecutor(max_workers=max(1, parallel_files)) as executor:
+            futures = [
+                executor.submit(self._fetch_directory_file, remote_file, local_file, size, connections_per_file, tuner or progress, tuner)
+                for remote_file, local_file, size in files
+            ]
+            for future in futures:
+                future.result()
+
+    def fetch_directory(
+        self,
+        remote_path: str,
+        local_path: str,
+        parallel_files: int,
+        connections_per_file: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional[TransferTuner] = None,
+    ) -> None:
+        files = self.list_files(remote_path)
+        os.makedirs(local_path, exist_ok=True)
+        for relative_path, _ in files:
+            os.makedirs(os.path.dirname(os.path.join(local_path, relative_path)), exist_ok=True)
+        self._fetch_many(
+            [(posixpath.join(remote_path, relative_path), os.path.join(local_path, relative_path), size) for relative_path, size in files],
+            parallel_files,
+            connections_per_file,
+            progress,
+            tuner,
+        )
+
+    def fetch_files(
+        self,
+        files: List[Tuple[str, str]],
+        parallel_files: int,
+        progress: Optional[ProgressCallback] = None,
+        tuner: Optional[TransferTuner] = None,
+    ) -> None:
+        if not files:
+            return
+        # Stat every file over a single session, rather than a session per file
+        with self._session() as session:
+            sized = [(remote_path, local_path, session.stat(remote_path).st_size) for remote_path, local_path in files]
+        self._fetch_many(sized, parallel_files, 1, progress, tuner)
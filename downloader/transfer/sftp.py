@@ -0,0 +1,51 @@
+from typing import Dict, List, Any
+import logging
+
+import paramiko
+
+from downloader.transfer.segmented import SegmentedEngine
+
+log = logging.getLogger("sftp")
+
+
+class _SftpSession(object):
+    """An authenticated sftp session which owns its ssh connection"""
+
+    def __init__(self, sftp_opts: Dict[str, Any]):
+        self._ssh = paramiko.SSHClient()
+        # Like lftp (via ssh), only connect to hosts which are already known
+        self._ssh.load_system_host_keys()
+        self._ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        self._ssh.connect(
+            sftp_opts["host"],
+            port=sftp_opts["port"],
+            username=sftp_opts["username"],
+            password=sftp_opts["password"] or None,
+            compress=False,
+        )
+        self._sftp = self._ssh.open_sftp()
+
+    def stat(self, path: str) -> Any:
+        return self._sftp.stat(path)
+
+    def listdir_attr(self, path: str = ".") -> List[Any]:
+        return self._sftp.listdir_attr(path)
+
+    def open(self, filename: str, mode: str = "r", bufsize: int = -1) -> Any:
+        return self._sftp.open(filename, mode, bufsize)
+
+    def close(self) -> None:
+        self._sftp.close()
+        self._ssh.close()
+
+
+class SftpEngine(SegmentedEngine):
+    """Transfers in-process over sftp, reusing authenticated sessions between transfers"""
+
+    def __init__(self, sftp_opts: Dict[str, Any]):
+        super().__init__()
+        self.sftp_opts = sftp_opts
+
+    def _open_session(self) -> _SftpSession:
+        log.debug(f"Opening sftp session to {self.sftp_opts['host']}")
+        return _SftpSession(self.sftp_opts)
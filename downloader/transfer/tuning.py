@@ -0,0 +1,229 @@
+from typing import List, Dict, Tuple, Any, Iterator, Optional
+import math
+import time
+import logging
+import threading
+import contextlib
+from collections import deque
+
+from downloader.transfer.engine import ProgressCallback
+
+log = logging.getLogger("tuning")
+
+# Roughly how many bytes of a file make it worth opening another connection for it
+_BYTES_PER_CONNECTION = 32 << 20
+# Files smaller than this gain nothing from segmenting, only from being fetched alongside other files
+_SMALL_FILE_SIZE = 16 << 20
+# Seconds between throughput measurements (and adjustments) while transferring
+_ADJUST_INTERVAL = 5.0
+# Relative throughput change which counts as an improvement or a regression, rather than noise
+_IMPROVEMENT = 1.05
+_REGRESSION = 0.9
+_MAX_HISTORY = 200
+
+
+class TransferPlan(object):
+    """Connection counts chosen for a single transfer, and the ceilings they can be adjusted within.
+    parallel_files is how many files are fetched at once, connections is how many segments each file is split into
+    """
+
+    def __init__(self, parallel_files: int, connections: int, max_parallel_files: int, max_connections: int, budget: int):
+        self.parallel_files = parallel_files
+        self.connections = connections
+        self.max_parallel_files = max_parallel_files
+        self.max_connections = max_connections
+        # Total connections this transfer can ever use at once
+        self.budget = budget
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "parallel_files": self.parallel_files,
+            "connections": self.connections,
+            "max_parallel_files": self.max_parallel_files,
+            "max_connections": self.max_connections,
+            "budget": self.budget,
+        }
+
+
+def _useful_connections(size: int, ceiling: int) -> int:
+    return max(1, min(ceiling, math.ceil(size / _BYTES_PER_CONNECTION)))
+
+
+def _byte_weighted_median(sizes: List[int]) -> int:
+    """Size of the file containing the middle byte, i.e. the size of file most of the data is in"""
+    sizes = sorted(sizes)
+    half = sum(sizes) / 2
+    running = 0
+    for size in sizes:
+        running += size
+        if running >= half:
+            return size
+    return 0
+
+
+def connection_ceiling(files: List[Tuple[str, int]], directory: bool, sftp_opts: Dict[str, Any]) -> int:
+    """The most connections a transfer of these files could make use of, within the configured limits"""
+    if not files:
+        return sftp_opts["mirror_parallel"] * sftp_opts["mirror_conn"] if directory else sftp_opts["pget_conn"]
+    if not directory:
+        return _useful_connections(files[0][1], sftp_opts["pget_conn"])
+    useful = sum(_useful_connections(size, sftp_opts["mirror_conn"]) for _, size in files)
+    return max(1, min(sftp_opts["mirror_parallel"] * sftp_opts["mirror_conn"], useful))
+
+
+def plan_transfer(files: List[Tuple[str, int]], directory: bool, sftp_opts: Dict[str, Any], connection_limit: int = 0) -> TransferPlan:
+    """Choose how many files to fetch at once and how many segments to split each into, from the file count and size distribution.
+    pget_conn is the ceiling of segments for a single file, mirror_conn the ceiling of segments per file within a directory,
+    and mirror_parallel * mirror_conn (or connection_limit if lower) the total connection budget of a directory
+    """
+    budget = connection_ceiling(files, directory, sftp_opts)
+    if connection_limit > 0:
+        budget = min(budget, connection_limit)
+    if not files:
+        # Nothing is known about the files, so use the configured values as they are
+        if directory:
+            parallel_files = min(sftp_opts["mirror_parallel"], budget)
+            connections = max(1, min(sftp_opts["mirror_conn"], budget // parallel_files))
+            return TransferPlan(parallel_files, connections, parallel_files, connections, budget)
+        return TransferPlan(1, budget, 1, budget, budget)
+    if not directory:
+        return TransferPlan(1, budget, 1, budget, budget)
+    # Segment files by the size most of the data is in; parallelize across files with the rest of the budget
+    typical_size = _byte_weighted_median([size for _, size in files])
+    large_files = sum(1 for _, size in files if size >= _SMALL_FILE_SIZE)
+    # Leave enough of the budget for several large files to be fetched at once (up to mirror_parallel of them)
+    per_file_budget = max(1, budget // max(1, min(large_files, sftp_opts["mirror_parallel"])))
+    connections = 1 if typical_size < _SMALL_FILE_SIZE else _useful_connections(typical_size, min(sftp_opts["mirror_conn"], per_file_budget))
+    max_parallel_files = max(1, min(len(files), budget))
+    parallel_files = max(1, min(len(files), budget // connections))
+    return TransferPlan(parallel_files, connections, max_parallel_files, connections, budget)
+
+
+class _Gate(object):
+    """Limits how many holders can be inside at once, with a limit that can change at any time"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[None]:
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+
+_history: "deque[Dict[str, Any]]" = deque(maxlen=_MAX_HISTORY)
+_history_lock = threading.Lock()
+
+
+def get_history() -> List[Dict[str, Any]]:
+    """Chosen parameters, adjustments, and achieved rates of the most recent transfers"""
+    with _history_lock:
+        return list(_history)
+
+
+class TransferTuner(object):
+    """Adjusts a transfer's concurrency from its measured throughput while it runs (by hill climbing), within the plan's ceilings.
+    Directories adjust how many files are fetched at once, single files how many segments are fetched at once.
+    Also acts as the progress callback of the transfer, passing progress on to progress
+    """
+
+    def __init__(self, remote_path: str, plan: TransferPlan, directory: bool, progress: Optional[ProgressCallback] = None):
+        self.remote_path = remote_path
+        self.plan = plan
+        self.directory = directory
+        self.progress = progress
+        self.file_gate = _Gate(plan.parallel_files)
+        self.segment_gate = _Gate(plan.connections)
+        self._initial = plan.as_dict()
+        self._lock = threading.Lock()
+        self._file_progress: Dict[str, int] = {}
+        self._start = time.monotonic()
+        self._last_adjust = self._start
+        self._last_bytes = 0
+        self._best_rate = 0.0
+        self._direction = 1
+        self._adjustments: List[Dict[str, float]] = []
+
+    def _knob(self) -> Tuple[int, int]:
+        """Current value and ceiling of what is being adjusted"""
+        if self.directory:
+            ceiling = min(self.plan.max_parallel_files, max(1, self.plan.budget // self.plan.connections))
+            return self.plan.parallel_files, ceiling
+        return self.plan.connections, self.plan.max_connections
+
+    def _set_knob(self, value: int) -> None:
+        if self.directory:
+            self.plan.parallel_files = value
+            self.file_gate.set_limit(value)
+        else:
+            self.plan.connections = value
+            self.segment_gate.set_limit(value)
+
+    def _adjust(self, now: float, transferred: int) -> None:
+        rate = (transferred - self._last_bytes) / (now - self._last_adjust)
+        self._last_adjust = now
+        self._last_bytes = transferred
+        value, ceiling = self._knob()
+        if rate > self._best_rate * _IMPROVEMENT:
+            # Still improving, keep going the same way
+            self._best_rate = rate
+        elif rate < self._best_rate * _REGRESSION:
+            # The last change made things worse (or the link got slower), so go back the other way
+            self._direction = -self._direction
+            self._best_rate = rate
+        else:
+            # Plateau; hold here
+            return
+        new_value = max(1, min(ceiling, value + self._direction))
+        if new_value != value:
+            self._set_knob(new_value)
+            self._adjustments.append({"seconds": round(now - self._start, 1), "value": new_value, "rate": rate})
+            log.debug(f"{self.remote_path}: {rate / (1 << 20):.1f} MiB/s, now using {new_value} {'parallel files' if self.directory else 'segments'}")
+
+    def __call__(self, local_path: str, transferred: int, total: int) -> None:
+        if self.progress:
+            self.progress(local_path, transferred, total)
+        now = time.monotonic()
+        with self._lock:
+            self._file_progress[local_path] = transferred
+            if now - self._last_adjust >= _ADJUST_INTERVAL:
+                self._adjust(now, sum(self._file_progress.values()))
+
+    def finish(self) -> Dict[str, Any]:
+        """Record (and return) what was chosen and what rate was achieved"""
+        elapsed = time.monotonic() - self._start
+        with self._lock:
+            transferred = sum(self._file_progress.values())
+        record: Dict[str, Any] = {
+            "remote_path": self.remote_path,
+            "finished": time.time(),
+            "seconds": round(elapsed, 3),
+            "bytes": transferred,
+            "bytes_per_second": transferred / elapsed if elapsed > 0 else 0.0,
+            "initial": self._initial,
+            "final": self.plan.as_dict(),
+            "adjustments": self._adjustments,
+        }
+        with _history_lock:
+            _history.append(record)
+        log.info(
+            f"Transferred {self.remote_path} at {record['bytes_per_second'] / (1 << 20):.1f} MiB/s "
+            f"({self._initial['parallel_files']} parallel files x {self._initial['connections']} segments, "
+            f"ended at {self.plan.parallel_files} x {self.plan.connections})"
+        )
+        return record
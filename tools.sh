@@ -18,6 +18,7 @@ run         : run the project
 unit        : run unit tests on the project
 coverage    : view coverage for the project (must run unit first)
 tests       : run all tests for the project and display coverage when finished
+bench       : run the offline benchmarks (extra arguments are passed through, i.e. --scale 0.1 or --help)
 lint        : check that the project has no linting errors with black
 format      : automatically try to fix any linting problems that exist with the black formatter
 clean       : remove compiled python/docs/other build or distribution artifacts from the local project
@@ -38,6 +39,9 @@ elif [ "$1" = "coverage" ]; then
 elif [ "$1" = "tests" ]; then
     sh tools.sh unit
     sh tools.sh coverage
+elif [ "$1" = "bench" ]; then
+    shift
+    $py_exec -m downloader.benchmark.main "$@"
 elif [ "$1" = "lint" ]; then
     find downloader -name "*.py" -exec $py_exec -m flake8 {} +
     $py_exec -m black --check -l 150 -t py312 downloader